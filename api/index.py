@@ -1 +1 @@
-from backend.main import app
+from backend.serverless import app
@@ -4,13 +4,24 @@ Replaces legacy scraping/v1 library with official netfilm/aoneroom H5 API.
 """
 
 import asyncio
+import contextlib
 import difflib
+import os
 import re
 import json
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
 import httpx
 
-API_BASE = "https://h5-api.aoneroom.com/wefeed-h5api-bff"
-_bearer_token: str | None = None
+from codec_probe import normalize_codec, sniff_url_codec
+from metrics import CACHE_EVENTS, STAGE_SECONDS, UPSTREAM_RESPONSES
+from stream_url_cache import signature_expiry
+from token_manager import TokenManager
+from upstream_governor import governed_transport
+
+# Overridable so the backend can run against the offline stub (h5_stub_server.py)
+API_BASE = os.environ.get("H5_API_BASE", "https://h5-api.aoneroom.com/wefeed-h5api-bff")
 
 DEFAULT_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/148.0.0.0 Safari/537.36",
@@ -32,58 +43,131 @@ PLAYER_HEADERS = {
     "X-Source": "",
 }
 
-async def _get_bearer_token() -> str:
-    global _bearer_token
-    if _bearer_token:
-        return _bearer_token
-    async with httpx.AsyncClient(follow_redirects=True, timeout=20) as client:
-        try:
-            resp = await client.get(f"{API_BASE}/home?host=moviebox.ph", headers=DEFAULT_HEADERS)
-            x_user = resp.headers.get("x-user")
-            if x_user:
-                _bearer_token = json.loads(x_user).get("token")
-            if not _bearer_token:
-                cookie = resp.headers.get("set-cookie", "")
-                m = re.search(r"token=([^;]+)", cookie)
-                if m:
-                    _bearer_token = m.group(1)
-        except Exception as e:
-            print(f"DEBUG: Token acquisition error: {e}")
-    return _bearer_token or ""
+# Shared H5 transport. Owned by the FastAPI lifespan (start_h5_client / close_h5_client)
+# so every H5 call reuses warm keep-alive connections instead of a fresh TCP+TLS handshake.
+H5_MAX_CONNECTIONS = int(os.environ.get("H5_MAX_CONNECTIONS", "20"))
+H5_MAX_KEEPALIVE = int(os.environ.get("H5_MAX_KEEPALIVE", "10"))
+H5_KEEPALIVE_EXPIRY = float(os.environ.get("H5_KEEPALIVE_EXPIRY", "60"))
+H5_HTTP2 = os.environ.get("H5_HTTP2", "1") == "1"
 
-async def _make_request(url: str, method: str = "GET", payload: dict = None, custom_headers: dict = None) -> dict:
-    global _bearer_token
-    token = await _get_bearer_token()
-    headers = {
-        **DEFAULT_HEADERS,
-        "Authorization": f"Bearer {token}" if token else "",
-        **(custom_headers or {})
-    }
-    async with httpx.AsyncClient(follow_redirects=True, timeout=25) as client:
+_h5_client: httpx.AsyncClient | None = None
+
+def _new_h5_client() -> httpx.AsyncClient:
+    http2 = H5_HTTP2
+    if http2:
         try:
-            if method == "POST":
-                resp = await client.post(url, headers=headers, json=payload)
-            else:
-                resp = await client.get(url, headers=headers)
+            import h2  # noqa: F401  (optional, installed via httpx[http2])
+        except ImportError:
+            http2 = False
+    return httpx.AsyncClient(
+        follow_redirects=True,
+        timeout=httpx.Timeout(25.0, connect=10.0),
+        # Every H5 request passes the upstream governor (per-host rate, priority queueing)
+        transport=governed_transport(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=H5_MAX_CONNECTIONS,
+                max_keepalive_connections=H5_MAX_KEEPALIVE,
+                keepalive_expiry=H5_KEEPALIVE_EXPIRY,
+            ),
+        ),
+    )
+
+async def start_h5_client() -> httpx.AsyncClient:
+    """Create the shared H5 client. Call once from the app lifespan."""
+    global _h5_client
+    if _h5_client is None or _h5_client.is_closed:
+        _h5_client = _new_h5_client()
+    return _h5_client
+
+async def close_h5_client():
+    """Close the shared H5 client and drain its pool."""
+    global _h5_client
+    client, _h5_client = _h5_client, None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+
+@contextlib.asynccontextmanager
+async def _h5_session():
+    """Yield the shared client when the lifespan owns one, else a short-lived client (scripts, Flask)."""
+    if _h5_client is not None and not _h5_client.is_closed:
+        yield _h5_client
+    else:
+        async with _new_h5_client() as client:
+            yield client
+
+async def _bootstrap_token() -> str | None:
+    """Fetch a fresh token from /home (x-user header, else the token cookie)."""
+    token = None
+    async with _h5_session() as client:
+        resp = await client.get(f"{API_BASE}/home?host=moviebox.ph", headers=DEFAULT_HEADERS, timeout=20)
+        UPSTREAM_RESPONSES.inc("/home", resp.status_code)
+        x_user = resp.headers.get("x-user")
+        if x_user:
+            token = json.loads(x_user).get("token")
+        if not token:
+            cookie = resp.headers.get("set-cookie", "")
+            m = re.search(r"token=([^;]+)", cookie)
+            if m:
+                token = m.group(1)
+    return token
+
+# Set H5_TOKEN_FILE to persist the token across restarts / serverless cold starts
+_token_manager = TokenManager(_bootstrap_token, persist_path=os.environ.get("H5_TOKEN_FILE") or None)
+
+def get_token_stats() -> dict:
+    return _token_manager.stats()
 
-            x_user = resp.headers.get("x-user")
-            if x_user:
-                new_token = json.loads(x_user).get("token")
-                if new_token:
-                    _bearer_token = new_token
+async def _get_bearer_token() -> str:
+    return await _token_manager.get()
 
-            if resp.status_code == 200:
-                return resp.json()
-            return {}
-        except Exception as e:
-            print(f"DEBUG: Request failed {url}: {e}")
-            return {}
+def _endpoint_label(url: str) -> str:
+    """Metric label for an H5 URL, e.g. /subject/download."""
+    path = urlsplit(url).path
+    return path.split("/wefeed-h5api-bff", 1)[-1] or path
+
+async def _make_request(url: str, method: str = "GET", payload: dict = None, custom_headers: dict = None) -> dict:
+    for attempt in range(2):
+        token = await _get_bearer_token()
+        headers = {
+            **DEFAULT_HEADERS,
+            "Authorization": f"Bearer {token}" if token else "",
+            **(custom_headers or {})
+        }
+        async with _h5_session() as client:
+            try:
+                if method == "POST":
+                    resp = await client.post(url, headers=headers, json=payload)
+                else:
+                    resp = await client.get(url, headers=headers)
+                UPSTREAM_RESPONSES.inc(_endpoint_label(url), resp.status_code)
+
+                x_user = resp.headers.get("x-user")
+                if x_user:
+                    _token_manager.update(json.loads(x_user).get("token"))
+
+                if resp.status_code == 401 and attempt == 0:
+                    # Revoked or rotated server-side: drop it and retry once with a fresh token
+                    _token_manager.invalidate(token)
+                    continue
+                if resp.status_code == 200:
+                    return resp.json()
+                return {}
+            except Exception as e:
+                UPSTREAM_RESPONSES.inc(_endpoint_label(url), "error")
+                print(f"DEBUG: Request failed {url}: {e}")
+                return {}
+    return {}
 
 async def _search_moviebox(title: str):
     """Search title and return list of results."""
     url = f"{API_BASE}/subject/search"
-    data = await _make_request(url, method="POST", payload={"keyword": title, "page": 1, "perPage": 15})
-    inner = data.get("data", {})
+    with STAGE_SECONDS.time("search"):
+        data = await _make_request(url, method="POST", payload={"keyword": title, "page": 1, "perPage": 15})
+    if "data" not in data:
+        # Upstream failure (as opposed to a genuine empty result) – lets callers avoid caching it
+        return None
+    inner = data.get("data") or {}
     raw = inner.get("items", inner.get("list", []))
     items = []
     for item in raw:
@@ -97,22 +181,180 @@ async def _search_moviebox(title: str):
         })
     return items
 
-async def _find_best_match(title: str, year: int = None, is_tv: bool = None):
-    items = await _search_moviebox(title)
-    if not items:
-        # Retry with clean title (stripping symbols)
-        clean_title = re.sub(r"[^\w\s]", " ", title).strip()
-        if clean_title != title:
-            items = await _search_moviebox(clean_title)
+class _MatchCache:
+    """Bounded TTL + LRU cache of title -> subject matches, with shorter-lived negative entries."""
+
+    def __init__(self, max_entries: int, ttl: float, negative_ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: OrderedDict[tuple, tuple[dict | None, float]] = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        """Return (found, match). found is False on a miss or an expired entry."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        match, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        if match is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, match
+
+    def put(self, key: tuple, match: dict | None):
+        ttl = self.ttl if match is not None else self.negative_ttl
+        self._entries[key] = (match, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+        }
+
+_match_cache = _MatchCache(
+    max_entries=int(os.environ.get("MATCH_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("MATCH_CACHE_TTL", "21600")),  # 6 hours
+    negative_ttl=float(os.environ.get("MATCH_CACHE_NEGATIVE_TTL", "300")),  # 5 minutes
+)
+
+def get_match_cache_stats() -> dict:
+    return _match_cache.stats()
+
+CACHE_EVENTS.add_source(lambda: {
+    ("match", "hit"): _match_cache.hits,
+    ("match", "negative_hit"): _match_cache.negative_hits,
+    ("match", "miss"): _match_cache.misses,
+})
 
-    if not items and (":" in title or "-" in title):
+def _match_cache_key(title: str, year: int = None, is_tv: bool = None) -> tuple:
+    return (" ".join((title or "").lower().split()), year, is_tv)
+
+async def _find_best_match(title: str, year: int = None, is_tv: bool = None):
+    key = _match_cache_key(title, year, is_tv)
+    found, match = _match_cache.get(key)
+    if found:
+        return match
+
+    with STAGE_SECONDS.time("find_best_match"):
+        match, upstream_failed = await _search_best_match(title, year=year, is_tv=is_tv)
+    # Don't negative-cache a miss caused by a failed search request
+    if match is not None or not upstream_failed:
+        _match_cache.put(key, match)
+    return match
+
+# "sequential" tries raw -> symbol-stripped -> pre-colon titles one after another;
+# "hedged" launches them concurrently (staggered) and stops once a candidate clears the threshold.
+MATCH_SEARCH_MODE = os.environ.get("MATCH_SEARCH_MODE", "sequential")
+MATCH_SEARCH_STAGGER = float(os.environ.get("MATCH_SEARCH_STAGGER", "0.15"))
+MATCH_SCORE_THRESHOLD = 50
+
+def _search_variants(title: str) -> list[str]:
+    """Query strings to try for a title, in priority order."""
+    variants = [title]
+    # Clean title (stripping symbols)
+    clean_title = re.sub(r"[^\w\s]", " ", title).strip()
+    if clean_title and clean_title != title:
+        variants.append(clean_title)
+    if ":" in title or "-" in title:
         main_part = re.split(r"[:\-]", title)[0].strip()
-        if main_part and main_part != title:
-            items = await _search_moviebox(main_part)
+        if main_part and main_part not in variants:
+            variants.append(main_part)
+    return variants
+
+async def _search_best_match(title: str, year: int = None, is_tv: bool = None):
+    """Run the search fallbacks and score candidates. Returns (match, upstream_failed)."""
+    if MATCH_SEARCH_MODE == "hedged":
+        return await _search_best_match_hedged(title, year=year, is_tv=is_tv)
+
+    upstream_failed = False
+    items = None
+    for query in _search_variants(title):
+        items = await _search_moviebox(query)
+        upstream_failed |= items is None
+        if items:
+            break
 
     if not items:
-        return None
+        return None, upstream_failed
+
+    return _pick_best_match(title, items, year=year, is_tv=is_tv), upstream_failed
 
+async def _search_best_match_hedged(title: str, year: int = None, is_tv: bool = None):
+    """Hedged variant of _search_best_match: one scoring pass over the merged results of all variants."""
+    variants = _search_variants(title)
+
+    async def _staggered_search(query: str, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        return await _search_moviebox(query)
+
+    pending = {
+        asyncio.create_task(_staggered_search(q, i * MATCH_SEARCH_STAGGER)): i
+        for i, q in enumerate(variants)
+    }
+    results: dict[int, list | None] = {}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                idx = pending.pop(task)
+                try:
+                    results[idx] = task.result()
+                except Exception as e:
+                    print(f"DEBUG: Hedged search failed for '{variants[idx]}': {e}")
+                    results[idx] = None
+
+            ranked = _rank_candidates(title, _merge_search_results(results), year=year, is_tv=is_tv)
+            if ranked and ranked[0][0] >= MATCH_SCORE_THRESHOLD:
+                return ranked[0][1], False
+    finally:
+        # Slower searches are no longer needed once a candidate clears the threshold
+        for task in pending:
+            task.cancel()
+
+    upstream_failed = any(r is None for r in results.values())
+    # Same fallback as the sequential path: first result of the highest-priority variant that had any
+    for idx in sorted(results):
+        if results[idx]:
+            return results[idx][0], upstream_failed
+    return None, upstream_failed
+
+def _merge_search_results(results: dict[int, list | None]) -> list:
+    """Merge per-variant search results in priority order, dropping duplicate subjects."""
+    merged, seen = [], set()
+    for idx in sorted(results):
+        for item in results[idx] or []:
+            key = item.get("subject_id") or item.get("slug")
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(item)
+    return merged
+
+def _pick_best_match(title: str, items: list, year: int = None, is_tv: bool = None):
+    ranked = _rank_candidates(title, items, year=year, is_tv=is_tv)
+    if ranked and ranked[0][0] >= MATCH_SCORE_THRESHOLD:
+        return ranked[0][1]
+    return items[0] if items else None
+
+def _rank_candidates(title: str, items: list, year: int = None, is_tv: bool = None) -> list[tuple[float, dict]]:
+    """Score search results against the query, best first. Items under 0.6 similarity are dropped."""
     cleaned_query = title.lower().strip()
     candidates = []
 
@@ -152,9 +394,60 @@ async def _find_best_match(title: str, year: int = None, is_tv: bool = None):
         candidates.append((score, item))
 
     candidates.sort(key=lambda x: x[0], reverse=True)
-    if candidates and candidates[0][0] >= 50:
-        return candidates[0][1]
-    return items[0] if items else None
+    return candidates
+
+# Single-flight coalescing for get_movie_files: the player fires qualities,
+# subtitles, stream/check, stream and downloads at once for the same title,
+# so concurrent callers share one pending upstream resolution.
+_inflight_files: dict[tuple, asyncio.Task] = {}
+_files_stats = {"calls": 0, "upstream": 0, "coalesced": 0, "cached": 0}
+
+# Completed resolutions are kept until their stream URLs' signatures are about to expire,
+# so a prefetched episode (or a late follow-up request) doesn't pay for resolution again.
+FILES_CACHE_SIZE = int(os.environ.get("FILES_CACHE_SIZE", "256"))
+FILES_CACHE_TTL = float(os.environ.get("FILES_CACHE_TTL", "120"))  # when URLs carry no expiry
+FILES_CACHE_MAX_TTL = float(os.environ.get("FILES_CACHE_MAX_TTL", "3600"))
+_files_cache: OrderedDict[tuple, tuple[tuple, float]] = OrderedDict()
+
+def get_coalesce_stats() -> dict:
+    """Counters for get_movie_files coalescing (calls, upstream resolutions, coalesced waits, cache hits)."""
+    return {**_files_stats, "in_flight": len(_inflight_files), "cached_entries": len(_files_cache)}
+
+CACHE_EVENTS.add_source(lambda: {
+    ("movie_files", "hit"): _files_stats["cached"],
+    ("movie_files", "coalesced"): _files_stats["coalesced"],
+    ("movie_files", "miss"): _files_stats["upstream"],
+})
+
+def has_inflight_resolutions() -> bool:
+    return bool(_inflight_files)
+
+def _files_cache_get(key: tuple):
+    entry = _files_cache.get(key)
+    if entry is None:
+        return None
+    result, expires_at = entry
+    if time.time() >= expires_at:
+        del _files_cache[key]
+        return None
+    _files_cache.move_to_end(key)
+    return result
+
+def _files_cache_put(key: tuple, result: tuple):
+    downloads, _ = result
+    if not downloads:
+        return
+    now = time.time()
+    expiries = [signature_expiry(d["url"], now) for d in downloads]
+    known = [e for e in expiries if e is not None]
+    expires_at = min(known) - 60 if known else now + FILES_CACHE_TTL
+    expires_at = min(expires_at, now + FILES_CACHE_MAX_TTL)
+    if expires_at <= now:
+        return
+    _files_cache[key] = (result, expires_at)
+    _files_cache.move_to_end(key)
+    while len(_files_cache) > FILES_CACHE_SIZE:
+        _files_cache.popitem(last=False)
 
 async def get_movie_files(
     title: str,
@@ -162,6 +455,41 @@ async def get_movie_files(
     season: int = 1,
     episode: int = 1,
     is_tv: bool = None,
+):
+    key = ((title or "").strip().lower(), year, season, episode, is_tv)
+    loop = asyncio.get_running_loop()
+    _files_stats["calls"] += 1
+
+    cached = _files_cache_get(key)
+    if cached is not None:
+        _files_stats["cached"] += 1
+        return cached
+
+    task = _inflight_files.get(key)
+    # Tasks are bound to their loop; never share one across loops (Flask spins up its own)
+    if task is not None and task.get_loop() is loop and not task.done():
+        _files_stats["coalesced"] += 1
+    else:
+        _files_stats["upstream"] += 1
+        task = loop.create_task(_fetch_movie_files(title, year, season, episode, is_tv))
+        _inflight_files[key] = task
+
+        def _release(t, key=key):
+            if _inflight_files.get(key) is t:
+                del _inflight_files[key]
+            if not t.cancelled() and t.exception() is None:
+                _files_cache_put(key, t.result())
+        task.add_done_callback(_release)
+
+    # Shield so a disconnecting caller doesn't cancel the resolution for everyone else
+    return await asyncio.shield(task)
+
+async def _fetch_movie_files(
+    title: str,
+    year: int = None,
+    season: int = 1,
+    episode: int = 1,
+    is_tv: bool = None,
 ):
     try:
         match = await _find_best_match(title, year=year, is_tv=is_tv)
@@ -180,7 +508,8 @@ async def get_movie_files(
         referer_path = f"tv-series/{detail_path}" if is_tv_item else f"movies/{detail_path}"
         player_referer = f"https://moviebox.ph/{referer_path}"
 
-        res_data = await _make_request(download_url, custom_headers={"Referer": player_referer})
+        with STAGE_SECONDS.time("subject_download"):
+            res_data = await _make_request(download_url, custom_headers={"Referer": player_referer})
         inner_data = res_data.get("data", {})
 
         raw_streams = inner_data.get("downloads", [])
@@ -216,27 +545,28 @@ async def get_movie_files(
             play_url = f"{domain}/wefeed-h5api-bff/subject/play?subjectId={subject_id}&se={se_num}&ep={ep_num}&detailPath={detail_path}"
             play_referer = f"{domain}/spa/videoPlayPage/{referer_path}?id={subject_id}&detailSe={se_num}&detailEp={ep_num}&lang=en"
 
-            async with httpx.AsyncClient(follow_redirects=True, timeout=25) as client:
-                resp = await client.get(play_url, headers={**PLAYER_HEADERS, "Referer": play_referer})
-                if resp.status_code == 200:
-                    play_data = resp.json().get("data", {})
-                    fallback_streams = play_data.get("streams", [])
-                    for s in fallback_streams:
-                        url = s.get("url")
-                        res = s.get("resolutions")
-                        if url and url.startswith("http"):
-                            downloads.append({
-                                "url": str(url),
-                                "resolution": f"{res}P" if res else "Unknown",
-                                "resource_id": str(s.get("id", "")),
-                                "size": int(s.get("size", 0)) if s.get("size") else 0,
-                                "codec": s.get("codecName", "")
-                            })
+            with STAGE_SECONDS.time("subject_play"):
+                async with _h5_session() as client:
+                    resp = await client.get(play_url, headers={**PLAYER_HEADERS, "Referer": play_referer})
+            UPSTREAM_RESPONSES.inc("/subject/play", resp.status_code)
+            if resp.status_code == 200:
+                play_data = resp.json().get("data", {})
+                fallback_streams = play_data.get("streams", [])
+                for s in fallback_streams:
+                    url = s.get("url")
+                    res = s.get("resolutions")
+                    if url and url.startswith("http"):
+                        downloads.append({
+                            "url": str(url),
+                            "resolution": f"{res}P" if res else "Unknown",
+                            "resource_id": str(s.get("id", "")),
+                            "size": int(s.get("size", 0)) if s.get("size") else 0,
+                            "codec": s.get("codecName", "")
+                        })
 
         # Prioritize non-HEVC and higher resolution
         def sort_key(item):
-            url = item.get("url", "").lower()
-            hevc = "h265" in url or "hevc" in url or "/h265/" in url
+            hevc = (normalize_codec(item.get("codec")) or sniff_url_codec(item.get("url", ""))) == "hevc"
             res_val = 0
             res_str = item.get("resolution", "")
             try:
@@ -295,50 +625,87 @@ async def get_media_metadata(title: str, year: int = None):
         print(f"DEBUG: get_media_metadata error: {e}")
         return None
 
-async def get_available_qualities(title: str, year: int = None, season: int = 1, episode: int = 1, is_tv: bool = None):
-    downloads, _ = await get_movie_files(title, year, season, episode, is_tv=is_tv)
-    if not downloads: return []
+def _sorted_qualities(downloads: list) -> list:
     qualities = set()
     for d in downloads:
         res = d.get("resolution", "")
         if res: qualities.add(str(res))
-    
+
     def sort_key(q):
         try: return int(re.sub(r"\D", "", str(q)))
         except: return 0
     return sorted(list(qualities), key=sort_key, reverse=True)
 
+async def get_available_qualities(title: str, year: int = None, season: int = 1, episode: int = 1, is_tv: bool = None):
+    downloads, _ = await get_movie_files(title, year, season, episode, is_tv=is_tv)
+    if not downloads: return []
+    return _sorted_qualities(downloads)
+
 async def get_available_qualities_with_urls(title: str, year: int = None, season: int = 1, episode: int = 1, is_tv: bool = None):
     downloads, _ = await get_movie_files(title, year, season, episode, is_tv=is_tv)
     if not downloads: return []
     return [{"quality": d.get("resolution", "Unknown"), "url": d.get("url", "")} for d in downloads if d.get("url")]
 
-async def get_available_subtitles(title: str, year: int = None, season: int = 1, episode: int = 1, is_tv: bool = None):
-    _, subtitles = await get_movie_files(title, year, season, episode, is_tv=is_tv)
-    if not subtitles: return []
-    LANG_MAP = {
-        "en": "English", "ar": "Arabic", "zh": "Chinese", "fr": "French",
-        "de": "German", "es": "Spanish", "it": "Italian", "ja": "Japanese",
-        "ko": "Korean", "pt": "Portuguese", "ru": "Russian", "ur": "Urdu",
-        "hi": "Hindi", "vi": "Vietnamese", "tr": "Turkish", "th": "Thai",
-        "id": "Indonesian", "ms": "Malay", "fa": "Persian", "he": "Hebrew",
-        "tl": "Tagalog",
-    }
+SUBTITLE_LANG_MAP = {
+    "en": "English", "ar": "Arabic", "zh": "Chinese", "fr": "French",
+    "de": "German", "es": "Spanish", "it": "Italian", "ja": "Japanese",
+    "ko": "Korean", "pt": "Portuguese", "ru": "Russian", "ur": "Urdu",
+    "hi": "Hindi", "vi": "Vietnamese", "tr": "Turkish", "th": "Thai",
+    "id": "Indonesian", "ms": "Malay", "fa": "Persian", "he": "Hebrew",
+    "tl": "Tagalog",
+}
+
+def _format_subtitles(subtitles: list) -> list:
     results = []
-    for i, s in enumerate(subtitles):
+    for i, s in enumerate(subtitles or []):
         lan_code = s.get("lan", "")
         lan_name = s.get("lanName", "")
-        display_lang = LANG_MAP.get(lan_code) or lan_name or f"Subtitle {i + 1}"
+        display_lang = SUBTITLE_LANG_MAP.get(lan_code) or lan_name or f"Subtitle {i + 1}"
         url = s.get("url", "")
         if url:
             results.append({"language": display_lang, "url": url})
     return results
 
-async def get_stream_url(title: str, quality: str = None, year: int = None, season: int = 1, episode: int = 1, is_tv: bool = None) -> str | None:
+async def get_available_subtitles(title: str, year: int = None, season: int = 1, episode: int = 1, is_tv: bool = None):
+    _, subtitles = await get_movie_files(title, year, season, episode, is_tv=is_tv)
+    if not subtitles: return []
+    return _format_subtitles(subtitles)
+
+async def resolve_media(title: str, year: int = None, season: int = 1, episode: int = 1, is_tv: bool = None) -> dict:
+    """Everything the player needs for one title in one pass: downloads, qualities, subtitles and metadata."""
+    files, metadata = await asyncio.gather(
+        get_movie_files(title, year, season, episode, is_tv=is_tv),
+        get_media_metadata(title, year=year),
+    )
+    downloads, subtitles = files
+    downloads = downloads or []
+
+    return {
+        "downloads": [
+            {
+                "quality": d.get("resolution", "Unknown"),
+                "codec": d.get("codec", ""),
+                "size": d.get("size", 0),
+                "resource_id": d.get("resource_id", ""),
+                "url": d.get("url", ""),
+            }
+            for d in downloads if d.get("url")
+        ],
+        "qualities": _sorted_qualities(downloads),
+        "subtitles": _format_subtitles(subtitles),
+        "metadata": metadata or {},
+    }
+
+async def get_stream_download(title: str, quality: str = None, year: int = None, season: int = 1, episode: int = 1, is_tv: bool = None) -> dict | None:
+    """The download entry (url, resolution, resource_id, codec) that get_stream_url would pick."""
     downloads, _ = await get_movie_files(title, year, season, episode, is_tv=is_tv)
     if not downloads:
         return None
     for d in downloads:
         if quality and d.get("resolution") == quality:
-            return d.get("url")
-    return downloads[0].get("url") if downloads else None
\ No newline at end of file
+            return d
+    return downloads[0]
+
+async def get_stream_url(title: str, quality: str = None, year: int = None, season: int = 1, episode: int = 1, is_tv: bool = None) -> str | None:
+    download = await get_stream_download(title, quality=quality, year=year, season=season, episode=episode, is_tv=is_tv)
+    return download.get("url") if download else None
\ No newline at end of file
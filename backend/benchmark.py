@@ -0,0 +1,241 @@
+"""
+benchmark.py – End-to-end latency benchmark for the FastAPI backend against the offline H5 stub.
+
+Starts h5_stub_server.py and main.py (pointed at the stub via H5_API_BASE), replays the
+request pattern Player.tsx issues when a title is opened, and reports p50/p95/p99 latency
+per endpoint plus upstream H5 calls per open, for each scenario.
+
+Usage:
+    python benchmark.py                       # all scenarios, default settings
+    python benchmark.py -s warm_movie -n 50 --latency 0.12 --error-rate 0.05
+    python benchmark.py --json results.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class _Server:
+    """A uvicorn subprocess we can wait on and stop."""
+
+    def __init__(self, args: list[str], port: int, health_path: str, env: dict | None = None):
+        self.args = args
+        self.port = port
+        self.health_path = health_path
+        self.env = {**os.environ, **(env or {})}
+        self.proc: subprocess.Popen | None = None
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self, timeout: float = 20.0):
+        self.proc = subprocess.Popen(
+            [sys.executable, *self.args], cwd=BACKEND_DIR, env=self.env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                try:
+                    resp = await client.get(self.base + self.health_path, timeout=1.0)
+                    if resp.status_code < 500:
+                        return
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.1)
+        self.stop()
+        raise RuntimeError(f"server {' '.join(self.args)} did not come up on port {self.port}")
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.proc = None
+
+
+def player_requests(title: str, year: int | None, season: int, episode: int, is_tv: bool) -> dict[str, tuple[str, dict]]:
+    """The requests Player.tsx fires in parallel when a title is opened."""
+    params = {"title": title, "is_tv": str(is_tv).lower(), "season": season, "episode": episode}
+    if year:
+        params["year"] = year
+    return {
+        "stream": ("/api/stream", params),
+        "stream_check": ("/api/stream/check", params),
+        "qualities": ("/api/qualities", params),
+        "subtitles": ("/api/subtitles", params),
+        "downloads": ("/api/downloads", params),
+        "metadata": ("/api/metadata", {"title": title, **({"year": year} if year else {})}),
+    }
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.stub = _Server(
+            ["h5_stub_server.py", "--port", str(args.stub_port), "--latency", str(args.latency),
+             "--jitter", str(args.jitter), "--error-rate", str(args.error_rate)],
+            args.stub_port, "/__stats",
+        )
+        self.backend = _Server(
+            ["-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+            args.port, "/health",
+            env={"H5_API_BASE": f"http://127.0.0.1:{args.stub_port}/wefeed-h5api-bff", "H5_TOKEN_FILE": ""},
+        )
+        self.client = httpx.AsyncClient(timeout=60.0, follow_redirects=False)
+
+    async def upstream_calls(self) -> int:
+        resp = await self.client.get(self.stub.base + "/__stats")
+        return resp.json()["total"]
+
+    async def open_title(self, samples: dict, title: str, year=None, season=1, episode=1, is_tv=False, track_upstream=True):
+        """One player open: all requests in parallel. Records per-endpoint and total latency."""
+        async def timed(name, path, params):
+            start = time.perf_counter()
+            try:
+                resp = await self.client.get(self.backend.base + path, params=params)
+                ok = resp.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            samples.setdefault(name, []).append(time.perf_counter() - start)
+            if not ok:
+                samples.setdefault("_errors", []).append(1.0)
+
+        if track_upstream:
+            await self.client.post(self.stub.base + "/__reset")
+        start = time.perf_counter()
+        await asyncio.gather(*(timed(n, p, q) for n, (p, q) in player_requests(title, year, season, episode, is_tv).items()))
+        samples.setdefault("open_total", []).append(time.perf_counter() - start)
+        if track_upstream:
+            samples.setdefault("_upstream_calls", []).append(float(await self.upstream_calls()))
+
+    async def restart_backend(self):
+        self.backend.stop()
+        await self.backend.start()
+
+    # --- scenarios -------------------------------------------------------
+
+    async def scenario_cold_movie(self, samples):
+        """Fresh backend per open: nothing cached, token bootstrap included."""
+        for _ in range(self.args.iterations):
+            await self.restart_backend()
+            await self.open_title(samples, "Avatar", 2009)
+
+    async def scenario_warm_movie(self, samples):
+        """Same title opened repeatedly on one backend."""
+        await self.restart_backend()
+        await self.open_title({}, "Avatar", 2009)
+        for _ in range(self.args.iterations):
+            await self.open_title(samples, "Avatar", 2009)
+
+    async def scenario_fallback_title(self, samples):
+        """Title that only matches on the pre-colon search and only has /subject/play streams."""
+        for _ in range(self.args.iterations):
+            await self.restart_backend()
+            await self.open_title(samples, "Spider-Man: No Way Home", 2021)
+
+    async def scenario_binge_tv(self, samples):
+        """Consecutive episodes of one show on one backend."""
+        await self.restart_backend()
+        for ep in range(1, self.args.iterations + 1):
+            season, episode = 1 + (ep - 1) // 7, 1 + (ep - 1) % 7
+            await self.open_title(samples, "Breaking Bad", 2008, season, episode, is_tv=True)
+
+    async def scenario_concurrent_viewers(self, samples):
+        """Several viewers opening the same episode at the same moment (Watch Together)."""
+        for _ in range(self.args.iterations):
+            await self.restart_backend()
+            await self.client.post(self.stub.base + "/__reset")
+            await asyncio.gather(*(
+                self.open_title(samples, "Stranger Things", 2016, 1, 1, is_tv=True, track_upstream=False)
+                for _ in range(self.args.viewers)
+            ))
+            samples.setdefault("_upstream_calls", []).append(float(await self.upstream_calls()))
+
+    SCENARIOS = ["cold_movie", "warm_movie", "fallback_title", "binge_tv", "concurrent_viewers"]
+
+    async def run(self) -> dict:
+        results = {}
+        await self.stub.start()
+        try:
+            for name in self.args.scenarios or self.SCENARIOS:
+                samples: dict = {}
+                await getattr(self, f"scenario_{name}")(samples)
+                results[name] = summarize(samples)
+                print_report(name, results[name])
+        finally:
+            self.backend.stop()
+            self.stub.stop()
+            await self.client.aclose()
+        return results
+
+
+def summarize(samples: dict) -> dict:
+    upstream = samples.pop("_upstream_calls", [])
+    errors = len(samples.pop("_errors", []))
+    summary = {
+        name: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+        }
+        for name, values in samples.items()
+    }
+    return {
+        "latency": summary,
+        "errors": errors,
+        "upstream_calls_per_open": round(sum(upstream) / len(upstream), 2) if upstream else 0.0,
+    }
+
+
+def print_report(name: str, result: dict):
+    print(f"\n== {name} ==  upstream calls/open: {result['upstream_calls_per_open']}  errors: {result['errors']}")
+    print(f"  {'endpoint':<14}{'n':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, stats in result["latency"].items():
+        print(f"  {endpoint:<14}{stats['count']:>5}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend latency benchmark against the offline H5 stub")
+    parser.add_argument("-s", "--scenario", dest="scenarios", action="append", choices=Benchmark.SCENARIOS)
+    parser.add_argument("-n", "--iterations", type=int, default=10)
+    parser.add_argument("--viewers", type=int, default=5, help="viewers for concurrent_viewers")
+    parser.add_argument("--latency", type=float, default=0.08, help="stub latency per H5 call (seconds)")
+    parser.add_argument("--jitter", type=float, default=0.04)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--stub-port", type=int, default=8765)
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(Benchmark(args).run())
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
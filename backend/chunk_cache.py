@@ -0,0 +1,368 @@
+"""
+chunk_cache.py – Range-aware on-disk cache of upstream video bytes.
+
+For LAN / home-server use, where the same episodes are streamed to several
+devices: each upstream file is stored as one sparse file under
+CHUNK_CACHE_DIR, filled in fixed-size chunks (CHUNK_SIZE) as they are first
+requested. A Range request is served from the chunks already on disk; only
+the missing ones are fetched, coalesced into one upstream request per
+contiguous run, with a few chunks of read-ahead. Concurrent requests for the
+same missing chunk share the fetch.
+
+Files are keyed by the upstream resource_id (falling back to the CDN path),
+so re-signed URLs for the same file hit the same cache entry. Whole files are
+evicted least-recently-used once the cache exceeds CHUNK_CACHE_BYTES.
+
+Disk bookkeeping stays off the event loop: the directory is scanned on first
+use rather than at import, eviction deletes files in a thread, and the JSON
+sidecar listing a file's cached chunks is rewritten at most every
+META_FLUSH_DELAY seconds rather than once per chunk.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+import httpx
+
+from segmented_fetch import parse_content_range
+from stream_url_cache import source_identity
+
+CHUNK_CACHE_DIR = os.environ.get("CHUNK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "movienight-chunks"))
+CHUNK_CACHE_BYTES = int(os.environ.get("CHUNK_CACHE_BYTES", str(50 * 1024 ** 3)))
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", str(2 * 1024 * 1024)))
+CHUNK_READAHEAD = int(os.environ.get("CHUNK_READAHEAD", "4"))  # chunks fetched ahead of the reader
+RESOURCE_MAP_SIZE = 4096
+EVICT_MIN_IDLE = 60  # seconds; don't evict a file that was just opened for playback
+META_FLUSH_DELAY = 2.0  # seconds; chunk sidecar writes are batched over this window
+
+
+def _write_at(path: str, offset: int, data: bytes):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def _read_at(path: str, offset: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _create_sparse(path: str, size: int):
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+
+def _write_json(path: str, data: dict):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+class ChunkEntry:
+    def __init__(self, key: str, root: str, chunk_size: int, file_size: int | None = None, present=None, last_access: float | None = None):
+        self.key = key
+        self.path = os.path.join(root, f"{key}.bin")
+        self.meta_path = os.path.join(root, f"{key}.json")
+        self.chunk_size = chunk_size
+        self.file_size = file_size
+        self.present: set[int] = set(present or ())
+        self.last_access = last_access or time.time()
+        self.readers = 0
+        self.fetching = 0
+
+    @property
+    def chunk_count(self) -> int:
+        return -(-self.file_size // self.chunk_size) if self.file_size else 0
+
+    def chunk_len(self, idx: int) -> int:
+        return min(self.chunk_size, self.file_size - idx * self.chunk_size)
+
+    @property
+    def bytes(self) -> int:
+        return sum(self.chunk_len(i) for i in self.present) if self.file_size else 0
+
+    @property
+    def busy(self) -> bool:
+        return bool(self.readers or self.fetching)
+
+    def touch(self):
+        self.last_access = time.time()
+
+
+class ChunkFetchError(Exception):
+    pass
+
+
+class ChunkCache:
+    def __init__(
+        self,
+        client_factory,
+        headers: dict,
+        root: str = CHUNK_CACHE_DIR,
+        max_bytes: int = CHUNK_CACHE_BYTES,
+        chunk_size: int = CHUNK_SIZE,
+        readahead: int = CHUNK_READAHEAD,
+    ):
+        self._client_factory = client_factory
+        self._headers = headers
+        self.root = root
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.entries: dict[str, ChunkEntry] = {}
+        self._resources: OrderedDict[str, str] = OrderedDict()  # source identity -> cache key
+        self._inflight: dict[tuple, asyncio.Future] = {}  # (key, chunk) -> future(ok: bool)
+        self.counters = {"chunk_hits": 0, "chunk_fetches": 0, "upstream_requests": 0, "bytes_from_disk": 0, "bytes_from_upstream": 0, "errors": 0, "evictions": 0, "meta_writes": 0}
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._dirty: set[str] = set()  # keys whose sidecar is out of date
+        self._flush_task: asyncio.Task | None = None
+        self._disk_lock = asyncio.Lock()  # orders sidecar writes against evictions
+
+    # --- persistence -----------------------------------------------------
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            for entry in await asyncio.to_thread(self._scan):
+                self.entries.setdefault(entry.key, entry)
+            self._loaded = True
+        await self._enforce_budget()
+
+    def _scan(self) -> list[ChunkEntry]:
+        """Files cached by a previous process (blocking; runs in a thread)."""
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-5]
+            try:
+                with open(os.path.join(self.root, name), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                entry = ChunkEntry(key, self.root, meta["chunk_size"], meta["file_size"], meta["chunks"], meta.get("last_access"))
+                if entry.chunk_size != self.chunk_size or not os.path.exists(entry.path):
+                    self._remove_files(entry)
+                    continue
+            except (OSError, ValueError, KeyError):
+                continue
+            found.append(entry)
+        return found
+
+    def _mark_dirty(self, entry: ChunkEntry):
+        self._dirty.add(entry.key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(META_FLUSH_DELAY)
+        await self.flush()
+
+    async def flush(self):
+        """Write the sidecars of entries whose chunk set changed since the last flush."""
+        async with self._disk_lock:
+            keys, self._dirty = self._dirty, set()
+            pending = [
+                (entry.meta_path, {"chunk_size": entry.chunk_size, "file_size": entry.file_size, "chunks": sorted(entry.present), "last_access": entry.last_access})
+                for entry in (self.entries.get(key) for key in keys) if entry is not None
+            ]
+            if pending:
+                await asyncio.to_thread(self._write_metas, pending)
+                self.counters["meta_writes"] += len(pending)
+
+    @staticmethod
+    def _write_metas(pending: list[tuple[str, dict]]):
+        for path, meta in pending:
+            try:
+                _write_json(path, meta)
+            except OSError as e:
+                print(f"DEBUG: Chunk cache meta write failed: {e}")
+
+    @staticmethod
+    def _remove_files(entry: ChunkEntry):
+        for path in (entry.path, entry.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+
+    # --- public API ------------------------------------------------------
+
+    def register(self, downloads: list):
+        """Note the resource_id behind each CDN URL so re-signed URLs share one cache entry."""
+        for d in downloads or []:
+            url, resource_id = d.get("url"), d.get("resource_id")
+            if not url or not resource_id:
+                continue
+            ident = source_identity(url)
+            self._resources[ident] = hashlib.sha256(f"id:{resource_id}".encode("utf-8")).hexdigest()[:24]
+            self._resources.move_to_end(ident)
+            while len(self._resources) > RESOURCE_MAP_SIZE:
+                self._resources.popitem(last=False)
+
+    def key_for(self, url: str) -> str:
+        ident = source_identity(url)
+        return self._resources.get(ident) or hashlib.sha256(f"url:{ident}".encode("utf-8")).hexdigest()[:24]
+
+    async def open(self, url: str, start: int = 0) -> ChunkEntry:
+        """Cache entry for `url` with its file size known (fetching the chunk at `start` if needed)."""
+        await self._ensure_loaded()
+        key = self.key_for(url)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = ChunkEntry(key, self.root, self.chunk_size)
+        entry.touch()
+        if entry.file_size is None:
+            # The first run's Content-Range tells us the size
+            idx = start // self.chunk_size
+            await self._await_chunk(entry, url, idx, idx + self.readahead)
+        return entry
+
+    async def read(self, entry: ChunkEntry, url: str, start: int, end: int):
+        """Yield bytes [start, end] of the file, from disk where cached, else from upstream."""
+        entry.readers += 1
+        try:
+            last = min(end // self.chunk_size, entry.chunk_count - 1)
+            for idx in range(start // self.chunk_size, last + 1):
+                if idx in entry.present:
+                    self.counters["chunk_hits"] += 1
+                    # Keep upcoming chunks arriving while cached ones are served
+                    self._ensure_fetching(entry, url, idx + 1, min(last, idx + self.readahead))
+                else:
+                    await self._await_chunk(entry, url, idx, min(last, idx + self.readahead))
+                lo = max(start, idx * self.chunk_size)
+                hi = min(end, (idx + 1) * self.chunk_size - 1)
+                data = await asyncio.to_thread(_read_at, entry.path, lo, hi - lo + 1)
+                if len(data) != hi - lo + 1:
+                    raise ChunkFetchError(f"short read from cache file {entry.key}")
+                self.counters["bytes_from_disk"] += len(data)
+                entry.touch()
+                yield data
+        finally:
+            entry.readers -= 1
+
+    # --- fetching --------------------------------------------------------
+
+    async def _await_chunk(self, entry: ChunkEntry, url: str, idx: int, last: int):
+        self._ensure_fetching(entry, url, idx, last)
+        if idx in entry.present:
+            return
+        ok = await asyncio.shield(self._inflight[(entry.key, idx)])
+        if not ok:
+            raise ChunkFetchError(f"upstream fetch failed for chunk {idx} of {entry.key}")
+
+    def _ensure_fetching(self, entry: ChunkEntry, url: str, first: int, last: int):
+        """Start upstream runs for chunks in [first, last] that are neither cached nor in flight."""
+        run_start = None
+        for idx in range(first, last + 2):
+            missing = idx <= last and idx not in entry.present and (entry.key, idx) not in self._inflight
+            if missing and run_start is None:
+                run_start = idx
+            elif not missing and run_start is not None:
+                self._start_run(entry, url, run_start, idx - 1)
+                run_start = None
+
+    def _start_run(self, entry: ChunkEntry, url: str, first: int, last: int):
+        loop = asyncio.get_running_loop()
+        for idx in range(first, last + 1):
+            self._inflight[(entry.key, idx)] = loop.create_future()
+        entry.fetching += 1
+        asyncio.create_task(self._fetch_run(entry, url, first, last))
+
+    async def _fetch_run(self, entry: ChunkEntry, url: str, first: int, last: int):
+        idx, registered = first, last
+        try:
+            self.counters["upstream_requests"] += 1
+            byte_range = f"bytes={first * self.chunk_size}-{(last + 1) * self.chunk_size - 1}"
+            async with self._client_factory().stream("GET", url, headers={**self._headers, "Range": byte_range}) as resp:
+                content_range = parse_content_range(resp.headers.get("Content-Range"))
+                if resp.status_code != 206 or content_range is None or content_range[0] != first * self.chunk_size:
+                    raise ChunkFetchError(f"unexpected upstream response {resp.status_code} {resp.headers.get('Content-Range')}")
+                if entry.file_size is None:
+                    if content_range[2] is None:
+                        raise ChunkFetchError("upstream did not report the file size")
+                    os.makedirs(self.root, exist_ok=True)
+                    await asyncio.to_thread(_create_sparse, entry.path, content_range[2])
+                    entry.file_size = content_range[2]
+                last = min(last, entry.chunk_count - 1)
+                buf = bytearray()
+                async for data in resp.aiter_bytes():
+                    buf.extend(data)
+                    self.counters["bytes_from_upstream"] += len(data)
+                    while idx <= last and len(buf) >= entry.chunk_len(idx):
+                        size = entry.chunk_len(idx)
+                        await asyncio.to_thread(_write_at, entry.path, idx * self.chunk_size, bytes(buf[:size]))
+                        del buf[:size]
+                        self._complete(entry, idx, True)
+                        idx += 1
+                    if idx > last:
+                        break
+            if idx <= last:
+                raise ChunkFetchError("upstream ended early")
+        except (httpx.HTTPError, OSError, ChunkFetchError) as e:
+            print(f"DEBUG: Chunk cache fetch failed for {url[:80]} chunks {idx}-{last}: {e}")
+            self.counters["errors"] += 1
+        finally:
+            entry.fetching -= 1
+            # Anything not delivered (failure, or chunks past the end of the file) is released
+            for rest in range(idx, registered + 1):
+                self._complete(entry, rest, False)
+            await self._enforce_budget()
+
+    def _complete(self, entry: ChunkEntry, idx: int, ok: bool):
+        if ok:
+            entry.present.add(idx)
+            self.counters["chunk_fetches"] += 1
+            self._mark_dirty(entry)
+        future = self._inflight.pop((entry.key, idx), None)
+        if future is not None and not future.done():
+            future.set_result(ok)
+
+    # --- eviction --------------------------------------------------------
+
+    async def _enforce_budget(self):
+        total = sum(e.bytes for e in self.entries.values())
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for entry in sorted(self.entries.values(), key=lambda e: e.last_access):
+            if total <= self.max_bytes:
+                break
+            if entry.busy or time.time() - entry.last_access < EVICT_MIN_IDLE:
+                continue
+            total -= entry.bytes
+            del self.entries[entry.key]
+            self._dirty.discard(entry.key)
+            victims.append(entry)
+            self.counters["evictions"] += 1
+            print(f"DEBUG: Evicted chunk cache entry {entry.key} ({entry.file_size} bytes)")
+        if victims:
+            async with self._disk_lock:
+                for entry in victims:
+                    await asyncio.to_thread(self._remove_files, entry)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "entries": len(self.entries),
+            "bytes": sum(e.bytes for e in self.entries.values()),
+            "max_bytes": self.max_bytes,
+            "chunk_size": self.chunk_size,
+            "inflight_chunks": len(self._inflight),
+            "dirty_metas": len(self._dirty),
+        }
@@ -0,0 +1,117 @@
+"""
+codec_probe.py – Per-resource video codec resolution for transcode decisions.
+
+Order of evidence: the upstream `codecName` reported with each download, then
+a ranged read of the file's `moov`/`stsd` box (exact codec, profile and bit
+depth), and only if both are unavailable the old URL substring heuristic.
+Results are cached per resource_id; concurrent probes for the same resource
+share one request. The moov read is capped at CODEC_PROBE_MOOV_BYTES: stsd
+sits near the start of the video trak, so a moov-at-end file doesn't have to
+download its whole sample table before the first redirect.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+
+from mp4_probe import fetch_moov, parse_video_codec
+from stream_url_cache import source_identity
+
+CODEC_CACHE_SIZE = int(os.environ.get("CODEC_CACHE_SIZE", "4096"))
+CODEC_PROBE_MOOV_BYTES = int(os.environ.get("CODEC_PROBE_MOOV_BYTES", str(256 * 1024)))
+
+_CODEC_ALIASES = {
+    "hevc": "hevc", "h265": "hevc", "h.265": "hevc", "x265": "hevc", "hvc1": "hevc", "hev1": "hevc",
+    "h264": "h264", "h.264": "h264", "avc": "h264", "avc1": "h264", "x264": "h264",
+    "av1": "av1", "av01": "av1",
+    "vp9": "vp9", "vp09": "vp9",
+}
+
+
+def normalize_codec(name: str | None) -> str:
+    """'H.265' / 'hvc1' / 'HEVC Main 10' -> 'hevc'; '' when unknown."""
+    if not name:
+        return ""
+    lowered = name.strip().lower()
+    if lowered in _CODEC_ALIASES:
+        return _CODEC_ALIASES[lowered]
+    for alias, codec in _CODEC_ALIASES.items():
+        if alias in lowered:
+            return codec
+    return lowered
+
+
+def sniff_url_codec(url: str) -> str:
+    url_lower = url.lower()
+    return "hevc" if ("h265" in url_lower or "hevc" in url_lower) else ""
+
+
+class CodecResolver:
+    def __init__(self, client_factory, headers: dict, max_entries: int = CODEC_CACHE_SIZE):
+        self._client_factory = client_factory
+        self._headers = headers
+        self._max_entries = max_entries
+        self._codecs: OrderedDict[str, dict] = OrderedDict()  # resource key -> codec info
+        self._resources: OrderedDict[str, str] = OrderedDict()  # source identity -> resource key
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.counters = {"upstream": 0, "probed": 0, "probe_failed": 0, "hits": 0}
+
+    @staticmethod
+    def _key(resource_id: str | None, url: str) -> str:
+        return f"id:{resource_id}" if resource_id else f"url:{source_identity(url)}"
+
+    def _remember(self, store: OrderedDict, key: str, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self._max_entries:
+            store.popitem(last=False)
+
+    def register(self, downloads: list):
+        """Note which resource each CDN URL belongs to, and any codec upstream already reported."""
+        for d in downloads or []:
+            url = d.get("url")
+            if not url:
+                continue
+            key = self._key(d.get("resource_id"), url)
+            self._remember(self._resources, source_identity(url), key)
+            codec = normalize_codec(d.get("codec"))
+            if codec and key not in self._codecs:
+                self.counters["upstream"] += 1
+                self._remember(self._codecs, key, {"codec": codec, "source": "upstream", "codec_name": d.get("codec")})
+
+    async def resolve(self, url: str) -> dict:
+        """Codec info for the file behind `url`: {"codec": "hevc"|"h264"|..., "source": ...}."""
+        key = self._resources.get(source_identity(url)) or self._key(None, url)
+        info = self._codecs.get(key)
+        if info is not None:
+            self._codecs.move_to_end(key)
+            self.counters["hits"] += 1
+            return info
+
+        task = self._inflight.get(key)
+        loop = asyncio.get_running_loop()
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(self._probe(key, url))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._inflight.get(key) is t and self._inflight.pop(key))
+        return await asyncio.shield(task)
+
+    async def _probe(self, key: str, url: str) -> dict:
+        try:
+            moov = await fetch_moov(self._client_factory(), url, self._headers, max_moov_bytes=CODEC_PROBE_MOOV_BYTES)
+            details = parse_video_codec(moov.data) if moov else None
+        except Exception as e:
+            # Any probe failure (HTTP, invalid URL, malformed boxes) falls back to the URL heuristic
+            print(f"DEBUG: Codec probe failed for {url[:80]}: {e}")
+            details = None
+        if details:
+            self.counters["probed"] += 1
+            info = {"source": "probe", **details}
+            self._remember(self._codecs, key, info)
+            return info
+        # Don't cache the heuristic: a later probe may succeed
+        self.counters["probe_failed"] += 1
+        return {"codec": sniff_url_codec(url), "source": "url"}
+
+    def stats(self) -> dict:
+        return {**self.counters, "entries": len(self._codecs), "inflight": len(self._inflight)}
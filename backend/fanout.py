@@ -0,0 +1,233 @@
+"""
+fanout.py – One upstream reader shared by every viewer of the same byte stream.
+
+Watch Together rooms put several viewers on the same title at the same time.
+Proxied byte streams are keyed by resource and start offset: the first
+request starts a SharedFeed that reads upstream into a bounded ring buffer,
+and later requests for the same resource whose start falls inside the
+buffered window (or just ahead of it) attach with their own cursor instead of
+opening another upstream connection.
+
+The feed reads ahead only as far as its slowest subscriber allows. A
+subscriber that keeps a caught-up subscriber waiting for longer than
+FANOUT_SLOW_READER_GRACE is dropped (its response ends and the player
+re-requests from where it is), so one stalled viewer can't freeze the room.
+"""
+
+import asyncio
+import itertools
+import os
+import time
+
+FANOUT_BUFFER_BYTES = int(os.environ.get("FANOUT_BUFFER_BYTES", str(16 * 1024 * 1024)))
+FANOUT_SLOW_READER_GRACE = float(os.environ.get("FANOUT_SLOW_READER_GRACE", "5"))
+FANOUT_LINGER = float(os.environ.get("FANOUT_LINGER", "3"))  # keep an unsubscribed feed for the next range request
+FANOUT_JOIN_AHEAD = 1024 * 1024  # join a feed whose head is at most this far behind the requested start
+FANOUT_CHUNK = 65536
+
+
+class SharedFeed:
+    """Bounded buffer over upstream bytes [start, end] with one cursor per subscriber."""
+
+    def __init__(self, hub: "FanoutHub", key: str, start: int, end: int, producer):
+        self.hub = hub
+        self.key = key
+        self.start = start
+        self.end = end  # inclusive
+        self.low = start  # absolute offset of buf[0]
+        self.buf = bytearray()
+        self.cursors: dict[int, int] = {}  # subscriber id -> next absolute offset
+        self.cond = asyncio.Condition()
+        self.eof = False
+        self.error: Exception | None = None
+        self.created = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.joined = 0
+        self.evicted = 0
+        self.linger_task: asyncio.Task | None = None
+        self.task = asyncio.create_task(self._produce(producer))
+
+    @property
+    def high(self) -> int:
+        return self.low + len(self.buf)
+
+    def can_serve(self, start: int, end: int) -> bool:
+        if self.error is not None or end > self.end:
+            return False
+        if self.eof:
+            return self.low <= start < self.high
+        return self.low <= start <= self.high + FANOUT_JOIN_AHEAD
+
+    def _backlog(self) -> int:
+        """Unread bytes held for the slowest subscriber (the whole buffer when nobody is subscribed)."""
+        return self.high - min(self.cursors.values(), default=self.low)
+
+    def _trim(self):
+        # Keep recent history for late joiners, but never drop bytes a subscriber hasn't read
+        excess = len(self.buf) - self.hub.capacity
+        if excess > 0:
+            drop = min(excess, min(self.cursors.values(), default=self.high) - self.low)
+            if drop > 0:
+                del self.buf[:drop]
+                self.low += drop
+
+    def _evict_slow(self) -> bool:
+        """Drop the subscribers furthest behind if they are holding back one that has caught up."""
+        if not self.cursors or max(self.cursors.values()) < self.high:
+            return False
+        slowest = min(self.cursors.values())
+        if slowest >= self.high:
+            return False
+        for sid, pos in list(self.cursors.items()):
+            if pos == slowest:
+                del self.cursors[sid]
+                self.evicted += 1
+                self.hub.counters["evicted"] += 1
+        return True
+
+    async def _produce(self, producer):
+        try:
+            async for chunk in producer(self.start, self.end):
+                async with self.cond:
+                    while self._backlog() >= self.hub.capacity:
+                        try:
+                            await asyncio.wait_for(
+                                self.cond.wait_for(lambda: self._backlog() < self.hub.capacity),
+                                timeout=FANOUT_SLOW_READER_GRACE,
+                            )
+                        except asyncio.TimeoutError:
+                            if self._evict_slow():
+                                print(f"DEBUG: Fan-out dropped a slow reader from {self.key[:80]}")
+                                self._trim()
+                                self.cond.notify_all()
+                    self.buf.extend(chunk)
+                    self.bytes_in += len(chunk)
+                    self._trim()
+                    self.cond.notify_all()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"DEBUG: Fan-out upstream error for {self.key[:80]}: {e}")
+            self.error = e
+        finally:
+            self.eof = True
+            # notify_all needs the lock; don't block cancellation on it
+            asyncio.get_running_loop().create_task(self._wake_all())
+
+    async def _wake_all(self):
+        async with self.cond:
+            self.cond.notify_all()
+
+    async def read(self, sid: int, end: int):
+        """Yield this subscriber's bytes up to `end` (inclusive)."""
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(lambda: sid not in self.cursors or self.cursors[sid] < self.high or self.eof)
+                if sid not in self.cursors:
+                    return  # evicted as a slow reader
+                pos = self.cursors[sid]
+                if pos >= self.high:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                stop = min(self.high, end + 1, pos + FANOUT_CHUNK)
+                data = bytes(self.buf[pos - self.low:stop - self.low])
+                self.cursors[sid] = stop
+                self._trim()
+                self.cond.notify_all()
+            self.bytes_out += len(data)
+            yield data
+            if stop > end:
+                return
+
+
+class FanoutHub:
+    """Registry of shared feeds, keyed by resource; see module docstring."""
+
+    def __init__(self, capacity: int = FANOUT_BUFFER_BYTES, linger: float = FANOUT_LINGER):
+        self.capacity = capacity
+        self.linger = linger
+        self.feeds: dict[str, list[SharedFeed]] = {}
+        self._ids = itertools.count(1)
+        self.counters = {"feeds": 0, "joined": 0, "evicted": 0}
+
+    async def stream(self, key: str, start: int, end: int, producer):
+        """Bytes [start, end] of resource `key`, shared with any feed that already covers them.
+
+        `producer(start, end)` must return an async iterator of upstream bytes; it is only
+        called when no existing feed can serve the request.
+        """
+        # Lookup and registration happen on first iteration, with no await in between,
+        # so a response that is never sent doesn't pin a feed
+        feed = next((f for f in self.feeds.get(key, ()) if f.can_serve(start, end)), None)
+        if feed is None:
+            feed = SharedFeed(self, key, start, end, producer)
+            self.feeds.setdefault(key, []).append(feed)
+            self.counters["feeds"] += 1
+        else:
+            feed.joined += 1
+            self.counters["joined"] += 1
+        if feed.linger_task is not None:
+            feed.linger_task.cancel()
+            feed.linger_task = None
+        sid = next(self._ids)
+        feed.cursors[sid] = start
+        try:
+            async for data in feed.read(sid, end):
+                yield data
+        finally:
+            self._unsubscribe(feed, sid)
+
+    def _unsubscribe(self, feed: SharedFeed, sid: int):
+        # Synchronous: runs in the response's finally, possibly during cancellation
+        if sid in feed.cursors:
+            del feed.cursors[sid]
+            # Let a producer blocked on this reader's backlog move on
+            asyncio.get_running_loop().create_task(feed._wake_all())
+        if not feed.cursors and feed.linger_task is None:
+            feed.linger_task = asyncio.create_task(self._drop_later(feed))
+
+    async def _drop_later(self, feed: SharedFeed):
+        try:
+            await asyncio.sleep(self.linger)
+        except asyncio.CancelledError:
+            return
+        if feed.cursors:
+            return
+        feeds = self.feeds.get(feed.key, [])
+        if feed in feeds:
+            feeds.remove(feed)
+        if not feeds:
+            self.feeds.pop(feed.key, None)
+        feed.task.cancel()
+        await asyncio.gather(feed.task, return_exceptions=True)
+
+    async def close(self):
+        for feeds in list(self.feeds.values()):
+            for feed in feeds:
+                if feed.linger_task is not None:
+                    feed.linger_task.cancel()
+                feed.task.cancel()
+                await asyncio.gather(feed.task, return_exceptions=True)
+        self.feeds.clear()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "buffer_bytes": self.capacity,
+            "active": [
+                {
+                    "key": f.key[:80],
+                    "subscribers": len(f.cursors),
+                    "window": [f.low, f.high],
+                    "bytes_in": f.bytes_in,
+                    "bytes_out": f.bytes_out,
+                    "joined": f.joined,
+                    "evicted": f.evicted,
+                    "finished": f.eof,
+                }
+                for feeds in self.feeds.values()
+                for f in feeds
+            ],
+        }
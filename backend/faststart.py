@@ -0,0 +1,191 @@
+"""
+faststart.py – Virtual "faststart" view of MP4s whose moov sits after mdat.
+
+The moov box is fetched once, its chunk offset tables (stco/co64) are rewritten
+for a layout with moov ahead of mdat, and client byte ranges of that virtual
+file are served on the fly: moov (and the small header before mdat) from
+memory, everything else from matching upstream ranges. Nothing is re-encoded
+and nothing beyond moov is stored. Total size is unchanged, since boxes are
+only moved.
+"""
+
+import asyncio
+import os
+import struct
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import httpx
+
+from mp4_probe import child_box, child_path, fetch_moov, iter_boxes, read_range
+from stream_url_cache import source_identity
+
+FASTSTART_CACHE_BYTES = int(os.environ.get("FASTSTART_CACHE_BYTES", str(64 * 1024 * 1024)))
+FASTSTART_CACHE_ENTRIES = 4096
+MAX_HEAD_BYTES = 64 * 1024
+
+
+@dataclass
+class FaststartLayout:
+    file_size: int
+    # (virtual_start, length, upstream_start or None for bytes served from `memory`)
+    segments: list
+    memory: dict  # virtual_start -> bytes for in-memory segments
+
+    @property
+    def size(self) -> int:
+        return sum(len(b) for b in self.memory.values())
+
+    def upstream_ranges(self, start: int, end: int):
+        """Yield ("memory", bytes) or ("upstream", (u_start, u_end)) pieces covering virtual [start, end]."""
+        for v_start, length, u_start in self.segments:
+            v_end = v_start + length - 1
+            if v_end < start or v_start > end:
+                continue
+            lo, hi = max(start, v_start), min(end, v_end)
+            if u_start is None:
+                data = self.memory[v_start]
+                yield "memory", data[lo - v_start:hi - v_start + 1]
+            else:
+                yield "upstream", (u_start + lo - v_start, u_start + hi - v_start)
+
+
+def rewrite_chunk_offsets(moov: bytes, shift_from: int, shift_to: int, delta: int) -> bytes | None:
+    """Add `delta` to every chunk offset in [shift_from, shift_to) across all tracks.
+
+    Returns None if a 32-bit stco entry would overflow (would need a co64 upgrade).
+    """
+    out = bytearray(moov)
+    top = next(iter_boxes(moov), None)
+    if top is None or top[0] != "moov":
+        return None
+    for box_type, _, payload, end in iter_boxes(moov, top[2], top[3]):
+        if box_type != "trak":
+            continue
+        stbl = child_path(moov, payload, end, ("mdia", "minf", "stbl"))
+        if stbl is None:
+            continue
+        for name, fmt, width in (("stco", ">I", 4), ("co64", ">Q", 8)):
+            table = child_box(moov, stbl[1], stbl[2], name)
+            if table is None:
+                continue
+            count = struct.unpack_from(">I", moov, table[1] + 4)[0]
+            pos = table[1] + 8
+            for i in range(count):
+                at = pos + i * width
+                value = struct.unpack_from(fmt, out, at)[0]
+                if shift_from <= value < shift_to:
+                    value += delta
+                    if width == 4 and value > 0xFFFFFFFF:
+                        return None
+                    struct.pack_into(fmt, out, at, value)
+    return bytes(out)
+
+
+async def build_layout(client: httpx.AsyncClient, url: str, headers: dict) -> FaststartLayout | None:
+    """Layout for a moov-after-mdat file, or None when the file is already faststart (or unsupported)."""
+    moov = await fetch_moov(client, url, headers)
+    if moov is None or not moov.complete or not moov.file_size:
+        return None
+    first_mdat = next((off for t, off, _ in moov.top_level if t == "mdat"), None)
+    if first_mdat is None or first_mdat > moov.offset:
+        return None  # moov already precedes the media data
+    if first_mdat > MAX_HEAD_BYTES:
+        return None
+    moov_end = moov.offset + moov.size
+    # Media between the first mdat and moov moves forward by the size of moov
+    rewritten = rewrite_chunk_offsets(moov.data, first_mdat, moov.offset, moov.size)
+    if rewritten is None:
+        return None
+    head = b""
+    if first_mdat:
+        head, _ = await read_range(client, url, headers, 0, first_mdat)
+        if len(head) != first_mdat:
+            return None
+    segments, memory = [], {}
+    if head:
+        segments.append((0, len(head), None))
+        memory[0] = head
+    segments.append((first_mdat, moov.size, None))
+    memory[first_mdat] = rewritten
+    segments.append((first_mdat + moov.size, moov.offset - first_mdat, first_mdat))
+    if moov_end < moov.file_size:
+        segments.append((moov_end, moov.file_size - moov_end, moov_end))
+    return FaststartLayout(file_size=moov.file_size, segments=segments, memory=memory)
+
+
+async def stream_virtual_range(layout: FaststartLayout, client: httpx.AsyncClient, url: str, headers: dict, start: int, end: int):
+    """Yield bytes [start, end] of the virtual faststart file."""
+    for kind, piece in layout.upstream_ranges(start, end):
+        if kind == "memory":
+            yield piece
+            continue
+        u_start, u_end = piece
+        async with client.stream("GET", url, headers={**headers, "Range": f"bytes={u_start}-{u_end}"}) as resp:
+            if resp.status_code != 206:
+                raise httpx.HTTPStatusError(f"expected 206, got {resp.status_code}", request=resp.request, response=resp)
+            async for chunk in resp.aiter_bytes():
+                yield chunk
+
+
+class FaststartCache:
+    """Byte-bounded LRU of faststart layouts per resource (None cached for files that don't need one)."""
+
+    def __init__(self, client_factory, headers: dict, max_bytes: int = FASTSTART_CACHE_BYTES):
+        self._client_factory = client_factory
+        self._headers = headers
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, FaststartLayout | None] = OrderedDict()
+        self._bytes = 0
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.builds = 0
+        self.not_needed = 0
+
+    async def get(self, url: str) -> FaststartLayout | None:
+        key = source_identity(url)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        task = self._inflight.get(key)
+        loop = asyncio.get_running_loop()
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(self._build(key, url))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._inflight.get(key) is t and self._inflight.pop(key))
+        return await asyncio.shield(task)
+
+    async def _build(self, key: str, url: str) -> FaststartLayout | None:
+        try:
+            layout = await build_layout(self._client_factory(), url, self._headers)
+        except (httpx.HTTPError, ValueError, struct.error) as e:
+            print(f"DEBUG: Faststart layout failed for {url[:80]}: {e}")
+            return None  # transient: not cached
+        if layout is None:
+            self.not_needed += 1
+        else:
+            self.builds += 1
+        self._insert(key, layout)
+        return layout
+
+    def _insert(self, key: str, layout: FaststartLayout | None):
+        size = layout.size if layout else 0
+        if size > self.max_bytes:
+            return
+        self._entries[key] = layout
+        self._bytes += size
+        while self._bytes > self.max_bytes or len(self._entries) > FASTSTART_CACHE_ENTRIES:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size if evicted else 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "builds": self.builds,
+            "not_needed": self.not_needed,
+            "inflight": len(self._inflight),
+        }
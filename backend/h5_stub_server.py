@@ -0,0 +1,158 @@
+"""
+h5_stub_server.py – Offline stand-in for the MovieBox H5 API.
+
+Replays the fixtures in fixtures/h5_fixtures.json for /home, /subject/search,
+/subject/download, /detail, /media-player/get-domain and /subject/play, with
+configurable injected latency and error rate, and counts every upstream call.
+
+Run:  python h5_stub_server.py --port 8765 --latency 0.08 --error-rate 0.02
+Then: H5_API_BASE=http://127.0.0.1:8765/wefeed-h5api-bff python main.py
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import Counter
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "h5_fixtures.json")
+PREFIX = "/wefeed-h5api-bff"
+STUB_TOKEN = "stub-token"
+
+
+def _fill(value, **params):
+    """Recursively substitute {se}/{ep}/{expires}/{base} placeholders in fixture strings."""
+    if isinstance(value, str):
+        for name, param in params.items():
+            value = value.replace("{" + name + "}", str(param))
+        return value
+    if isinstance(value, list):
+        return [_fill(v, **params) for v in value]
+    if isinstance(value, dict):
+        return {k: _fill(v, **params) for k, v in value.items()}
+    return value
+
+
+def create_stub_app(
+    fixtures_path: str = FIXTURES_PATH,
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    url_ttl: int = 3600,
+) -> FastAPI:
+    with open(fixtures_path, "r", encoding="utf-8") as f:
+        subjects = json.load(f)["subjects"]
+    by_id = {s["subjectId"]: s for s in subjects}
+    by_path = {s["detailPath"]: s for s in subjects}
+
+    app = FastAPI()
+    app.state.calls = Counter()
+    app.state.config = {"latency": latency, "jitter": jitter, "error_rate": error_rate, "url_ttl": url_ttl}
+
+    @app.middleware("http")
+    async def inject_faults(request: Request, call_next):
+        path = request.url.path
+        if not path.startswith(PREFIX):
+            return await call_next(request)
+        app.state.calls[path[len(PREFIX):]] += 1
+        cfg = app.state.config
+        delay = cfg["latency"] + random.uniform(0, cfg["jitter"])
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if cfg["error_rate"] and random.random() < cfg["error_rate"]:
+            app.state.calls["errors"] += 1
+            return JSONResponse({"code": 500, "message": "injected error"}, status_code=500)
+        response = await call_next(request)
+        response.headers["x-user"] = json.dumps({"token": STUB_TOKEN})
+        return response
+
+    def envelope(data) -> dict:
+        return {"code": 0, "message": "ok", "data": data}
+
+    def params(request: Request, se=0, ep=0) -> dict:
+        return {"se": se, "ep": ep, "expires": int(time.time()) + app.state.config["url_ttl"], "base": str(request.base_url).rstrip("/")}
+
+    def subject_summary(s: dict) -> dict:
+        return {k: s[k] for k in ("subjectId", "title", "detailPath", "subjectType", "releaseDate")}
+
+    @app.get(PREFIX + "/home")
+    async def home():
+        return envelope({"operatingList": []})
+
+    @app.post(PREFIX + "/subject/search")
+    async def search(request: Request):
+        body = await request.json()
+        keyword = " ".join(str(body.get("keyword", "")).lower().split())
+        items = [subject_summary(s) for s in subjects if keyword and keyword in " ".join(s["title"].lower().split())]
+        return envelope({"pager": {"page": 1, "totalCount": len(items)}, "items": items[: int(body.get("perPage", 15))]})
+
+    @app.get(PREFIX + "/subject/download")
+    async def download(request: Request, subjectId: str, se: int = 0, ep: int = 0, detailPath: str = ""):
+        s = by_id.get(subjectId)
+        if s is None:
+            return envelope({"downloads": [], "captions": []})
+        return envelope(_fill({"downloads": s.get("downloads", []), "captions": s.get("captions", [])}, **params(request, se, ep)))
+
+    @app.get(PREFIX + "/detail")
+    async def detail(detailPath: str):
+        s = by_path.get(detailPath)
+        if s is None:
+            return envelope({})
+        return envelope({
+            "subject": subject_summary(s),
+            "subjectType": s["subjectType"],
+            "resource": {"seasons": s.get("seasons", [])},
+        })
+
+    @app.get(PREFIX + "/media-player/get-domain")
+    async def get_domain(request: Request):
+        return envelope(str(request.base_url).rstrip("/"))
+
+    @app.get(PREFIX + "/subject/play")
+    async def play(request: Request, subjectId: str, se: int = 0, ep: int = 0, detailPath: str = ""):
+        s = by_id.get(subjectId) or {}
+        return envelope(_fill({"streams": s.get("play_streams", [])}, **params(request, se, ep)))
+
+    @app.get("/__stats")
+    async def stats():
+        return {"calls": dict(app.state.calls), "total": sum(v for k, v in app.state.calls.items() if k != "errors")}
+
+    @app.post("/__reset")
+    async def reset():
+        app.state.calls.clear()
+        return Response(status_code=204)
+
+    @app.post("/__config")
+    async def configure(request: Request):
+        app.state.config.update(await request.json())
+        return app.state.config
+
+    return app
+
+
+app = create_stub_app(
+    latency=float(os.environ.get("STUB_LATENCY", "0")),
+    jitter=float(os.environ.get("STUB_JITTER", "0")),
+    error_rate=float(os.environ.get("STUB_ERROR_RATE", "0")),
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline MovieBox H5 API stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fixtures", default=FIXTURES_PATH)
+    parser.add_argument("--latency", type=float, default=0.0, help="base injected latency per call (seconds)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with HTTP 500")
+    args = parser.parse_args()
+    uvicorn.run(
+        create_stub_app(args.fixtures, args.latency, args.jitter, args.error_rate),
+        host=args.host, port=args.port, log_level="warning",
+    )
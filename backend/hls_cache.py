@@ -0,0 +1,434 @@
+"""
+hls_cache.py – On-disk HLS segment cache for transcoded (HEVC -> H.264) streams.
+
+Alternative to the progressive fMP4 transcode: ffmpeg writes fixed-length TS
+segments into a per-title directory keyed by source identity (CDN path, without
+the expiring signature) and rendition. Segments already on disk are served as
+plain files, so seeks into encoded regions are instant and a title is only
+encoded once. A seek past the encoded region restarts the encoder at that
+segment (keyframes are forced on segment boundaries, so restarted runs line up
+with cached ones). Whole titles are evicted least-recently-used under
+HLS_CACHE_BYTES. Directory scans and deletions run in worker threads, and
+titles from a previous process are picked up on first use, not at import.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+
+from stream_url_cache import source_identity
+from transcode import FFMPEG_INPUT_HEADERS, TranscodeManager, terminate_process
+
+HLS_CACHE_DIR = os.environ.get("HLS_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "movienight-hls")
+HLS_CACHE_BYTES = int(os.environ.get("HLS_CACHE_BYTES", str(20 * 1024 * 1024 * 1024)))
+HLS_SEGMENT_SECONDS = int(os.environ.get("HLS_SEGMENT_SECONDS", "4"))
+HLS_LOOKAHEAD_SEGMENTS = int(os.environ.get("HLS_LOOKAHEAD_SEGMENTS", "6"))
+HLS_SEGMENT_WAIT = float(os.environ.get("HLS_SEGMENT_WAIT", "30"))
+HLS_IDLE_TIMEOUT = float(os.environ.get("HLS_IDLE_TIMEOUT", "120"))
+HLS_DURATION_WAIT = 10.0
+RENDITION = "h264-720p"
+
+_DURATION_RE = re.compile(rb"Duration:\s*(\d+):(\d{2}):(\d{2}(?:\.\d+)?)")
+_SEGMENT_RE = re.compile(r"^seg_(\d{5})\.ts$")
+_TRASH_SUFFIX = ".evicted"
+
+
+def cache_key(url: str, rendition: str = RENDITION) -> str:
+    return hashlib.sha256(f"{source_identity(url)}|{rendition}".encode("utf-8")).hexdigest()[:24]
+
+
+def segment_name(index: int) -> str:
+    return f"seg_{index:05d}.ts"
+
+
+def segment_index(name: str) -> int | None:
+    m = _SEGMENT_RE.match(name)
+    return int(m.group(1)) if m else None
+
+
+def build_hls_cmd(ffmpeg_path: str, source_url: str, out_dir: str, start_index: int, segment_seconds: int) -> list[str]:
+    offset = start_index * segment_seconds
+    cmd = [ffmpeg_path]
+    if offset:
+        cmd.extend(["-ss", str(offset)])
+    cmd.extend([
+        "-reconnect", "1",
+        "-reconnect_streamed", "1",
+        "-reconnect_delay_max", "5",
+        "-headers", FFMPEG_INPUT_HEADERS,
+        "-i", source_url,
+        "-vf", "scale=-2:min(720\\,ih)",
+        "-c:v", "libx264",
+        "-preset", "ultrafast",
+        "-force_key_frames", f"expr:gte(t,n_forced*{segment_seconds})",
+        "-threads", "0",
+        "-c:a", "aac",
+        "-ac", "2",
+        "-b:a", "160k",
+        "-sn",
+        # Keep timestamps absolute so segments from a restarted run splice onto cached ones
+        "-output_ts_offset", str(offset),
+        "-f", "hls",
+        "-hls_time", str(segment_seconds),
+        "-hls_list_size", "0",
+        "-hls_segment_type", "mpegts",
+        "-hls_flags", "temp_file",
+        "-start_number", str(start_index),
+        "-hls_segment_filename", os.path.join(out_dir, "seg_%05d.ts"),
+        os.path.join(out_dir, "ffmpeg.m3u8"),
+    ])
+    return cmd
+
+
+@dataclass
+class _Job:
+    process: asyncio.subprocess.Process
+    start_index: int
+    started: float = field(default_factory=time.time)
+    next_index: int = 0  # first segment this run has not written yet
+    monitor: asyncio.Task | None = None
+
+
+@dataclass
+class HLSEntry:
+    key: str
+    dir: str
+    source_url: str = ""
+    ffmpeg_path: str = ""
+    duration: float | None = None
+    last_access: float = field(default_factory=time.time)
+    bytes: int = 0
+    job: _Job | None = None
+
+    def segment_path(self, index: int) -> str:
+        return os.path.join(self.dir, segment_name(index))
+
+    def segment_count(self, segment_seconds: int) -> int | None:
+        if not self.duration:
+            return None
+        return max(1, math.ceil(self.duration / segment_seconds - 1e-6))
+
+    def touch(self):
+        now = time.time()
+        # Persist recency (directory mtime) at most once a minute; it orders eviction after restarts
+        if now - self.last_access > 60:
+            try:
+                os.utime(self.dir)
+            except OSError:
+                pass
+        self.last_access = now
+
+    def rescan_bytes(self):
+        """Recount the directory's size (blocking; call in a thread)."""
+        total = 0
+        try:
+            with os.scandir(self.dir) as it:
+                for f in it:
+                    if f.is_file():
+                        total += f.stat().st_size
+        except OSError:
+            pass
+        self.bytes = total
+
+
+def _remove_tmp_files(directory: str):
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        if name.endswith(".tmp"):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def _discard_dir(path: str) -> str | None:
+    """Rename a title directory out of the way (cheap) so it can be deleted in the background."""
+    trash = f"{path}{_TRASH_SUFFIX}-{time.time_ns()}"
+    try:
+        os.rename(path, trash)
+        return trash
+    except OSError:
+        return None
+
+
+class HLSCache:
+    def __init__(
+        self,
+        transcoder: TranscodeManager,
+        root: str = HLS_CACHE_DIR,
+        max_bytes: int = HLS_CACHE_BYTES,
+        segment_seconds: int = HLS_SEGMENT_SECONDS,
+    ):
+        self.transcoder = transcoder
+        self.root = root
+        self.max_bytes = max_bytes
+        self.segment_seconds = segment_seconds
+        self.entries: dict[str, HLSEntry] = {}
+        self.hits = 0
+        self.misses = 0
+        self.encodes = 0
+        self.evictions = 0
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    # --- persistence -----------------------------------------------------
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            for entry in await asyncio.to_thread(self._scan):
+                self.entries.setdefault(entry.key, entry)
+            self._loaded = True
+        await self._enforce_budget()
+
+    def _scan(self) -> list[HLSEntry]:
+        """Titles encoded by a previous process (blocking; runs in a thread)."""
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if _TRASH_SUFFIX in name:
+                shutil.rmtree(path, ignore_errors=True)  # deletion interrupted by a restart
+                continue
+            try:
+                with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta.get("segment_seconds") != self.segment_seconds:
+                    shutil.rmtree(path, ignore_errors=True)
+                    continue
+                entry = HLSEntry(key=name, dir=path, duration=meta.get("duration"), last_access=os.path.getmtime(path))
+            except (OSError, ValueError, AttributeError):
+                continue
+            entry.rescan_bytes()
+            found.append(entry)
+        return found
+
+    def _write_meta(self, entry: HLSEntry):
+        meta = {"duration": entry.duration, "segment_seconds": self.segment_seconds, "rendition": RENDITION}
+        path = os.path.join(entry.dir, "meta.json")
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"DEBUG: HLS meta write failed: {e}")
+
+    # --- public API ------------------------------------------------------
+
+    async def open(self, source_url: str, ffmpeg_path: str) -> str:
+        """Register (or refresh) a source and return its cache key.
+
+        The freshly signed URL replaces any stored one, so encoder restarts use a
+        valid signature. Encoding starts right away when nothing is cached yet.
+        """
+        await self._ensure_loaded()
+        key = cache_key(source_url)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = HLSEntry(key=key, dir=os.path.join(self.root, key))
+            self.entries[key] = entry
+            await asyncio.to_thread(os.makedirs, entry.dir, exist_ok=True)
+            await asyncio.to_thread(self._write_meta, entry)
+        entry.source_url = source_url
+        entry.ffmpeg_path = ffmpeg_path
+        entry.touch()
+        if entry.duration is None:
+            if entry.job is None and not os.path.exists(entry.segment_path(0)):
+                await self._start_job(entry, 0)
+            # ffmpeg prints the input duration almost immediately; it lets us publish a full VOD playlist
+            deadline = time.monotonic() + HLS_DURATION_WAIT
+            while entry.duration is None and entry.job is not None and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+        return key
+
+    async def playlist(self, key: str) -> str | None:
+        await self._ensure_loaded()
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        entry.touch()
+        seg = self.segment_seconds
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{seg}", "#EXT-X-MEDIA-SEQUENCE:0"]
+        count = entry.segment_count(seg)
+        if count is not None:
+            lines.append("#EXT-X-PLAYLIST-TYPE:VOD")
+            for i in range(count):
+                lines.append(f"#EXTINF:{min(seg, entry.duration - i * seg):.3f},")
+                lines.append(segment_name(i))
+            lines.append("#EXT-X-ENDLIST")
+        else:
+            # Duration unknown: list what is encoded so far as a growing EVENT playlist
+            lines.append("#EXT-X-PLAYLIST-TYPE:EVENT")
+            i = 0
+            while os.path.exists(entry.segment_path(i)):
+                lines.append(f"#EXTINF:{seg:.3f},")
+                lines.append(segment_name(i))
+                i += 1
+        return "\n".join(lines) + "\n"
+
+    async def segment(self, key: str, index: int) -> str:
+        """Path of segment `index`, encoding it first if needed.
+
+        Raises KeyError for unknown titles/segments, TranscodeBusy when no encoder
+        slot is free, and RuntimeError / asyncio.TimeoutError when encoding fails.
+        """
+        await self._ensure_loaded()
+        entry = self.entries.get(key)
+        if entry is None:
+            raise KeyError(key)
+        count = entry.segment_count(self.segment_seconds)
+        if index < 0 or (count is not None and index >= count):
+            raise KeyError(index)
+        entry.touch()
+        path = entry.segment_path(index)
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+
+        self.misses += 1
+        deadline = time.monotonic() + HLS_SEGMENT_WAIT
+        restarts = 0
+        while not os.path.exists(path):
+            job = entry.job
+            if job is None or not (job.start_index <= index <= job.next_index + HLS_LOOKAHEAD_SEGMENTS):
+                # Not being encoded, or too far ahead of the encoder to wait for: restart there
+                if restarts >= 2:
+                    raise RuntimeError("encoder stopped before producing the segment")
+                if not entry.source_url:
+                    raise RuntimeError("no source URL for this title; reopen the stream")
+                restarts += 1
+                await self._start_job(entry, index)
+            if time.monotonic() > deadline:
+                raise asyncio.TimeoutError()
+            await asyncio.sleep(0.2)
+        return path
+
+    async def close(self):
+        for entry in list(self.entries.values()):
+            await self._stop_job(entry)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": sum(e.bytes for e in self.entries.values()),
+            "max_bytes": self.max_bytes,
+            "active_jobs": sum(1 for e in self.entries.values() if e.job is not None),
+            "hits": self.hits,
+            "misses": self.misses,
+            "encodes": self.encodes,
+            "evictions": self.evictions,
+        }
+
+    # --- encoder jobs ----------------------------------------------------
+
+    async def _start_job(self, entry: HLSEntry, index: int):
+        await self._stop_job(entry)
+        await self.transcoder.acquire()
+        try:
+            creationflags = 0x08000000 if sys.platform == "win32" else 0  # CREATE_NO_WINDOW
+            print(f"DEBUG: Starting HLS encode of {entry.key} at segment {index}...")
+            process = await asyncio.create_subprocess_exec(
+                *build_hls_cmd(entry.ffmpeg_path, entry.source_url, entry.dir, index, self.segment_seconds),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+                creationflags=creationflags,
+            )
+        except BaseException:
+            self.transcoder.release()
+            raise
+        self.encodes += 1
+        job = _Job(process=process, start_index=index, next_index=index)
+        entry.job = job
+        job.monitor = asyncio.create_task(self._monitor(entry, job))
+
+    async def _stop_job(self, entry: HLSEntry):
+        job = entry.job
+        if job is None:
+            return
+        if job.monitor is not None and job.monitor is not asyncio.current_task():
+            job.monitor.cancel()
+            await asyncio.gather(job.monitor, return_exceptions=True)
+        await self._finish_job(entry, job)
+
+    async def _finish_job(self, entry: HLSEntry, job: _Job):
+        if entry.job is not job:
+            return
+        entry.job = None
+        await terminate_process(job.process)
+        self.transcoder.release()
+        await asyncio.to_thread(_remove_tmp_files, entry.dir)
+        await asyncio.to_thread(entry.rescan_bytes)
+        await self._enforce_budget()
+
+    async def _monitor(self, entry: HLSEntry, job: _Job):
+        """Parse ffmpeg's stderr for the duration and watch progress until the run ends."""
+        async def read_stderr():
+            head = b""
+            while True:
+                line = await job.process.stderr.readline()
+                if not line:
+                    return
+                if entry.duration is None and len(head) < 65536:
+                    head += line
+                    m = _DURATION_RE.search(head)
+                    if m:
+                        h, mnt, sec = m.groups()
+                        entry.duration = int(h) * 3600 + int(mnt) * 60 + float(sec)
+                        await asyncio.to_thread(self._write_meta, entry)
+
+        reader = asyncio.create_task(read_stderr())
+        try:
+            while not reader.done():
+                await asyncio.wait([reader], timeout=1.0)
+                while True:
+                    path = entry.segment_path(job.next_index)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        break
+                    if st.st_mtime < job.started - 1:
+                        # Caught up with segments a previous run already produced
+                        print(f"DEBUG: HLS encode of {entry.key} reached cached segment {job.next_index}, stopping")
+                        reader.cancel()
+                        break
+                    entry.bytes += st.st_size
+                    job.next_index += 1
+                if time.time() - entry.last_access > HLS_IDLE_TIMEOUT:
+                    print(f"DEBUG: HLS encode of {entry.key} idle, stopping")
+                    reader.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
+        finally:
+            reader.cancel()
+            await asyncio.shield(self._finish_job(entry, job))
+
+    async def _enforce_budget(self):
+        total = sum(e.bytes for e in self.entries.values())
+        if total <= self.max_bytes:
+            return
+        trash = []
+        for entry in sorted(self.entries.values(), key=lambda e: e.last_access):
+            if total <= self.max_bytes:
+                break
+            if entry.job is not None:
+                continue
+            # Renamed now, so a reopen of the same title gets a fresh directory; deleted off the loop
+            discarded = _discard_dir(entry.dir)
+            if discarded:
+                trash.append(discarded)
+            del self.entries[entry.key]
+            total -= entry.bytes
+            self.evictions += 1
+            print(f"DEBUG: Evicted HLS cache entry {entry.key} ({entry.bytes} bytes)")
+        for path in trash:
+            await asyncio.to_thread(shutil.rmtree, path, True)
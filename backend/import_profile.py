@@ -0,0 +1,131 @@
+"""
+import_profile.py – Import-time profile and cold-start budget check for the serverless entrypoint.
+
+Imports the target module in fresh interpreters with `-X importtime`, reports
+its total import time (median over runs) and the slowest modules it pulled
+in, and optionally times a first request through its ASGI `app`. Exits 1 when
+a median is over budget, so it can run in CI.
+
+    python backend/import_profile.py                               # api.index, 50 ms budget
+    python backend/import_profile.py --request /health             # import + first /health
+    python backend/import_profile.py -m main --budget-ms 0 --top 25  # report only
+
+JSON endpoints make real H5 calls; point H5_API_BASE at h5_stub_server.py to
+time them offline.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_REQUEST_SNIPPET = """
+import asyncio, json, sys, time
+started = time.perf_counter()
+from {module} import app
+path, _, query = sys.argv[1].partition("?")
+status = []
+
+async def main():
+    scope = {{"type": "http", "method": "GET", "path": path, "query_string": query.encode(), "headers": []}}
+    async def receive():
+        return {{"type": "http.request", "body": b"", "more_body": False}}
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+    await app(scope, receive, send)
+
+asyncio.run(main())
+print(json.dumps({{"ms": (time.perf_counter() - started) * 1000, "status": status[0] if status else None}}))
+"""
+
+
+def parse_importtime(stderr: str) -> tuple[float, list[tuple[str, float, float]]]:
+    """(total ms of imports after interpreter startup, [(module, self ms, cumulative ms)])."""
+    rows, after_site, total = [], False, 0.0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if not after_site:
+            after_site = depth == 0 and name == "site"
+            continue
+        rows.append((name, int(self_us) / 1000, int(cumulative_us) / 1000))
+        if depth == 0:
+            total += int(cumulative_us) / 1000
+    return total, rows
+
+
+def profile_import(module: str, runs: int) -> tuple[list[float], list]:
+    results = []
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=ROOT_DIR, capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            sys.exit(f"import {module} failed:\n{proc.stderr[-2000:]}")
+        results.append(parse_importtime(proc.stderr))
+    results.sort(key=lambda r: r[0])
+    totals = [total for total, _ in results]
+    median_rows = results[len(results) // 2][1]
+    return totals, median_rows
+
+
+def profile_request(module: str, path: str, runs: int) -> tuple[list[float], int | None]:
+    timings, status = [], None
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, "-c", _REQUEST_SNIPPET.format(module=module), path],
+            cwd=ROOT_DIR, capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            sys.exit(f"request {path} failed:\n{proc.stderr[-2000:]}")
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        timings.append(result["ms"])
+        status = result["status"]
+    return timings, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time profile with a cold-start budget check")
+    parser.add_argument("-m", "--module", default="api.index", help="module to import (from the repo root)")
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument("--budget-ms", type=float, default=50.0, help="max median import time (0 = report only)")
+    parser.add_argument("--request", action="append", default=[], metavar="PATH", help="also time import + first GET PATH")
+    parser.add_argument("--request-budget-ms", type=float, default=0.0, help="max median import + first request time (0 = report only)")
+    args = parser.parse_args()
+
+    totals, rows = profile_import(args.module, args.runs)
+    median = statistics.median(totals)
+    print(f"== import {args.module} ==  median {median:.1f} ms  (min {min(totals):.1f}, max {max(totals):.1f}, n={args.runs})")
+    print(f"  {'module':<48} {'self ms':>9} {'cumul ms':>9}")
+    for name, self_ms, cumulative_ms in sorted(rows, key=lambda r: r[2], reverse=True)[:args.top]:
+        print(f"  {name:<48} {self_ms:>9.1f} {cumulative_ms:>9.1f}")
+
+    over = []
+    if args.budget_ms and median > args.budget_ms:
+        over.append(f"import {args.module}: {median:.1f} ms > {args.budget_ms:.0f} ms")
+
+    for path in args.request:
+        timings, status = profile_request(args.module, path, args.runs)
+        request_median = statistics.median(timings)
+        print(f"== import + GET {path} ==  median {request_median:.1f} ms  status {status}")
+        if args.request_budget_ms and request_median > args.request_budget_ms:
+            over.append(f"GET {path}: {request_median:.1f} ms > {args.request_budget_ms:.0f} ms")
+
+    if over:
+        print("OVER BUDGET: " + "; ".join(over))
+        sys.exit(1)
+    print("within budget" if args.budget_ms else "report only")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+loop_bridge.py – A long-lived asyncio loop on a background thread for sync (Flask) code.
+
+Sync request handlers submit coroutines with `run()` instead of creating a new
+event loop per request, so the async api_service keeps its pooled H5 client,
+token and caches (and loop-bound single-flight tasks) across requests. The loop
+starts lazily in the serving process (gunicorn forks workers after import, and
+threads don't survive a fork) and shuts down cleanly at exit.
+"""
+
+import asyncio
+import os
+import threading
+
+BRIDGE_TIMEOUT = float(os.environ.get("BRIDGE_TIMEOUT", "60"))
+SHUTDOWN_TIMEOUT = 10.0
+
+
+class LoopBridge:
+    def __init__(self, on_start=(), on_stop=(), name: str = "asyncio-bridge"):
+        self.on_start = list(on_start)  # coroutine functions awaited on the loop after it starts
+        self.on_stop = list(on_stop)  # ... and before it stops
+        self.name = name
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.loop is not None and self._pid == os.getpid() and self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self.running:
+                return self.loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def serve():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=serve, name=self.name, daemon=True)
+            self._thread.start()
+            ready.wait()
+            self.loop, self._pid = loop, os.getpid()
+            for hook in self.on_start:
+                asyncio.run_coroutine_threadsafe(hook(), loop).result(SHUTDOWN_TIMEOUT)
+            return loop
+
+    def run(self, coro, timeout: float | None = BRIDGE_TIMEOUT):
+        """Run `coro` on the shared loop and block the calling thread for its result."""
+        loop = self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self):
+        """Run the stop hooks, cancel leftover tasks and stop the loop thread."""
+        with self._lock:
+            if not self.running:
+                return
+            loop, thread = self.loop, self._thread
+
+            async def shutdown():
+                for hook in self.on_stop:
+                    try:
+                        await hook()
+                    except Exception as e:
+                        print(f"DEBUG: Loop bridge shutdown hook failed: {e}")
+                tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            try:
+                asyncio.run_coroutine_threadsafe(shutdown(), loop).result(SHUTDOWN_TIMEOUT)
+            except Exception as e:
+                print(f"DEBUG: Loop bridge shutdown incomplete: {e}")
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(SHUTDOWN_TIMEOUT)
+            if not thread.is_alive():
+                loop.close()
+            self.loop, self._thread, self._pid = None, None, None
@@ -1,11 +1,11 @@
-import uvicorn
 import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Response, Request
-from fastapi.responses import RedirectResponse, StreamingResponse, FileResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-import requests
 import os
+import secrets
 import sys
 
 # Ensure backend directory is in the python path for absolute imports on deployment
@@ -13,15 +13,69 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from api_service import (
     get_stream_url, 
+    get_stream_download,
     get_media_metadata, 
     get_available_qualities, 
     get_available_subtitles,
-    get_available_qualities_with_urls
+    get_available_qualities_with_urls,
+    get_coalesce_stats,
+    get_match_cache_stats,
+    get_token_stats,
+    resolve_media,
+    start_h5_client,
+    close_h5_client,
 )
+from stream_url_cache import StreamURLCache, source_identity
+from prefetch import EpisodePrefetcher
+from subtitle_cache import SubtitleCache, SubtitleEntry, make_entry as make_subtitle_entry
+from vtt_converter import convert_stream
+from segmented_fetch import SEGMENT_SIZE, SegmentedFetcher, fetch_range, parse_content_range, parse_range_header
+from transcode import TranscodeBusy, TranscodeManager
+from hls_cache import HLSCache, segment_index
+from codec_probe import CodecResolver
+from seek_index import SeekIndexCache
+from faststart import FaststartCache, stream_virtual_range
+from fanout import FanoutHub
+from chunk_cache import ChunkCache, ChunkFetchError
+from stream_proxy import ReadAheadProxy
+from upstream_governor import DOWNLOAD, UpstreamBusy, governed_transport, governor, upstream_priority
+import metrics
+from metrics import CACHE_EVENTS, STAGE_SECONDS, UPSTREAM_RESPONSES
 import httpx
-import re
+import shutil
+import time
+from urllib.parse import quote
+
+# Resolved CDN URLs, kept until just before their auth_key signature expires
+_stream_url_cache = StreamURLCache(
+    max_entries=int(os.environ.get("STREAM_URL_CACHE_SIZE", "2000")),
+    max_bytes=int(os.environ.get("STREAM_URL_CACHE_BYTES", str(4 * 1024 * 1024))),
+)
 
-app = FastAPI()
+CACHE_EVENTS.add_source(lambda: {
+    ("stream_url", "hit"): _stream_url_cache.hits,
+    ("stream_url", "miss"): _stream_url_cache.misses,
+})
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm, pooled connections to the H5 API for the lifetime of the process
+    await start_h5_client()
+    sweeper = asyncio.create_task(_stream_url_cache.run_sweeper())
+    try:
+        yield
+    finally:
+        sweeper.cancel()
+        await _prefetcher.close()
+        await _hls_cache.close()
+        await _transcoder.close()
+        await _fanout.close()
+        await _chunk_cache.close()
+        await close_h5_client()
+        if _shared_stream_client is not None and not _shared_stream_client.is_closed:
+            await _shared_stream_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow CORS
 app.add_middleware(
@@ -67,6 +121,32 @@ if os.path.exists(local_assets_dir):
 async def health_check():
     return {"status": "ok", "service": "movie-night-backend"}
 
+@app.get("/api/debug/stats")
+async def debug_stats():
+    """Internal counters for the resolution pipeline (coalescing, caches)."""
+    return {
+        "movie_files": get_coalesce_stats(),
+        "match_cache": get_match_cache_stats(),
+        "stream_url_cache": _stream_url_cache.stats(),
+        "prefetch": _prefetcher.stats(),
+        "token": get_token_stats(),
+        "subtitle_cache": _subtitle_cache.stats(),
+        "transcode": _transcoder.stats(),
+        "fanout": _fanout.stats(),
+        "chunk_cache": _chunk_cache.stats(),
+        "stream_proxy": _stream_proxy.stats(),
+        "hls_cache": _hls_cache.stats(),
+        "codecs": _codec_resolver.stats(),
+        "seek_index": _seek_index.stats(),
+        "faststart": _faststart.stats(),
+        "upstream": governor.stats(),
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text exposition of stage latencies, upstream statuses, cache events and transcodes."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/api/metadata")
 async def get_meta(title: str, year: int = None):
     if not title: return {}
@@ -108,112 +188,210 @@ async def get_downloads_links(title: str, year: int = None, season: int = 1, epi
         print(f"Download links error: {e}")
         return []
 
+SUBTITLE_FETCH_HEADERS = {
+    'Referer': 'https://fmoviesunblocked.net/',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+}
+
+# Converted subtitles keyed by source URL, filled by the proxy and by prefetch
+_subtitle_cache = SubtitleCache(
+    max_bytes=int(os.environ.get("SUBTITLE_CACHE_BYTES", str(16 * 1024 * 1024))),
+    disk_dir=os.environ.get("SUBTITLE_CACHE_DIR") or None,
+    disk_max_bytes=int(os.environ.get("SUBTITLE_DISK_CACHE_BYTES", str(256 * 1024 * 1024))),
+)
+SUBTITLE_CACHE_CONTROL = "public, max-age=86400"
+
+CACHE_EVENTS.add_source(lambda: {
+    ("subtitle", "hit"): _subtitle_cache.hits,
+    ("subtitle", "disk_hit"): _subtitle_cache.disk_hits,
+    ("subtitle", "miss"): _subtitle_cache.misses,
+})
+
+async def _open_subtitle(url: str) -> httpx.Response:
+    """Start streaming a remote subtitle; raises HTTPException on upstream errors."""
+    client = _get_shared_stream_client()
+    resp = await client.send(client.build_request("GET", url, headers=SUBTITLE_FETCH_HEADERS, timeout=20.0), stream=True)
+    UPSTREAM_RESPONSES.inc("subtitle", resp.status_code)
+    if resp.status_code >= 400:
+        await resp.aclose()
+        print(f"Sub Proxy Fetch Error: {resp.status_code} for {url}")
+        raise HTTPException(status_code=resp.status_code)
+    return resp
+
+async def _convert_and_cache(url: str, resp: httpx.Response):
+    """Yield converted WebVTT cue by cue while the upstream body downloads, then cache the result."""
+    started = time.perf_counter()
+    parts = []
+    try:
+        async for text in convert_stream(resp.aiter_bytes()):
+            parts.append(text)
+            yield text
+    finally:
+        await resp.aclose()
+    STAGE_SECONDS.observe(time.perf_counter() - started, "subtitle_proxy")
+    await _subtitle_cache.put(url, "".join(parts))
+
+async def _fetch_subtitle_vtt(url: str) -> SubtitleEntry:
+    """Fetch and convert a subtitle, serving repeat requests from _subtitle_cache."""
+    entry = await _subtitle_cache.get(url)
+    if entry is not None:
+        return entry
+    async for _ in _convert_and_cache(url, await _open_subtitle(url)):
+        pass
+    return await _subtitle_cache.get(url) or make_subtitle_entry("WEBVTT\n\n")
+
 @app.get("/api/subtitles/proxy")
-async def proxy_subtitle(url: str):
+async def proxy_subtitle(url: str, request: Request, lang: str = None, title: str = None):
     if not url: raise HTTPException(status_code=400)
+    # The player passes the chosen language so next-episode prefetch converts only that one
+    _prefetcher.note_subtitle_language(title, lang)
+    headers = {
+        "Access-Control-Allow-Origin": "*",
+        "Cache-Control": SUBTITLE_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+        "X-Content-Type-Options": "nosniff",
+    }
     try:
-        headers = {
-            'Referer': 'https://fmoviesunblocked.net/', 
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
-        async with httpx.AsyncClient(timeout=20.0, follow_redirects=True) as client:
-            resp = await client.get(url, headers=headers)
-            if resp.status_code >= 400:
-                print(f"Sub Proxy Fetch Error: {resp.status_code} for {url}")
-                raise HTTPException(status_code=resp.status_code)
-            
-            content = resp.content
-            
-            # 1. Handle Byte Order Mark (BOM) and decode
-            try:
-                text = content.decode('utf-8-sig')
-            except UnicodeDecodeError:
-                try:
-                    text = content.decode('latin-1')
-                except:
-                    text = content.decode('utf-8', errors='ignore')
-
-            text = text.strip()
-            
-            # Handle \N or \n as line breaks (common in some sources)
-            text = text.replace("\\N", "\n").replace("\\n", "\n")
-            
-            # 2. Check if it's already VTT or needs conversion
-            is_vtt = text.startswith("WEBVTT")
-            
-            # Standardize timestamps: 00:00:00,000 -> 00:00:00.000
-            text = re.sub(r"(\d{2}:\d{2}:\d{2}),(\d{3})", r"\1.\2", text)
-            
-            # Inject positioning (line:80%) to push subs up away from black bars
-            # This works for both newly converted and existing VTT
-            text = re.sub(r"(\d{2}:\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}:\d{2}\.\d{3})", r"\1 line:80%", text)
-            
-            if not is_vtt:
-                vtt_text = "WEBVTT\n\n" + text
-                return Response(
-                    content=vtt_text, 
-                    media_type="text/vtt",
-                    headers={
-                        "Access-Control-Allow-Origin": "*",
-                        "Cache-Control": "no-cache",
-                        "X-Content-Type-Options": "nosniff"
-                    }
-                )
-            
-            # Already VTT, but we updated the timestamps with 'line:80%'
-            return Response(
-                content=text if text.startswith("WEBVTT") else f"WEBVTT\n\n{text}", 
-                media_type="text/vtt",
-                headers={
-                    "Access-Control-Allow-Origin": "*",
-                    "Cache-Control": "no-cache",
-                    "X-Content-Type-Options": "nosniff"
-                }
-            )
+        entry = await _subtitle_cache.get(url)
+        if entry is None:
+            # Cache miss: stream cues to the client as they are converted
+            resp = await _open_subtitle(url)
+            return StreamingResponse(_convert_and_cache(url, resp), media_type="text/vtt; charset=utf-8", headers=headers)
+
+        headers["ETag"] = entry.etag
+        if_none_match = request.headers.get("if-none-match", "")
+        if entry.etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+
+        body, encoding = entry.body_for(request.headers.get("accept-encoding"))
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type="text/vtt; charset=utf-8", headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Sub proxy total failure: {e}")
         raise HTTPException(status_code=500)
 
-@app.get("/api/download/proxy")
-async def download_proxy(url: str, title: str = "video"):
-    if not url: raise HTTPException(status_code=400)
-    
-    headers = {
-        'Referer': 'https://fmoviesunblocked.net/', 
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-    }
-    
-    client = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0), follow_redirects=True)
-    
-    async def stream_file():
-        try:
-            async with client.stream("GET", url, headers=headers) as r:
-                async for chunk in r.aiter_bytes(chunk_size=1024*1024): # 1MB chunks
-                    yield chunk
-        finally:
-            await client.aclose()
+DOWNLOAD_FETCH_HEADERS = {
+    'Referer': 'https://fmoviesunblocked.net/',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+}
+# Upstream headers relayed to the client so resumed downloads can validate and continue
+_PASSTHROUGH_HEADERS = ("Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified")
+
+# Multi-connection upstream fetching for downloads (per request: ?segmented=true/false)
+DOWNLOAD_SEGMENTED = os.environ.get("DOWNLOAD_SEGMENTED", "0") == "1"
 
-    # Try to get file size for progress
+async def _segmented_download(client: httpx.AsyncClient, url: str, headers: dict, byte_range, resp_headers: dict):
+    """Serve a download over several upstream connections. Returns None if the upstream can't do ranges."""
+    start, end = byte_range or (0, None)
+    first_end = start + SEGMENT_SIZE - 1 if end is None else min(end, start + SEGMENT_SIZE - 1)
     try:
-        r = requests.head(url, headers=headers, allow_redirects=True, timeout=5)
-        content_length = r.headers.get('Content-Length')
-    except:
-        content_length = None
+        first_data, first_headers = await fetch_range(client, url, headers, start, first_end)
+    except httpx.HTTPStatusError as e:
+        # Not a usable 206 (e.g. Range ignored): fall back before any of the body is read
+        UPSTREAM_RESPONSES.inc("download", e.response.status_code)
+        return None
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Segmented download probe failed: {e}")
+        return None
+    UPSTREAM_RESPONSES.inc("download", 206)
+    parsed = parse_content_range(first_headers.get("Content-Range"))
+    if parsed[2] is None:
+        return None
+
+    total = parsed[2]
+    first_end = parsed[1]
+    end = total - 1 if end is None else min(end, total - 1)
+
+    async def body():
+        # The probe doubles as the first segment
+        yield first_data
+        if first_end < end:
+            fetcher = SegmentedFetcher(client, url, headers, first_end + 1, end)
+            async for chunk in fetcher.stream():
+                yield chunk
+
+    resp_headers = {**resp_headers, "Content-Length": str(end - start + 1)}
+    for name in ("ETag", "Last-Modified"):
+        if name in first_headers:
+            resp_headers[name] = first_headers[name]
+    if byte_range:
+        resp_headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    return StreamingResponse(
+        body(),
+        status_code=206 if byte_range else 200,
+        headers=resp_headers,
+        media_type="application/octet-stream",
+    )
+
+@app.get("/api/download/proxy")
+async def download_proxy(url: str, request: Request, title: str = "video", segmented: bool = None):
+    if not url: raise HTTPException(status_code=400)
+    # Downloads queue behind playback and prefetch at the upstream governor
+    upstream_priority.set(DOWNLOAD)
 
     filename = f"{title.replace(' ', '_')}.mp4"
     resp_headers = {
         "Content-Disposition": f'attachment; filename="{filename}"',
-        "Access-Control-Allow-Origin": "*"
+        "Access-Control-Allow-Origin": "*",
+        "Accept-Ranges": "bytes",
     }
-    if content_length:
-        resp_headers["Content-Length"] = content_length
 
-    return StreamingResponse(stream_file(), headers=resp_headers, media_type="application/octet-stream")
+    headers = dict(DOWNLOAD_FETCH_HEADERS)
+    client = _get_shared_stream_client()
 
-import time
+    # Segmented mode handles plain and single-range requests; If-Range validation stays with the upstream
+    byte_range = parse_range_header(request.headers.get("Range"))
+    if (DOWNLOAD_SEGMENTED if segmented is None else segmented) and byte_range is not False and not request.headers.get("If-Range"):
+        response = await _segmented_download(client, url, headers, byte_range, resp_headers)
+        if response is not None:
+            return response
 
-_stream_url_cache = {}  # key: (title, quality, year, season, episode, is_tv) -> (url, timestamp)
-CACHE_TTL = 180  # 3 minutes (prevents CDN link signature expiration)
+    # Forward Range/If-Range so a dropped download resumes instead of restarting from byte 0
+    for name in ("Range", "If-Range"):
+        value = request.headers.get(name)
+        if value:
+            headers[name] = value
+
+    try:
+        upstream = await client.send(
+            client.build_request("GET", url, headers=headers, timeout=httpx.Timeout(60.0, connect=10.0)),
+            stream=True,
+        )
+    except UpstreamBusy as busy:
+        raise HTTPException(status_code=503, detail="Upstream is busy, retry shortly.", headers={"Retry-After": str(busy.retry_after)})
+    except httpx.HTTPError as e:
+        print(f"Download proxy upstream error: {e}")
+        raise HTTPException(status_code=502, detail="Upstream unavailable")
+    UPSTREAM_RESPONSES.inc("download", upstream.status_code)
+
+    if upstream.status_code >= 400:
+        # Includes 416 for unsatisfiable ranges, relayed with its Content-Range
+        status = upstream.status_code
+        content_range = upstream.headers.get("Content-Range")
+        await upstream.aclose()
+        return Response(status_code=status, headers={"Content-Range": content_range} if content_range else {})
+
+    async def stream_file():
+        try:
+            async for chunk in upstream.aiter_bytes(chunk_size=1024*1024): # 1MB chunks
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+    # File size (and range) come from the GET itself – no separate HEAD round trip
+    for name in _PASSTHROUGH_HEADERS:
+        if name in upstream.headers:
+            resp_headers[name] = upstream.headers[name]
+
+    return StreamingResponse(
+        stream_file(),
+        status_code=206 if upstream.status_code == 206 else 200,
+        headers=resp_headers,
+        media_type="application/octet-stream",
+    )
 
 # Global shared client pool for stream proxying (reuses connections instead of creating new ones per request)
 _shared_stream_client: httpx.AsyncClient | None = None
@@ -224,36 +402,256 @@ def _get_shared_stream_client() -> httpx.AsyncClient:
         _shared_stream_client = httpx.AsyncClient(
             timeout=httpx.Timeout(120.0, connect=15.0),
             follow_redirects=True,
-            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+            # Upstream governor: per-host token buckets and priority queueing instead of a flat semaphore
+            transport=governed_transport(limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)),
         )
     return _shared_stream_client
 
-# Semaphore to limit concurrent upstream stream connections and prevent 429
-_stream_semaphore = asyncio.Semaphore(5)
+def _warm_stream_cache(key: tuple, downloads: list):
+    """Seed the stream URL cache for a prefetched episode (auto quality and every listed quality)."""
+    title, year, season, episode, is_tv = key
+    _codec_resolver.register(downloads)
+    _chunk_cache.register(downloads)
+    _stream_url_cache.put((title, None, year, season, episode, is_tv), downloads[0]["url"])
+    # downloads are ranked best-first, so keep the first URL seen for each quality
+    for d in reversed(downloads):
+        _stream_url_cache.put((title, d["resolution"], year, season, episode, is_tv), d["url"])
 
-# Track active stream requests to prevent duplicate concurrent fetches for the same URL
-_active_stream_requests: dict[str, float] = {}  # url -> timestamp
-_STREAM_DEDUP_WINDOW = 2.0  # seconds
+_prefetcher = EpisodePrefetcher(warm_stream=_warm_stream_cache, warm_subtitle=_fetch_subtitle_vtt)
 
 async def _resolve_stream_url(title, quality, year, season, episode, is_tv):
     """Resolve stream URL with caching to avoid redundant upstream API calls."""
     cache_key = (title, quality, year, season, episode, is_tv)
-    now = time.time()
-    if cache_key in _stream_url_cache:
-        url, ts = _stream_url_cache[cache_key]
-        if now - ts < CACHE_TTL:
-            print(f"DEBUG: Stream URL cache hit for '{title}' (quality={quality})")
-            return url
-        else:
-            del _stream_url_cache[cache_key]
-
-    from api_service import get_stream_url
-    stream_url = await get_stream_url(title, quality=quality, year=year, season=season, episode=episode, is_tv=is_tv)
+    url = _stream_url_cache.get(cache_key)
+    if url:
+        print(f"DEBUG: Stream URL cache hit for '{title}' (quality={quality})")
+        return url
+
+    download = await get_stream_download(title, quality=quality, year=year, season=season, episode=episode, is_tv=is_tv)
+    if not download:
+        return None
+    _codec_resolver.register([download])
+    _chunk_cache.register([download])
+    stream_url = download.get("url")
     if stream_url:
-        _stream_url_cache[cache_key] = (stream_url, now)
+        _stream_url_cache.put(cache_key, stream_url)
     return stream_url
 
 
+# HEVC -> H.264 encoders: capped by CPU count, reaped when their viewer leaves
+_transcoder = TranscodeManager()
+# Optional HLS output: segments cached on disk so seeks into encoded regions and rewatches skip ffmpeg
+_hls_cache = HLSCache(_transcoder)
+TRANSCODE_OUTPUT = os.environ.get("TRANSCODE_OUTPUT", "progressive")  # "progressive" (fMP4 pipe) or "hls"
+
+def _viewer_id(player: str | None) -> str:
+    """Identify a viewer so a seek can reuse (and supersede) their running encoder.
+
+    Uses the player's own token (?player=, generated per player instance by the
+    frontend). IP + User-Agent would merge two viewers behind one NAT with the
+    same browser, who would then keep cutting off each other's streams; without
+    a token each request counts as its own viewer.
+    """
+    if player:
+        return f"player:{player[:64]}"
+    return f"request:{secrets.token_hex(8)}"
+
+
+# Video codec per resource: upstream codecName, else a ranged read of the moov/stsd box
+_codec_resolver = CodecResolver(_get_shared_stream_client, DOWNLOAD_FETCH_HEADERS)
+
+# Keyframe time -> byte offset maps, built once per resource from the moov box
+_seek_index = SeekIndexCache(_get_shared_stream_client, DOWNLOAD_FETCH_HEADERS)
+
+# Proxied byte streams: viewers of the same resource (e.g. a Watch Together room) share one upstream read
+_fanout = FanoutHub()
+
+# Opt-in proxy serving moov-at-end MP4s as a virtual faststart file (moov ahead of mdat)
+_faststart = FaststartCache(_get_shared_stream_client, DOWNLOAD_FETCH_HEADERS)
+STREAM_FASTSTART = os.environ.get("STREAM_FASTSTART", "0") == "1"
+
+def _serve_range(request: Request, total: int, headers: dict):
+    """(start, end, status, headers) for the request's Range over a `total`-byte file, or a 416 Response."""
+    headers = {"Accept-Ranges": "bytes", "Content-Type": "video/mp4", **headers}
+    byte_range = parse_range_header(request.headers.get("Range"))
+    if byte_range:
+        start, end = byte_range
+        end = total - 1 if end is None else min(end, total - 1)
+        if start >= total:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{total}"})
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    else:
+        # No (or unsupported suffix/multi) range: the whole file
+        start, end, status = 0, total - 1, 200
+    headers["Content-Length"] = str(end - start + 1)
+    return start, end, status, headers
+
+
+async def _faststart_response(request: Request, stream_url: str) -> Response | None:
+    """Range-aware response over the faststart layout, or None when the file doesn't need one."""
+    layout = await _faststart.get(stream_url)
+    if layout is None:
+        return None
+    served = _serve_range(request, layout.file_size, {"X-Faststart": "true"})
+    if isinstance(served, Response):
+        return served
+    start, end, status, headers = served
+    print(f"DEBUG: Serving faststart view of {stream_url[:80]} bytes {start}-{end}")
+
+    def read_upstream(lo: int, hi: int):
+        return stream_virtual_range(layout, _get_shared_stream_client(), stream_url, DOWNLOAD_FETCH_HEADERS, lo, hi)
+
+    return StreamingResponse(
+        _fanout.stream(f"faststart:{source_identity(stream_url)}", start, end, read_upstream),
+        status_code=status,
+        headers=headers,
+        media_type="video/mp4",
+    )
+
+
+# Proxy modes for /api/stream: "off" redirects to the CDN; "cache" serves through the on-disk
+# chunk cache (LAN server); "stream" relays through a read-ahead proxy (clients blocked from the CDN)
+STREAM_PROXY = os.environ.get("STREAM_PROXY", "off")
+_chunk_cache = ChunkCache(_get_shared_stream_client, DOWNLOAD_FETCH_HEADERS)
+_stream_proxy = ReadAheadProxy(_get_shared_stream_client, DOWNLOAD_FETCH_HEADERS)
+
+def _proxy_mode(proxy: str | None) -> str:
+    mode = (proxy or STREAM_PROXY).lower()
+    if mode in ("1", "true", "yes", "on"):
+        return "cache"
+    if mode in ("0", "false", "no", ""):
+        return "off"
+    return mode
+
+
+async def _chunk_cache_response(request: Request, stream_url: str) -> Response | None:
+    """Range response served from the disk chunk cache, fetching only missing chunks; None on upstream failure."""
+    byte_range = parse_range_header(request.headers.get("Range"))
+    try:
+        entry = await _chunk_cache.open(stream_url, byte_range[0] if byte_range else 0)
+    except ChunkFetchError as e:
+        print(f"DEBUG: Chunk cache unavailable for {stream_url[:80]}: {e}")
+        return None
+    served = _serve_range(request, entry.file_size, {"X-Cache": "chunk"})
+    if isinstance(served, Response):
+        return served
+    start, end, status, headers = served
+    return StreamingResponse(
+        _chunk_cache.read(entry, stream_url, start, end),
+        status_code=status,
+        headers=headers,
+        media_type="video/mp4",
+    )
+
+
+async def _proxied_stream_response(request: Request, stream_url: str) -> Response:
+    """Relay the CDN response (Range forwarded) through the read-ahead proxy.
+
+    Once the file size is known from an earlier response, ranges go through the
+    fan-out so viewers of the same title (a Watch Together room) share upstream
+    reads; the upstream request is then made only when the body is iterated.
+    """
+    known = _stream_proxy.describe(stream_url)
+    if known is not None:
+        total, content_type = known
+        served = _serve_range(request, total, {"Content-Type": content_type})
+        if isinstance(served, Response):
+            return served
+        start, end, status, headers = served
+
+        def read_upstream(lo: int, hi: int):
+            return _stream_proxy.iter_range(stream_url, lo, hi)
+
+        return StreamingResponse(
+            _fanout.stream(f"proxy:{source_identity(stream_url)}", start, end, read_upstream),
+            status_code=status,
+            headers=headers,
+            media_type=content_type,
+        )
+
+    try:
+        upstream = await _stream_proxy.open(stream_url, request.headers.get("Range"))
+    except UpstreamBusy as busy:
+        raise HTTPException(status_code=503, detail="Upstream is busy, retry shortly.", headers={"Retry-After": str(busy.retry_after)})
+    except httpx.HTTPError as e:
+        print(f"DEBUG: Stream proxy upstream failure for {stream_url[:80]}: {e}")
+        raise HTTPException(status_code=502, detail="Upstream stream unavailable")
+    return StreamingResponse(
+        upstream.iter_bytes(),
+        status_code=upstream.status_code,
+        headers=upstream.headers,
+        media_type=upstream.headers.get("Content-Type", "video/mp4"),
+    )
+
+
+async def _needs_transcode(stream_url: str, hevc: int = 0) -> bool:
+    """True when the stream's video is HEVC and the client can't decode it natively."""
+    if hevc:
+        return False
+    info = await _codec_resolver.resolve(stream_url)
+    return info.get("codec") == "hevc"
+
+
+async def _will_transcode(stream_url: str, hevc: int = 0) -> bool:
+    """True when the stream needs transcoding and ffmpeg is available."""
+    return shutil.which("ffmpeg") is not None and await _needs_transcode(stream_url, hevc)
+
+
+def _stream_verdict(will_transcode: bool, output: str = None) -> dict:
+    """How /api/stream will serve: direct, a progressive transcode, or an HLS playlist (load it with hls.js)."""
+    hls = will_transcode and (output or TRANSCODE_OUTPUT) == "hls"
+    return {
+        "transcoded": will_transcode,
+        # HLS is a seekable VOD playlist from 0; only the progressive transcode needs start_time restarts
+        "accept_ranges": "none" if will_transcode and not hls else "bytes",
+        "output": "hls" if hls else "progressive",
+    }
+
+
+@app.get("/api/resolve")
+async def resolve(
+    title: str,
+    quality: str = None,
+    year: int = None,
+    season: int = 1,
+    episode: int = 1,
+    is_tv: bool = None,
+    hevc: int = 0,
+    output: str = None,
+):
+    """Downloads, qualities, subtitles (with proxy URLs), metadata and the transcode verdict in one response."""
+    if not title:
+        raise HTTPException(status_code=400, detail="Title is required")
+    try:
+        result = await resolve_media(title, year=year, season=season, episode=episode, is_tv=is_tv)
+    except Exception as e:
+        print(f"Resolve error: {e}")
+        result = {"downloads": [], "qualities": [], "subtitles": [], "metadata": {}}
+
+    for sub in result["subtitles"]:
+        # lang/title as the player sends them, so next-episode prefetch learns the chosen language
+        sub["proxy_url"] = (
+            f"/api/subtitles/proxy?url={quote(sub['url'], safe='')}"
+            f"&lang={quote(sub.get('language') or '', safe='')}&title={quote(title, safe='')}"
+        )
+
+    # Same selection as get_stream_url: requested quality, else the top-ranked stream
+    downloads = result["downloads"]
+    stream_url = next((d["url"] for d in downloads if quality and d["quality"] == quality), None)
+    if not stream_url and downloads:
+        stream_url = downloads[0]["url"]
+    _codec_resolver.register(downloads)
+    _chunk_cache.register(downloads)
+    if stream_url:
+        # Warm the stream cache so the follow-up /api/stream call skips resolution
+        _stream_url_cache.put((title, quality, year, season, episode, is_tv), stream_url)
+
+    will_transcode = bool(stream_url) and await _will_transcode(stream_url, hevc)
+    result["stream"] = {"available": bool(stream_url), **_stream_verdict(will_transcode, output)}
+    return result
+
+
 @app.get("/api/stream/check")
 async def check_stream_type(
     title: str,
@@ -263,30 +661,45 @@ async def check_stream_type(
     episode: int = 1,
     is_tv: bool = None,
     hevc: int = 0,
+    output: str = None,
 ):
-    """Lightweight endpoint to check if a stream will be transcoded, without opening the full stream."""
+    """Lightweight endpoint to check if (and how) a stream will be transcoded, without opening the full stream."""
     if not title:
         raise HTTPException(status_code=400, detail="Title is required")
     try:
         stream_url = await _resolve_stream_url(title, quality, year, season, episode, is_tv)
         if not stream_url:
-            return {"transcoded": False, "accept_ranges": "bytes"}
+            return _stream_verdict(False)
 
-        import shutil
-        url_lower = stream_url.lower()
-        is_hevc_stream = ("h265" in url_lower or "hevc" in url_lower or "/h265/" in url_lower) and not hevc
-        ffmpeg_path = shutil.which("ffmpeg")
-        will_transcode = is_hevc_stream and ffmpeg_path is not None
+        will_transcode = await _will_transcode(stream_url, hevc)
 
-        return {
-            "transcoded": will_transcode,
-            "accept_ranges": "none" if will_transcode else "bytes",
-        }
+        return _stream_verdict(will_transcode, output)
     except HTTPException:
         raise
     except Exception as e:
         print(f"Stream check error: {e}")
-        return {"transcoded": False, "accept_ranges": "bytes"}
+        return _stream_verdict(False)
+
+
+@app.get("/api/stream/seekmap")
+async def stream_seekmap(
+    title: str,
+    quality: str = None,
+    year: int = None,
+    season: int = 1,
+    episode: int = 1,
+    is_tv: bool = None,
+):
+    """Keyframe time -> byte offset map of the resolved stream, read from its moov box."""
+    if not title:
+        raise HTTPException(status_code=400, detail="Title is required")
+    stream_url = await _resolve_stream_url(title, quality, year, season, episode, is_tv)
+    if not stream_url:
+        raise HTTPException(status_code=404, detail="Stream not found")
+    index = await _seek_index.get(stream_url)
+    if index is None:
+        return {"available": False}
+    return {"available": True, **index.to_dict()}
 
 
 @app.get("/api/stream")
@@ -297,106 +710,81 @@ async def stream_movie(
     year: int = None,
     season: int = 1,
     episode: int = 1,
-    proxy: bool = True,
+    proxy: str = None,
     is_tv: bool = None,
     hevc: int = 0,
-    start_time: float = 0.0
+    start_time: float = 0.0,
+    output: str = None,
+    faststart: bool = None,
+    player: str = None
 ):
     if not title:
         raise HTTPException(status_code=400, detail="Title is required")
+    output = output or TRANSCODE_OUTPUT
 
     try:
         stream_url = await _resolve_stream_url(title, quality, year, season, episode, is_tv)
         if not stream_url:
              raise HTTPException(status_code=404, detail="Stream not found")
 
-        # Dynamic HEVC to H.264 Transcoding detection
-        import shutil
-        import sys
-        
-        url_lower = stream_url.lower()
-        is_hevc = ("h265" in url_lower or "hevc" in url_lower or "/h265/" in url_lower) and not hevc
+        # Resolve the next episode in the background so "next episode" starts from cache
+        if is_tv and start_time <= 0.0:
+            _prefetcher.schedule(title, year, season, episode, is_tv)
+
+        # Dynamic HEVC to H.264 Transcoding detection (codec from upstream metadata or the moov box)
         ffmpeg_path = shutil.which("ffmpeg")
+        is_hevc = bool(ffmpeg_path) and await _needs_transcode(stream_url, hevc)
+
+        if is_hevc and ffmpeg_path and output == "hls":
+            try:
+                key = await _hls_cache.open(stream_url, ffmpeg_path)
+            except TranscodeBusy as busy:
+                raise HTTPException(
+                    status_code=503,
+                    detail="All transcoders are busy, retry shortly.",
+                    headers={"Retry-After": str(busy.retry_after)},
+                )
+            return RedirectResponse(url=f"/api/hls/{key}/index.m3u8", status_code=307)
 
         if is_hevc and ffmpeg_path:
-            print(f"DEBUG: HEVC detected. Spawning ffmpeg transcoding proxy for: {stream_url[:100]} starting at {start_time}s...")
-            headers_str = (
-                "Referer: https://netfilm.world/\r\n"
-                "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/148.0.0.0 Safari/537.36\r\n"
-            )
-            
-            cmd = [ffmpeg_path]
-            if start_time > 0.0:
-                cmd.extend(["-ss", str(start_time)])
-                
-            cmd.extend([
-                "-reconnect", "1",
-                "-reconnect_streamed", "1",
-                "-reconnect_delay_max", "5",
-                "-headers", headers_str,
-                "-i", stream_url,
-                "-vf", "scale=-2:min(720\\,ih)",
-                "-c:v", "libx264",
-                "-preset", "ultrafast",
-                "-tune", "zerolatency",
-                "-threads", "0",
-                "-c:a", "copy",
-                "-sn",
-                "-f", "mp4",
-                "-movflags", "frag_keyframe+empty_moov",
-                "pipe:1"
-            ])
-            
-            import subprocess
-            creationflags = 0
-            if sys.platform == "win32":
-                creationflags = 0x08000000  # CREATE_NO_WINDOW
-                
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.DEVNULL,
-                creationflags=creationflags
-            )
-            
-            async def stream_generator_transcoded():
-                try:
-                    yield {
-                        "status": 200,
-                        "headers": {
-                            "Content-Type": "video/mp4",
-                            "Accept-Ranges": "none",
-                            "Access-Control-Allow-Origin": "*",
-                            "Cache-Control": "no-cache",
-                            "X-Content-Type-Options": "nosniff",
-                            "X-Transcoded": "true"
-                        }
-                    }
-                    while True:
-                        chunk = await process.stdout.read(262144) # 256KB chunks for faster transcoding startup
-                        if not chunk:
-                            break
-                        yield chunk
-                except Exception as e:
-                    print(f"DEBUG: Transcoding stream exception: {e}")
-                finally:
-                    try:
-                        process.terminate()
-                        await process.wait()
-                    except:
-                        pass
-            
-            gen = stream_generator_transcoded()
             try:
-                config = await anext(gen)
-                return StreamingResponse(
-                    gen,
-                    status_code=config["status"],
-                    headers=config["headers"],
-                    media_type="video/mp4"
+                stream = await _transcoder.open(_viewer_id(player), stream_url, start_time, ffmpeg_path)
+            except TranscodeBusy as busy:
+                raise HTTPException(
+                    status_code=503,
+                    detail="All transcoders are busy, retry shortly.",
+                    headers={"Retry-After": str(busy.retry_after)},
                 )
             except Exception as tr_err:
                 print(f"DEBUG: Transcoding failed ({tr_err}), falling back to direct CDN redirect...")
+            else:
+                return StreamingResponse(
+                    stream.iter_bytes(),
+                    status_code=200,
+                    headers={
+                        "Content-Type": "video/mp4",
+                        "Accept-Ranges": "none",
+                        "Access-Control-Allow-Origin": "*",
+                        "Cache-Control": "no-cache",
+                        "X-Content-Type-Options": "nosniff",
+                        "X-Transcoded": "true",
+                        "X-Transcode-Start": f"{stream.actual_start:.3f}",
+                    },
+                    media_type="video/mp4"
+                )
+
+        if STREAM_FASTSTART if faststart is None else faststart:
+            response = await _faststart_response(request, stream_url)
+            if response is not None:
+                return response
+
+        mode = _proxy_mode(proxy)
+        if mode == "cache":
+            response = await _chunk_cache_response(request, stream_url)
+            if response is not None:
+                return response
+        elif mode == "stream":
+            return await _proxied_stream_response(request, stream_url)
 
         # Default streaming logic: Return 307 Redirect directly to CDN stream URL.
         # This enables client browsers to stream directly from MovieBox CDN with zero datacenter IP blocks and fast buffering.
@@ -412,6 +800,33 @@ async def stream_movie(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/hls/{key}/index.m3u8")
+async def hls_playlist(key: str):
+    playlist = await _hls_cache.playlist(key)
+    if playlist is None:
+        raise HTTPException(status_code=404, detail="Unknown HLS stream")
+    return Response(content=playlist, media_type="application/vnd.apple.mpegurl", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/api/hls/{key}/{segment}")
+async def hls_segment(key: str, segment: str):
+    index = segment_index(segment)
+    if index is None:
+        raise HTTPException(status_code=404, detail="Unknown segment")
+    try:
+        path = await _hls_cache.segment(key, index)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown segment")
+    except TranscodeBusy as busy:
+        raise HTTPException(status_code=503, detail="All transcoders are busy, retry shortly.", headers={"Retry-After": str(busy.retry_after)})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Segment not ready")
+    except RuntimeError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    # Segments are immutable once written
+    return FileResponse(path, media_type="video/mp2t", headers={"Cache-Control": "public, max-age=86400"})
+
+
 @app.get("/{full_path:path}")
 async def serve_frontend(full_path: str):
     """Serve the built frontend. For any non-API path, return index.html (SPA routing)."""
@@ -430,4 +845,5 @@ async def serve_frontend(full_path: str):
 
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -1,10 +1,8 @@
 from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-import requests
 import os
 import sys
-import re
-import asyncio
+import atexit
 import traceback
 import httpx
 import urllib.parse
@@ -17,21 +15,39 @@ from api_service import (
     get_media_metadata, 
     get_available_qualities, 
     get_available_subtitles,
-    get_available_qualities_with_urls
+    get_available_qualities_with_urls,
+    start_h5_client,
+    close_h5_client,
 )
+from loop_bridge import LoopBridge
+from vtt_converter import SubtitleStreamConverter
+from upstream_governor import DOWNLOAD, governed_sync_transport, priority
 
 app = Flask(__name__)
 CORS(app)
 
+# Shared sync clients for the proxies; requests pass the upstream governor.
+# Only the subtitle host has ever needed certificate checks off; video and downloads keep them.
+_proxy_client = httpx.Client(timeout=30.0, follow_redirects=True, transport=governed_sync_transport())
+_subtitle_client = httpx.Client(timeout=30.0, follow_redirects=True, transport=governed_sync_transport(verify=False))
+
+# One long-lived event loop for the async api_service: pooled H5 client, token and caches persist across requests
+_bridge = LoopBridge(on_start=[start_h5_client], on_stop=[close_h5_client], name="flask-asyncio")
+
+def _shutdown():
+    _bridge.stop()
+    _proxy_client.close()
+    _subtitle_client.close()
+
+atexit.register(_shutdown)
+
 @app.route("/api/metadata")
 def get_meta():
     title = request.args.get('title')
     year = request.args.get('year', type=int)
     if not title: return jsonify({})
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(get_media_metadata(title, year=year))
+        result = _bridge.run(get_media_metadata(title, year=year))
         return jsonify(result or {})
     except Exception as e:
         print(f"Metadata error: {e}")
@@ -47,9 +63,7 @@ def get_qualities():
     
     if not title: return jsonify([])
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(get_available_qualities(title, year=year, season=season, episode=episode, is_tv=is_tv))
+        result = _bridge.run(get_available_qualities(title, year=year, season=season, episode=episode, is_tv=is_tv))
         return jsonify(result or [])
     except:
         return jsonify([])
@@ -64,9 +78,7 @@ def get_subtitles():
     
     if not title: return jsonify([])
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(get_available_subtitles(title, year=year, season=season, episode=episode, is_tv=is_tv))
+        result = _bridge.run(get_available_subtitles(title, year=year, season=season, episode=episode, is_tv=is_tv))
         return jsonify(result or [])
     except:
         return jsonify([])
@@ -91,46 +103,33 @@ def proxy_subtitle():
             'Accept': '*/*'
         }
         
-        # Follow main.py exactly with httpx
-        with httpx.Client(timeout=30.0, follow_redirects=True, verify=False) as client:
-            resp = client.get(url, headers=headers)
-            if resp.status_code >= 400:
-                print(f"DEBUG: Sub Proxy Remote Error: {resp.status_code} for {url[:50]}")
-                return f"Remote Error: {resp.status_code}", 502
-            
-            content = resp.content
-            
-            # Decoding logic from main.py
+        resp = _subtitle_client.send(_subtitle_client.build_request("GET", url, headers=headers), stream=True)
+        if resp.status_code >= 400:
+            print(f"DEBUG: Sub Proxy Remote Error: {resp.status_code} for {url[:50]}")
+            resp.close()
+            return f"Remote Error: {resp.status_code}", 502
+
+        # Convert cue by cue while the remote file is still downloading
+        def generate():
+            converter = SubtitleStreamConverter()
             try:
-                text = content.decode('utf-8-sig')
-            except UnicodeDecodeError:
-                try:
-                    text = content.decode('latin-1')
-                except:
-                    text = content.decode('utf-8', errors='ignore')
-
-            text = text.strip()
-            text = text.replace("\\N", "\n").replace("\\n", "\n")
-            is_vtt = text.startswith("WEBVTT")
-            
-            # SRT to VTT Timestamp Conversion
-            text = re.sub(r"(\d{2}:\d{2}:\d{2}),(\d{3})", r"\1.\2", text)
-            
-            # Inject positioning (line:80%)
-            text = re.sub(r"(\d{2}:\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}:\d{2}\.\d{3})", r"\1 line:80%", text)
-            
-            if not is_vtt:
-                text = "WEBVTT\n\n" + text
-
-            return Response(
-                text, 
-                mimetype="text/vtt",
-                headers={
-                    "Access-Control-Allow-Origin": "*",
-                    "Cache-Control": "no-cache",
-                    "X-Content-Type-Options": "nosniff"
-                }
-            )
+                for chunk in resp.iter_bytes():
+                    out = converter.feed(chunk)
+                    if out:
+                        yield out
+                yield converter.finish()
+            finally:
+                resp.close()
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="text/vtt",
+            headers={
+                "Access-Control-Allow-Origin": "*",
+                "Cache-Control": "no-cache",
+                "X-Content-Type-Options": "nosniff"
+            }
+        )
     except Exception as e:
         print(f"DEBUG: Sub Proxy EXCEPTION: {e}")
         traceback.print_exc()
@@ -146,9 +145,7 @@ def get_downloads_links():
     
     if not title: return jsonify([])
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        links = loop.run_until_complete(get_available_qualities_with_urls(title, year=year, season=season, episode=episode, is_tv=is_tv))
+        links = _bridge.run(get_available_qualities_with_urls(title, year=year, season=season, episode=episode, is_tv=is_tv))
         return jsonify(links or [])
     except:
         return jsonify([])
@@ -165,12 +162,16 @@ def download_proxy():
     }
     
     try:
-        r = requests.get(url, headers=headers, stream=True, timeout=10)
+        with priority(DOWNLOAD):
+            r = _proxy_client.send(_proxy_client.build_request("GET", url, headers=headers), stream=True)
         filename = f"{title.replace(' ', '_')}.mp4"
         
         def generate():
-            for chunk in r.iter_content(chunk_size=1024*1024):
-                yield chunk
+            try:
+                for chunk in r.iter_bytes(chunk_size=1024*1024):
+                    yield chunk
+            finally:
+                r.close()
 
         resp_headers = {
             "Content-Disposition": f'attachment; filename="{filename}"',
@@ -188,9 +189,7 @@ def get_tv_meta():
     year = request.args.get('year', type=int)
     if not title: return jsonify({})
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(get_media_metadata(title, year=year))
+        result = _bridge.run(get_media_metadata(title, year=year))
         return jsonify(result or {})
     except Exception as e:
         print(f"TV Metadata error: {e}")
@@ -208,9 +207,7 @@ def stream_movie():
     if not title: return "Title required", 400
 
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        stream_url = loop.run_until_complete(get_stream_url(title, quality=quality, year=year, season=season, episode=episode, is_tv=is_tv))
+        stream_url = _bridge.run(get_stream_url(title, quality=quality, year=year, season=season, episode=episode, is_tv=is_tv))
         
         if not stream_url: return "Not found", 404
 
@@ -222,11 +219,14 @@ def stream_movie():
         range_header = request.headers.get('Range')
         if range_header: headers['Range'] = range_header
 
-        r = requests.get(stream_url, headers=headers, stream=True, timeout=10)
+        r = _proxy_client.send(_proxy_client.build_request("GET", stream_url, headers=headers), stream=True)
         
         def generate():
-            for chunk in r.iter_content(chunk_size=65536):
-                yield chunk
+            try:
+                for chunk in r.iter_bytes(chunk_size=65536):
+                    yield chunk
+            finally:
+                r.close()
 
         response_headers = {
             "Content-Type": r.headers.get("Content-Type", "video/mp4"),
@@ -0,0 +1,170 @@
+"""
+metrics.py – Minimal Prometheus-style metrics (counters, gauges, histograms) for the backend.
+
+No client library needed: metrics live in process memory and render() produces the
+Prometheus text exposition format served at /metrics. Caches that already keep their
+own counters feed them in at scrape time (Counter.add_source) instead of double-counting.
+"""
+
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+# Latency buckets (seconds) sized for upstream RTTs and ffmpeg startup
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+        self._sources: list[Callable[[], dict]] = []
+
+    def inc(self, *labelvalues, amount: float = 1.0):
+        key = tuple(str(v) for v in labelvalues)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def add_source(self, fn: Callable[[], dict]):
+        """Merge in values owned elsewhere (e.g. a cache's own hit counters) at scrape time.
+
+        fn returns {labelvalues tuple: value}.
+        """
+        self._sources.append(fn)
+
+    def render(self) -> Iterable[str]:
+        values = dict(self._values)
+        for source in self._sources:
+            try:
+                for key, value in source().items():
+                    key = tuple(str(v) for v in key)
+                    values[key] = values.get(key, 0.0) + value
+            except Exception as e:
+                print(f"DEBUG: metrics source for {self.name} failed: {e}")
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {value:g}"
+
+
+class Gauge:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, *labelvalues):
+        self._values[tuple(str(v) for v in labelvalues)] = float(value)
+
+    def inc(self, *labelvalues, amount: float = 1.0):
+        key = tuple(str(v) for v in labelvalues)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, *labelvalues, amount: float = 1.0):
+        self.inc(*labelvalues, amount=-amount)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {value:g}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *labelvalues):
+        key = tuple(str(v) for v in labelvalues)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.buckets):
+            series[idx] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + (f'{bound:g}',))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + ('+Inf',))} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {series[-2]:g}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {series[-1]}"
+
+
+_metrics: list = []
+
+
+def _register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Backend metrics --------------------------------------------------------
+
+STAGE_SECONDS = _register(Histogram(
+    "movienight_stage_duration_seconds",
+    "Latency of pipeline stages (search, match, subject_download, subject_play, subtitle_proxy, transcode_startup).",
+    ("stage",),
+))
+UPSTREAM_RESPONSES = _register(Counter(
+    "movienight_upstream_responses_total",
+    "Upstream HTTP responses by endpoint and status code ('error' for transport failures).",
+    ("endpoint", "status"),
+))
+CACHE_EVENTS = _register(Counter(
+    "movienight_cache_events_total",
+    "Cache lookups by cache and result.",
+    ("cache", "result"),
+))
+ACTIVE_TRANSCODES = _register(Gauge(
+    "movienight_active_transcodes",
+    "ffmpeg transcode processes currently running.",
+))
+UPSTREAM_QUEUE_DEPTH = _register(Gauge(
+    "movienight_upstream_queue_depth",
+    "Upstream requests waiting for the governor, by priority class.",
+    ("priority",),
+))
+UPSTREAM_WAIT_SECONDS = _register(Histogram(
+    "movienight_upstream_wait_seconds",
+    "Time upstream requests waited for a governor slot, by priority class.",
+    ("priority",),
+))
+UPSTREAM_THROTTLED = _register(Counter(
+    "movienight_upstream_throttled_total",
+    "429/503 responses that made the governor back off, by host.",
+    ("host",),
+))
@@ -0,0 +1,196 @@
+"""
+mp4_probe.py – ISO-BMFF (MP4) box helpers and ranged `moov` probing.
+
+Finds the `moov` box of a remote MP4 with a few small Range requests (it may
+sit before or after `mdat`) and reads the video sample description (`stsd`)
+for the exact codec, profile, level and bit depth. Used to decide whether a
+stream needs transcoding without running ffprobe.
+"""
+
+import struct
+from dataclasses import dataclass
+
+import httpx
+
+PROBE_BYTES = 64 * 1024
+MAX_MOOV_BYTES = 32 * 1024 * 1024
+MAX_TOP_LEVEL_HOPS = 16
+
+_HEVC_PROFILES = {1: "Main", 2: "Main 10", 3: "Main Still Picture", 4: "Range Extensions"}
+_AVC_PROFILES = {66: "Baseline", 77: "Main", 88: "Extended", 100: "High", 110: "High 10", 122: "High 4:2:2", 244: "High 4:4:4"}
+_FOURCC_CODECS = {
+    "hvc1": "hevc", "hev1": "hevc", "dvh1": "hevc", "dvhe": "hevc",
+    "avc1": "h264", "avc3": "h264",
+    "av01": "av1", "vp09": "vp9", "vp08": "vp8",
+}
+
+
+def iter_boxes(data: bytes, start: int = 0, end: int | None = None, allow_truncated: bool = False):
+    """Yield (type, box_start, payload_start, box_end) for the boxes in data[start:end].
+
+    With allow_truncated, a final box running past the available data is still
+    yielded (box_end clamped), so a partially fetched container can be walked.
+    """
+    end = len(data) if end is None else min(end, len(data))
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        if pos + size > end:
+            if allow_truncated:
+                yield box_type.decode("latin-1"), pos, pos + header, end
+            return
+        yield box_type.decode("latin-1"), pos, pos + header, pos + size
+        pos += size
+
+
+def child_box(data: bytes, payload_start: int, box_end: int, wanted: str, allow_truncated: bool = False):
+    """(box_start, payload_start, box_end) of the first `wanted` child, or None."""
+    for box_type, start, payload, end in iter_boxes(data, payload_start, box_end, allow_truncated):
+        if box_type == wanted:
+            return start, payload, end
+    return None
+
+
+def child_path(data: bytes, payload_start: int, box_end: int, path: tuple, allow_truncated: bool = False):
+    """Descend through nested children, e.g. ("mdia", "minf", "stbl")."""
+    box = (None, payload_start, box_end)
+    for name in path:
+        box = child_box(data, box[1], box[2], name, allow_truncated)
+        if box is None:
+            return None
+    return box
+
+
+@dataclass
+class MoovBox:
+    data: bytes  # the whole moov box, header included (possibly truncated, see `complete`)
+    offset: int  # file offset of the moov box
+    size: int  # declared size of the moov box
+    file_size: int | None
+    complete: bool
+    top_level: list  # [(type, offset, size)] of the top-level boxes up to and including moov
+
+
+async def read_range(client: httpx.AsyncClient, url: str, headers: dict, start: int, length: int) -> tuple[bytes, int | None]:
+    """Up to `length` bytes from `start`, and the total file size if the server reports it.
+
+    Streams and stops early, so a server that ignores Range doesn't send the whole file.
+    """
+    want = length
+    body = bytearray()
+    async with client.stream("GET", url, headers={**headers, "Range": f"bytes={start}-{start + length - 1}"}) as resp:
+        if resp.status_code == 200 and start > 0:
+            raise ValueError("server ignored Range")
+        if resp.status_code not in (200, 206):
+            raise httpx.HTTPStatusError(f"status {resp.status_code}", request=resp.request, response=resp)
+        total = None
+        content_range = resp.headers.get("Content-Range", "")
+        if "/" in content_range and not content_range.endswith("*"):
+            total = int(content_range.rsplit("/", 1)[1])
+        elif resp.status_code == 200 and resp.headers.get("Content-Length"):
+            total = int(resp.headers["Content-Length"])
+        async for chunk in resp.aiter_bytes():
+            body.extend(chunk)
+            if len(body) >= want:
+                break
+    return bytes(body[:want]), total
+
+
+async def fetch_moov(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: dict,
+    probe_bytes: int = PROBE_BYTES,
+    max_moov_bytes: int = MAX_MOOV_BYTES,
+) -> MoovBox | None:
+    """Locate and fetch the moov box by hopping over top-level boxes with ranged reads."""
+    buf, buf_start = b"", 0
+    file_size = None
+    offset = 0
+    top_level = []
+    for _ in range(MAX_TOP_LEVEL_HOPS):
+        if file_size is not None and offset >= file_size:
+            return None
+        rel = offset - buf_start
+        if rel < 0 or rel + 16 > len(buf):
+            buf, size_hint = await read_range(client, url, headers, offset, probe_bytes)
+            buf_start, rel = offset, 0
+            file_size = file_size or size_hint
+            if len(buf) < 8:
+                return None
+        size, box_type = struct.unpack_from(">I4s", buf, rel)
+        if size == 1:
+            size = struct.unpack_from(">Q", buf, rel + 8)[0]
+        elif size == 0:
+            if file_size is None:
+                return None
+            size = file_size - offset
+        if size < 8:
+            return None
+        top_level.append((box_type.decode("latin-1"), offset, size))
+        if box_type == b"moov":
+            want = min(size, max_moov_bytes)
+            if rel + want <= len(buf):
+                data = buf[rel:rel + want]
+            else:
+                data, size_hint = await read_range(client, url, headers, offset, want)
+                file_size = file_size or size_hint
+            return MoovBox(data=data, offset=offset, size=size, file_size=file_size, complete=len(data) >= size, top_level=top_level)
+        offset += size
+    return None
+
+
+def find_video_trak(moov: bytes, allow_truncated: bool = True):
+    """(box_start, payload_start, box_end) of the first video trak in a moov box."""
+    top = next(iter_boxes(moov, 0, None, allow_truncated), None)
+    if top is None or top[0] != "moov":
+        return None
+    for box_type, start, payload, end in iter_boxes(moov, top[2], top[3], allow_truncated):
+        if box_type != "trak":
+            continue
+        hdlr = child_path(moov, payload, end, ("mdia", "hdlr"), allow_truncated)
+        if hdlr and moov[hdlr[1] + 8:hdlr[1] + 12] == b"vide":
+            return start, payload, end
+    return None
+
+
+def parse_video_codec(moov: bytes) -> dict | None:
+    """Codec details from the first video sample entry in a (possibly truncated) moov box."""
+    trak = find_video_trak(moov)
+    if trak is None:
+        return None
+    stsd = child_path(moov, trak[1], trak[2], ("mdia", "minf", "stbl", "stsd"), allow_truncated=True)
+    if stsd is None:
+        return None
+    # stsd: version/flags (4) + entry_count (4), then sample entries
+    entry = next(iter_boxes(moov, stsd[1] + 8, stsd[2], allow_truncated=True), None)
+    if entry is None:
+        return None
+    fourcc, _, payload, end = entry
+    info = {"fourcc": fourcc, "codec": _FOURCC_CODECS.get(fourcc, fourcc), "profile": None, "level": None, "bit_depth": 8}
+    # VisualSampleEntry: 6 reserved + 2 dref + 16 predefined + width/height at +24/+26; children start at +78
+    if payload + 28 <= end:
+        info["width"], info["height"] = struct.unpack_from(">HH", moov, payload + 24)
+    for box_type, _, cfg, cfg_end in iter_boxes(moov, payload + 78, end, allow_truncated=True):
+        if box_type == "hvcC" and cfg + 19 <= cfg_end:
+            profile_idc = moov[cfg + 1] & 0x1F
+            info["profile"] = _HEVC_PROFILES.get(profile_idc, str(profile_idc))
+            info["level"] = moov[cfg + 12] / 30
+            info["bit_depth"] = (moov[cfg + 17] & 0x07) + 8
+        elif box_type == "avcC" and cfg + 4 <= cfg_end:
+            profile_idc = moov[cfg + 1]
+            info["profile"] = _AVC_PROFILES.get(profile_idc, str(profile_idc))
+            info["level"] = moov[cfg + 3] / 10
+            if profile_idc in (110, 122, 244):
+                info["bit_depth"] = 10
+    return info
@@ -0,0 +1,161 @@
+"""
+prefetch.py – Background next-episode resolution for TV playback.
+
+When an episode starts streaming, the following episode is resolved in the
+background (search match, /subject/download, subtitle conversion) so that
+"next episode" is served from cache. Prefetches are delayed, bounded in
+concurrency, yield to in-flight interactive resolutions, and cancellable.
+
+Only subtitles in the language the viewer last picked are converted (for that
+title, else the last one picked anywhere), falling back to
+PREFETCH_SUBTITLE_LANGS; a season can list 20+ languages per episode.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from api_service import SUBTITLE_LANG_MAP, get_media_metadata, get_movie_files, has_inflight_resolutions
+from upstream_governor import PREFETCH, upstream_priority
+
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_DELAY = float(os.environ.get("PREFETCH_DELAY", "20"))          # seconds after playback starts
+PREFETCH_CONCURRENCY = int(os.environ.get("PREFETCH_CONCURRENCY", "1"))
+PREFETCH_IDLE_POLL = 0.5
+PREFETCH_MAX_IDLE_WAIT = 60.0
+# Language codes or names ("en,fr" / "English"); empty disables subtitle prefetch when no choice is known
+PREFETCH_SUBTITLE_LANGS = [l.strip().lower() for l in os.environ.get("PREFETCH_SUBTITLE_LANGS", "en").split(",") if l.strip()]
+LAST_LANGUAGE_TITLES = 512
+
+
+async def next_episode(title: str, year: int, season: int, episode: int) -> tuple[int, int] | None:
+    """(season, episode) following the given one, using the season bounds from get_media_metadata."""
+    meta = await get_media_metadata(title, year=year)
+    if not meta or not meta.get("is_tv"):
+        return None
+    seasons = {s["season"]: s["episodes_count"] for s in meta.get("seasons", [])}
+    if episode < seasons.get(season, 0):
+        return season, episode + 1
+    later = sorted(s for s in seasons if s > season)
+    if later:
+        return later[0], 1
+    return None
+
+
+class EpisodePrefetcher:
+    """Schedules low-priority background resolution of the next episode."""
+
+    def __init__(
+        self,
+        warm_stream: Callable[[tuple, list], None] | None = None,
+        warm_subtitle: Callable[[str], Awaitable[object]] | None = None,
+        delay: float = PREFETCH_DELAY,
+        concurrency: int = PREFETCH_CONCURRENCY,
+        subtitle_langs: list[str] = PREFETCH_SUBTITLE_LANGS,
+    ):
+        self.warm_stream = warm_stream
+        self.warm_subtitle = warm_subtitle
+        self.delay = delay
+        self.subtitle_langs = list(subtitle_langs)
+        self._last_language: OrderedDict[str, str] = OrderedDict()  # title ("" = any title) -> language
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: dict[tuple, asyncio.Task] = {}
+        self.stats_counters = {"scheduled": 0, "completed": 0, "failed": 0, "cancelled": 0, "skipped": 0}
+
+    def schedule(self, title: str, year: int, season: int, episode: int, is_tv: bool) -> bool:
+        """Queue a prefetch of the episode after (season, episode). Returns False if already queued or disabled."""
+        if not PREFETCH_ENABLED or not is_tv:
+            return False
+        key = ((title or "").strip().lower(), year, season, episode)
+        if key in self._tasks:
+            return False
+        self.stats_counters["scheduled"] += 1
+        task = asyncio.create_task(self._run(title, year, season, episode))
+        self._tasks[key] = task
+        task.add_done_callback(lambda t, key=key: self._tasks.pop(key, None))
+        return True
+
+    def cancel(self, title: str, year: int, season: int, episode: int) -> bool:
+        task = self._tasks.get(((title or "").strip().lower(), year, season, episode))
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    def note_subtitle_language(self, title: str | None, language: str | None):
+        """Remember the subtitle language the viewer picked, for this title and as the general default."""
+        language = (language or "").strip().lower()
+        if not language:
+            return
+        for key in {(title or "").strip().lower(), ""}:
+            self._last_language[key] = language
+            self._last_language.move_to_end(key)
+        while len(self._last_language) > LAST_LANGUAGE_TITLES:
+            self._last_language.popitem(last=False)
+
+    def _subtitles_to_warm(self, title: str, subtitles: list) -> list:
+        key = (title or "").strip().lower()
+        last = self._last_language.get(key) or self._last_language.get("")
+        wanted = {last} if last else set(self.subtitle_langs)
+        picked = []
+        for sub in subtitles or []:
+            code = (sub.get("lan") or "").lower()
+            names = {code, (sub.get("lanName") or "").lower(), SUBTITLE_LANG_MAP.get(code, "").lower()}
+            if wanted & (names - {""}):
+                picked.append(sub)
+        return picked
+
+    async def close(self):
+        """Cancel every pending prefetch and wait for them to unwind."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _wait_for_idle(self):
+        # Interactive resolutions go first; give up waiting after a while rather than starve forever
+        waited = 0.0
+        while has_inflight_resolutions() and waited < PREFETCH_MAX_IDLE_WAIT:
+            await asyncio.sleep(PREFETCH_IDLE_POLL)
+            waited += PREFETCH_IDLE_POLL
+
+    async def _run(self, title: str, year: int, season: int, episode: int):
+        # This task's upstream calls queue behind interactive playback
+        upstream_priority.set(PREFETCH)
+        try:
+            await asyncio.sleep(self.delay)
+            async with self._slots:
+                await self._wait_for_idle()
+                nxt = await next_episode(title, year, season, episode)
+                if nxt is None:
+                    self.stats_counters["skipped"] += 1
+                    return
+                n_season, n_episode = nxt
+
+                await self._wait_for_idle()
+                downloads, subtitles = await get_movie_files(title, year, n_season, n_episode, is_tv=True)
+                if not downloads:
+                    self.stats_counters["failed"] += 1
+                    return
+                if self.warm_stream:
+                    self.warm_stream((title, year, n_season, n_episode, True), downloads)
+
+                for sub in self._subtitles_to_warm(title, subtitles) if self.warm_subtitle else []:
+                    await self._wait_for_idle()
+                    try:
+                        await self.warm_subtitle(sub["url"])
+                    except Exception as e:
+                        print(f"DEBUG: Prefetch subtitle warm failed: {e}")
+
+                print(f"DEBUG: Prefetched '{title}' S{n_season}E{n_episode} ({len(downloads)} streams)")
+                self.stats_counters["completed"] += 1
+        except asyncio.CancelledError:
+            self.stats_counters["cancelled"] += 1
+            raise
+        except Exception as e:
+            self.stats_counters["failed"] += 1
+            print(f"DEBUG: Prefetch error for '{title}': {e}")
+
+    def stats(self) -> dict:
+        return {**self.stats_counters, "pending": len(self._tasks)}
@@ -0,0 +1,236 @@
+"""
+seek_index.py – Keyframe time -> byte offset index for remote MP4 files.
+
+The moov box is fetched once with ranged reads (see mp4_probe) and the video
+track's sample tables (stts/ctts/stss/stsc/stsz/stco|co64, plus the edit list)
+are reduced to two compact arrays: keyframe presentation times (decode time
+plus the ctts composition offset) and file offsets. The per-sample walk runs in
+a worker thread. Indexes are cached per resource (CDN path) and concurrent
+builds are shared.
+
+The index is served by /api/stream/seekmap and has no other consumer. The
+transcode path doesn't use it: ffmpeg can't begin demuxing an MP4 at a raw
+byte offset without the moov, and its input -ss already seeks through the
+moov to the keyframe before the requested time.
+"""
+
+import asyncio
+import bisect
+import os
+import struct
+from array import array
+from collections import OrderedDict
+
+import httpx
+
+from mp4_probe import child_box, child_path, fetch_moov, find_video_trak
+from stream_url_cache import source_identity
+
+SEEK_INDEX_CACHE_SIZE = int(os.environ.get("SEEK_INDEX_CACHE_SIZE", "256"))
+NO_STSS_SPACING = 1.0  # seconds between index points when every sample is a sync sample
+
+
+class KeyframeIndex:
+    def __init__(self, times: array, offsets: array, duration: float, moov_offset: int, moov_size: int, file_size: int | None):
+        self.times = times
+        self.offsets = offsets
+        self.duration = duration
+        self.moov_offset = moov_offset
+        self.moov_size = moov_size
+        self.file_size = file_size
+
+    @property
+    def moov_at_end(self) -> bool:
+        return bool(self.offsets) and self.moov_offset > self.offsets[0]
+
+    def keyframe_before(self, seconds: float) -> tuple[float, int] | None:
+        """(time, byte offset) of the last keyframe at or before `seconds`."""
+        if not self.times:
+            return None
+        idx = max(0, bisect.bisect_right(self.times, seconds) - 1)
+        return self.times[idx], self.offsets[idx]
+
+    def to_dict(self) -> dict:
+        return {
+            "duration": round(self.duration, 3),
+            "file_size": self.file_size,
+            "moov": {"offset": self.moov_offset, "size": self.moov_size, "at_end": self.moov_at_end},
+            "keyframes": len(self.times),
+            "times": [round(t, 3) for t in self.times],
+            "offsets": list(self.offsets),
+        }
+
+
+def _full_box_entries(data: bytes, box) -> tuple[int, int]:
+    """(entry_count, first_entry_pos) of a full box whose payload starts with version/flags + count."""
+    return struct.unpack_from(">I", data, box[1] + 4)[0], box[1] + 8
+
+
+def build_keyframe_index(moov: bytes, moov_offset: int = 0, file_size: int | None = None) -> KeyframeIndex | None:
+    """Parse the video trak of a complete moov box into a KeyframeIndex."""
+    trak = find_video_trak(moov, allow_truncated=False)
+    if trak is None:
+        return None
+    mdhd = child_path(moov, trak[1], trak[2], ("mdia", "mdhd"))
+    stbl = child_path(moov, trak[1], trak[2], ("mdia", "minf", "stbl"))
+    if mdhd is None or stbl is None:
+        return None
+    version = moov[mdhd[1]]
+    if version == 1:
+        timescale, duration = struct.unpack_from(">IQ", moov, mdhd[1] + 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", moov, mdhd[1] + 12)
+    if not timescale:
+        return None
+
+    def table(name):
+        return child_box(moov, stbl[1], stbl[2], name)
+
+    stts, stsc, stsz, stss = table("stts"), table("stsc"), table("stsz"), table("stss")
+    chunk_box, offset_fmt = table("stco"), ">I"
+    if chunk_box is None:
+        chunk_box, offset_fmt = table("co64"), ">Q"
+    if None in (stts, stsc, stsz, chunk_box):
+        return None
+
+    # Edit list: media time where presentation starts (first non-empty edit)
+    media_start = 0
+    elst = child_path(moov, trak[1], trak[2], ("edts", "elst"))
+    if elst is not None:
+        count, pos = _full_box_entries(moov, elst)
+        wide = moov[elst[1]] == 1
+        for _ in range(count):
+            media_time = struct.unpack_from(">q" if wide else ">i", moov, pos + (8 if wide else 4))[0]
+            pos += 20 if wide else 12
+            if media_time >= 0:
+                media_start = media_time
+                break
+
+    chunk_count, pos = _full_box_entries(moov, chunk_box)
+    step = 8 if offset_fmt == ">Q" else 4
+    chunk_offsets = [struct.unpack_from(offset_fmt, moov, pos + i * step)[0] for i in range(chunk_count)]
+
+    uniform_size, sample_count = struct.unpack_from(">II", moov, stsz[1] + 4)
+    sizes_pos = stsz[1] + 12
+
+    stsc_count, stsc_pos = _full_box_entries(moov, stsc)
+    stsc_entries = [struct.unpack_from(">III", moov, stsc_pos + i * 12)[:2] for i in range(stsc_count)]
+
+    stts_count, stts_pos = _full_box_entries(moov, stts)
+    stts_entries = [struct.unpack_from(">II", moov, stts_pos + i * 8) for i in range(stts_count)]
+
+    # Composition offsets (B-frames): presentation time = decode time + offset
+    ctts_entries = []
+    ctts = table("ctts")
+    if ctts is not None:
+        ctts_count, ctts_pos = _full_box_entries(moov, ctts)
+        ctts_fmt = ">Ii" if moov[ctts[1]] == 1 else ">II"
+        ctts_entries = [struct.unpack_from(ctts_fmt, moov, ctts_pos + i * 8) for i in range(ctts_count)]
+
+    sync = None
+    if stss is not None:
+        sync_count, sync_pos = _full_box_entries(moov, stss)
+        sync = set(struct.unpack_from(f">{sync_count}I", moov, sync_pos))
+
+    times, offsets = array("d"), array("q")
+    sample = 1  # 1-based sample number
+    decode_time = 0
+    stts_idx, stts_left = 0, stts_entries[0][0] if stts_entries else 0
+    ctts_idx, ctts_left = 0, ctts_entries[0][0] if ctts_entries else 0
+    last_point = -NO_STSS_SPACING
+    for i, (first_chunk, per_chunk) in enumerate(stsc_entries):
+        last_chunk = stsc_entries[i + 1][0] - 1 if i + 1 < len(stsc_entries) else chunk_count
+        for chunk in range(first_chunk, last_chunk + 1):
+            if chunk - 1 >= chunk_count:
+                break
+            offset = chunk_offsets[chunk - 1]
+            for _ in range(per_chunk):
+                if sample > sample_count:
+                    break
+                size = uniform_size or struct.unpack_from(">I", moov, sizes_pos + (sample - 1) * 4)[0]
+                while ctts_left == 0 and ctts_idx + 1 < len(ctts_entries):
+                    ctts_idx += 1
+                    ctts_left = ctts_entries[ctts_idx][0]
+                composition = 0
+                if ctts_left:
+                    composition = ctts_entries[ctts_idx][1]
+                    ctts_left -= 1
+                seconds = (decode_time + composition - media_start) / timescale
+                if (sample in sync) if sync is not None else (seconds - last_point >= NO_STSS_SPACING):
+                    times.append(max(0.0, seconds))
+                    offsets.append(offset)
+                    last_point = seconds
+                offset += size
+                sample += 1
+                while stts_left == 0 and stts_idx + 1 < len(stts_entries):
+                    stts_idx += 1
+                    stts_left = stts_entries[stts_idx][0]
+                if stts_left:
+                    decode_time += stts_entries[stts_idx][1]
+                    stts_left -= 1
+
+    moov_size = struct.unpack_from(">I", moov, 0)[0]
+    if moov_size == 1:
+        moov_size = struct.unpack_from(">Q", moov, 8)[0]
+    return KeyframeIndex(times, offsets, max(0.0, (duration - media_start) / timescale), moov_offset, moov_size, file_size)
+
+
+class SeekIndexCache:
+    """Per-resource cache of keyframe indexes, built on first use from a ranged moov fetch."""
+
+    def __init__(self, client_factory, headers: dict, max_entries: int = SEEK_INDEX_CACHE_SIZE):
+        self._client_factory = client_factory
+        self._headers = headers
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, KeyframeIndex | None] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.builds = 0
+        self.failures = 0
+
+    async def get(self, url: str) -> KeyframeIndex | None:
+        key = source_identity(url)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        task = self._inflight.get(key)
+        loop = asyncio.get_running_loop()
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(self._build(key, url))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._inflight.get(key) is t and self._inflight.pop(key))
+        return await asyncio.shield(task)
+
+    async def _build(self, key: str, url: str) -> KeyframeIndex | None:
+        try:
+            moov = await fetch_moov(self._client_factory(), url, self._headers)
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"DEBUG: Seek index fetch failed for {url[:80]}: {e}")
+            self.failures += 1
+            return None  # transient: not cached
+        index = None
+        if moov is not None and moov.complete:
+            try:
+                # A per-sample Python walk over the tables: keep it off the event loop
+                index = await asyncio.to_thread(build_keyframe_index, moov.data, moov.offset, moov.file_size)
+            except struct.error as e:
+                print(f"DEBUG: Seek index parse failed for {url[:80]}: {e}")
+        if index is None:
+            self.failures += 1
+        else:
+            self.builds += 1
+        # A file without a usable index won't grow one: cache the miss too
+        self._entries[key] = index
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return index
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "builds": self.builds,
+            "failures": self.failures,
+            "inflight": len(self._inflight),
+        }
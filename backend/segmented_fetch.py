@@ -0,0 +1,173 @@
+"""
+segmented_fetch.py – Multi-connection ranged download of one upstream file.
+
+The MovieBox CDN throttles per connection, so the download proxy can fetch
+several byte ranges concurrently and stream them to the client in order.
+Segments land in a bounded reorder buffer (at most `max_ahead` segments past
+the one being sent), and the number of parallel connections adapts to the
+measured aggregate throughput.
+"""
+
+import asyncio
+import os
+import re
+import time
+
+import httpx
+
+SEGMENT_SIZE = int(os.environ.get("DOWNLOAD_SEGMENT_SIZE", str(2 * 1024 * 1024)))
+MIN_CONNECTIONS = int(os.environ.get("DOWNLOAD_MIN_CONNECTIONS", "2"))
+MAX_CONNECTIONS = int(os.environ.get("DOWNLOAD_MAX_CONNECTIONS", "6"))
+SEGMENT_RETRIES = 3
+
+_CONTENT_RANGE_RE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+_RANGE_RE = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+
+def parse_range_header(value: str | None):
+    """Parse a single 'bytes=a-' / 'bytes=a-b' Range header.
+
+    Returns None when absent, (start, end_or_None) when supported, False for
+    anything else (suffix or multi-range requests).
+    """
+    if not value:
+        return None
+    m = _RANGE_RE.match(value.strip())
+    if not m:
+        return False
+    start = int(m.group(1))
+    end = int(m.group(2)) if m.group(2) else None
+    if end is not None and end < start:
+        return False
+    return start, end
+
+
+def parse_content_range(value: str | None) -> tuple[int, int, int | None] | None:
+    """'bytes 0-99/1000' -> (0, 99, 1000); total is None for '*'."""
+    m = _CONTENT_RANGE_RE.match(value or "")
+    if not m:
+        return None
+    total = None if m.group(3) == "*" else int(m.group(3))
+    return int(m.group(1)), int(m.group(2)), total
+
+
+async def fetch_range(client: httpx.AsyncClient, url: str, headers: dict, start: int, end: int) -> tuple[bytes, httpx.Headers]:
+    """Bytes [start, end] of `url` (fewer if the file ends first) and the response headers.
+
+    Streams the response and checks for a 206 with a matching Content-Range
+    before reading the body, so a server that ignores Range and answers 200
+    doesn't get the whole file read into memory.
+    """
+    body = bytearray()
+    async with client.stream("GET", url, headers={**headers, "Range": f"bytes={start}-{end}"}) as resp:
+        content_range = parse_content_range(resp.headers.get("Content-Range"))
+        if resp.status_code != 206 or content_range is None or content_range[0] != start:
+            raise httpx.HTTPStatusError(
+                f"expected 206 for bytes {start}-{end}, got {resp.status_code} {resp.headers.get('Content-Range')}",
+                request=resp.request, response=resp,
+            )
+        want = min(end, content_range[1]) - start + 1
+        async for chunk in resp.aiter_bytes():
+            body.extend(chunk)
+            if len(body) >= want:
+                break
+    if len(body) < want:
+        raise ValueError(f"short range {len(body)}/{want} bytes")
+    return bytes(body[:want]), resp.headers
+
+
+class SegmentedFetcher:
+    """Fetch bytes [start, end] of `url` over several connections, yielding them in order."""
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        headers: dict,
+        start: int,
+        end: int,
+        segment_size: int = SEGMENT_SIZE,
+        min_connections: int = MIN_CONNECTIONS,
+        max_connections: int = MAX_CONNECTIONS,
+        max_ahead: int | None = None,
+    ):
+        self.client = client
+        self.url = url
+        self.headers = headers
+        self.segments = [
+            (s, min(s + segment_size - 1, end)) for s in range(start, end + 1, segment_size)
+        ]
+        self.min_connections = max(1, min_connections)
+        self.max_connections = max(self.min_connections, max_connections)
+        self.connections = self.min_connections
+        # Reorder buffer bound: memory stays under max_ahead * segment_size
+        self.max_ahead = max_ahead or self.max_connections * 2
+        self._window_bytes = 0
+        self._window_started = time.monotonic()
+        self._last_rate = 0.0
+        self._window_segments = 0
+
+    async def _fetch_segment(self, idx: int) -> bytes:
+        seg_start, seg_end = self.segments[idx]
+        expected = seg_end - seg_start + 1
+        last_error = None
+        for attempt in range(SEGMENT_RETRIES):
+            try:
+                data, _ = await fetch_range(self.client, self.url, self.headers, seg_start, seg_end)
+                if len(data) != expected:
+                    raise ValueError(f"short segment {len(data)}/{expected} bytes")
+                self._record(len(data))
+                return data
+            except (httpx.HTTPError, ValueError) as e:
+                last_error = e
+                await asyncio.sleep(0.5 * (attempt + 1))
+        raise RuntimeError(f"segment {seg_start}-{seg_end} failed: {last_error}")
+
+    def _record(self, nbytes: int):
+        """Adapt the connection count to aggregate throughput, one window per `connections` segments."""
+        self._window_bytes += nbytes
+        self._window_segments += 1
+        if self._window_segments < self.connections:
+            return
+        now = time.monotonic()
+        rate = self._window_bytes / max(now - self._window_started, 1e-6)
+        if self._last_rate:
+            if rate > self._last_rate * 1.1 and self.connections < self.max_connections:
+                self.connections += 1
+            elif rate < self._last_rate * 0.8 and self.connections > self.min_connections:
+                self.connections -= 1
+        elif self.connections < self.max_connections:
+            self.connections += 1
+        self._last_rate = rate
+        self._window_bytes = 0
+        self._window_segments = 0
+        self._window_started = now
+
+    async def stream(self):
+        """Yield the requested byte range in order."""
+        pending: dict[int, asyncio.Task] = {}
+        next_idx = 0
+        emit_idx = 0
+        total = len(self.segments)
+        try:
+            while emit_idx < total:
+                active = sum(1 for t in pending.values() if not t.done())
+                while next_idx < total and active < self.connections and next_idx - emit_idx < self.max_ahead:
+                    pending[next_idx] = asyncio.create_task(self._fetch_segment(next_idx))
+                    next_idx += 1
+                    active += 1
+
+                head = pending[emit_idx]
+                if not head.done():
+                    # Wake on any completion so freed connections are refilled while waiting for the head
+                    await asyncio.wait([t for t in pending.values() if not t.done()], return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                data = head.result()
+                del pending[emit_idx]
+                emit_idx += 1
+                yield data
+        finally:
+            for task in pending.values():
+                task.cancel()
+            await asyncio.gather(*pending.values(), return_exceptions=True)
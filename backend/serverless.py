@@ -0,0 +1,237 @@
+"""
+serverless.py – Cold-start friendly ASGI app for the Vercel entrypoint (api/index.py).
+
+Importing main.py pulls in FastAPI, uvicorn and all of the streaming,
+proxying and transcoding machinery, which is most of a cold start. This app
+answers /health (and CORS preflights) with the standard library only, serves
+the JSON lookup endpoints with api_service alone, and imports the full
+FastAPI app on the first request that needs it (streams, proxies, HLS,
+subtitles, the frontend). Keep the module-level imports here to the standard
+library; `import_profile.py` checks the budget.
+
+When the server runs the ASGI lifespan protocol (uvicorn does), main.py's
+lifespan is started when the full app is first loaded and shut down with
+ours, so its URL-cache sweeper, stream client, transcoders and HLS cache are
+set up and closed as usual. A runtime that sends no lifespan events leaves
+it unstarted, as it would for main.app itself.
+"""
+
+import json
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+if BACKEND_DIR not in sys.path:
+    # Ahead of api/, which has stale copies of main.py and api_service.py
+    sys.path.insert(0, BACKEND_DIR)
+
+if os.environ.get("VERCEL"):
+    # Warm instances reuse the H5 token instead of bootstrapping it on every cold start
+    os.environ.setdefault("H5_TOKEN_FILE", "/tmp/movienight-h5-token.json")
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"*"),
+    (b"access-control-allow-headers", b"*"),
+]
+
+# path -> api_service function taking (title, year=, season=, episode=, is_tv=)
+EPISODE_LOOKUPS = {
+    "/api/qualities": "get_available_qualities",
+    "/api/subtitles": "get_available_subtitles",
+    "/api/downloads": "get_available_qualities_with_urls",
+}
+
+_full_app = None
+_client_loop = None
+_lifespan_scope = None  # the server's lifespan scope, once it has started us
+_full_lifespan = None  # task starting main.app's lifespan -> _ForwardedLifespan
+
+
+class _BadParam(Exception):
+    pass
+
+
+def _query(scope) -> dict:
+    from urllib.parse import parse_qsl
+    return dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+
+
+def _int(query: dict, name: str, default=None):
+    value = query.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise _BadParam(f"{name} must be an integer")
+
+
+def _bool(query: dict, name: str):
+    value = query.get(name)
+    if value is None or value == "":
+        return None
+    lowered = value.lower()
+    if lowered in ("1", "true", "yes", "on"):
+        return True
+    if lowered in ("0", "false", "no", "off"):
+        return False
+    raise _BadParam(f"{name} must be a boolean")
+
+
+async def _send_json(send, status: int, body):
+    payload = json.dumps(body).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode()), *CORS_HEADERS],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def _ensure_h5_client():
+    """Pooled H5 client bound to the running loop (no lifespan runs here to create it)."""
+    global _client_loop
+    import asyncio
+    from api_service import close_h5_client, start_h5_client
+    loop = asyncio.get_running_loop()
+    if _client_loop is not loop:
+        if _client_loop is not None:
+            try:
+                await close_h5_client()  # pooled on a previous invocation's loop
+            except Exception:
+                pass
+        _client_loop = loop
+    await start_h5_client()
+
+
+async def _metadata(query: dict):
+    from api_service import get_media_metadata
+    try:
+        return await get_media_metadata(query["title"], year=_int(query, "year"))
+    except _BadParam:
+        raise
+    except Exception:
+        return {}
+
+
+async def _episode_lookup(path: str, query: dict):
+    import api_service
+    lookup = getattr(api_service, EPISODE_LOOKUPS[path])
+    kwargs = {
+        "year": _int(query, "year"),
+        "season": _int(query, "season", 1),
+        "episode": _int(query, "episode", 1),
+        "is_tv": _bool(query, "is_tv"),
+    }
+    try:
+        return await lookup(query["title"], **kwargs)
+    except Exception as e:
+        print(f"Lookup error ({path}): {e}")
+        return []
+
+
+class _ForwardedLifespan:
+    """main.app's lifespan protocol, driven from ours."""
+
+    def __init__(self, app, scope):
+        import asyncio
+        self._inbox = asyncio.Queue()
+        self._replies = asyncio.Queue()
+        self._task = asyncio.create_task(app(dict(scope), self._inbox.get, self._replies.put))
+
+    async def _step(self, event: str) -> dict:
+        import asyncio
+        await self._inbox.put({"type": f"lifespan.{event}"})
+        reply = asyncio.ensure_future(self._replies.get())
+        await asyncio.wait({reply, self._task}, return_when=asyncio.FIRST_COMPLETED)
+        if reply.done():
+            return reply.result()
+        reply.cancel()
+        error = self._task.exception() if not self._task.cancelled() else None
+        return {"type": f"lifespan.{event}.failed", "message": repr(error)}
+
+    async def startup(self):
+        reply = await self._step("startup")
+        if reply["type"] != "lifespan.startup.complete":
+            raise RuntimeError(f"main.app startup failed: {reply.get('message', '')}")
+
+    async def shutdown(self):
+        reply = await self._step("shutdown")
+        if reply["type"] != "lifespan.shutdown.complete":
+            print(f"DEBUG: main.app shutdown failed: {reply.get('message', '')}")
+
+
+async def _start_full_lifespan(app) -> _ForwardedLifespan:
+    forwarded = _ForwardedLifespan(app, _lifespan_scope)
+    await forwarded.startup()
+    return forwarded
+
+
+async def _lifespan(scope, receive, send):
+    # The JSON handlers create the pooled H5 client on demand; main.app's lifespan starts with the full app
+    global _lifespan_scope
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _lifespan_scope = scope
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _full_lifespan is not None:
+                try:
+                    await (await _full_lifespan).shutdown()
+                except Exception as e:
+                    print(f"DEBUG: main.app lifespan not shut down: {e}")
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def load_full_app():
+    """The complete FastAPI app from main.py (imported once, on first use)."""
+    global _full_app
+    if _full_app is None:
+        from main import app
+        _full_app = app
+    return _full_app
+
+
+async def _started_full_app():
+    """The full app, with its lifespan started first when the server runs ours."""
+    global _full_lifespan
+    import asyncio
+    full = load_full_app()
+    if _lifespan_scope is not None:
+        if _full_lifespan is None:
+            _full_lifespan = asyncio.ensure_future(_start_full_lifespan(full))
+        await asyncio.shield(_full_lifespan)
+    return full
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(scope, receive, send)
+    if scope["type"] == "http":
+        method, path = scope["method"], scope["path"]
+        if method == "OPTIONS":
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-length", b"0"), *CORS_HEADERS]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if method == "GET" and path in ("/health", "/api/health"):
+            return await _send_json(send, 200, {"status": "ok", "service": "movie-night-backend"})
+        if method == "GET" and (path == "/api/metadata" or path in EPISODE_LOOKUPS):
+            query = _query(scope)
+            empty = {} if path == "/api/metadata" else []
+            try:
+                if "title" not in query:
+                    raise _BadParam("title is required")
+                if not query["title"]:
+                    return await _send_json(send, 200, empty)
+                await _ensure_h5_client()
+                if path == "/api/metadata":
+                    result = await _metadata(query)
+                else:
+                    result = await _episode_lookup(path, query)
+            except _BadParam as e:
+                return await _send_json(send, 422, {"detail": str(e)})
+            return await _send_json(send, 200, result if result is not None else empty)
+    await (await _started_full_app())(scope, receive, send)
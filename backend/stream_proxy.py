@@ -0,0 +1,167 @@
+"""
+stream_proxy.py – Async read-ahead proxy for clients that can't reach the CDN.
+
+The upstream response (Range forwarded) is read by a background task into a
+bounded buffer of PROXY_READAHEAD_BYTES, so a short stall on either side
+doesn't stall the other; once the buffer is full the upstream read pauses
+until the client catches up. When the client goes away the reader task is
+cancelled and the upstream connection closed straight away, instead of the
+proxy draining the rest of the file. The reader starts as soon as the headers
+are in; if the response body is never iterated (the client left before it
+started) a watchdog cancels it after PROXY_START_TIMEOUT, so the connection is
+still released.
+
+File sizes seen in upstream responses are remembered per resource, so later
+ranges can be served through the fan-out hub (see main.py), where
+`iter_range()` opens the upstream lazily, inside the shared feed.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+
+import httpx
+
+from segmented_fetch import parse_content_range
+from stream_url_cache import source_identity
+
+PROXY_READAHEAD_BYTES = int(os.environ.get("PROXY_READAHEAD_BYTES", str(8 * 1024 * 1024)))
+PROXY_CHUNK_BYTES = 256 * 1024
+PROXY_START_TIMEOUT = 10.0  # seconds between open() and the first read before the upstream is dropped
+SIZE_MAP_SIZE = 4096
+# Upstream headers relayed to the client (Content-Length only when the body isn't re-encoded)
+RELAY_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified")
+
+_EOF = object()
+
+
+class ProxiedStream:
+    """An open upstream response plus its read-ahead buffer."""
+
+    def __init__(self, proxy: "ReadAheadProxy", response: httpx.Response):
+        self.proxy = proxy
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = {name: response.headers[name] for name in RELAY_HEADERS if name in response.headers}
+        if response.headers.get("Content-Encoding"):
+            self.headers.pop("Content-Length", None)
+        slots = max(1, proxy.readahead // proxy.chunk_size)
+        self._buffer: asyncio.Queue = asyncio.Queue(maxsize=slots)
+        self._started = False
+        self._reader = asyncio.create_task(self._read_upstream())
+        self._watchdog = asyncio.get_running_loop().call_later(PROXY_START_TIMEOUT, self._abandon)
+
+    def _abandon(self):
+        if not self._started:
+            self.proxy.counters["abandoned"] += 1
+            self.discard()
+
+    def discard(self):
+        """Drop the upstream response without reading it (the reader task closes it)."""
+        self._watchdog.cancel()
+        self._reader.cancel()
+
+    async def _read_upstream(self):
+        try:
+            async for chunk in self.response.aiter_bytes(self.proxy.chunk_size):
+                await self._buffer.put(chunk)
+                self.proxy.counters["bytes_read"] += len(chunk)
+            await self._buffer.put(_EOF)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._buffer.put(e)
+        finally:
+            # Closing here, in our own task, also works when the request's task is being cancelled
+            await self.response.aclose()
+
+    async def iter_bytes(self):
+        self._started = True
+        self._watchdog.cancel()
+        self.proxy.active += 1
+        finished = False
+        try:
+            while True:
+                item = await self._buffer.get()
+                if item is _EOF:
+                    finished = True
+                    return
+                if isinstance(item, Exception):
+                    print(f"DEBUG: Stream proxy upstream error: {item}")
+                    self.proxy.counters["upstream_errors"] += 1
+                    finished = True
+                    raise item
+                self.proxy.counters["bytes_sent"] += len(item)
+                yield item
+        finally:
+            # Synchronous: runs when the client disconnects, possibly while the request is being cancelled
+            self.proxy.active -= 1
+            if not finished:
+                self.proxy.counters["client_disconnects"] += 1
+            self._reader.cancel()
+
+
+class ReadAheadProxy:
+    def __init__(self, client_factory, headers: dict, readahead: int = PROXY_READAHEAD_BYTES, chunk_size: int = PROXY_CHUNK_BYTES):
+        self._client_factory = client_factory
+        self._headers = headers
+        self.readahead = readahead
+        self.chunk_size = chunk_size
+        self.active = 0
+        self._sizes: OrderedDict[str, tuple[int, str]] = OrderedDict()  # source identity -> (size, content type)
+        self.counters = {"opened": 0, "bytes_read": 0, "bytes_sent": 0, "client_disconnects": 0, "upstream_errors": 0, "abandoned": 0}
+
+    async def open(self, url: str, range_header: str | None = None) -> ProxiedStream:
+        """Send the upstream request (forwarding Range) and return once its headers are in."""
+        client = self._client_factory()
+        headers = dict(self._headers)
+        if range_header:
+            headers["Range"] = range_header
+        response = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+        self.counters["opened"] += 1
+        self._note_size(url, response)
+        return ProxiedStream(self, response)
+
+    def _note_size(self, url: str, response: httpx.Response):
+        content_range = parse_content_range(response.headers.get("Content-Range"))
+        if response.status_code == 206 and content_range and content_range[2] is not None:
+            size = content_range[2]
+        elif response.status_code == 200 and response.headers.get("Content-Length") and not response.headers.get("Content-Encoding"):
+            size = int(response.headers["Content-Length"])
+        else:
+            return
+        ident = source_identity(url)
+        self._sizes[ident] = (size, response.headers.get("Content-Type", "video/mp4"))
+        self._sizes.move_to_end(ident)
+        while len(self._sizes) > SIZE_MAP_SIZE:
+            self._sizes.popitem(last=False)
+
+    def describe(self, url: str) -> tuple[int, str] | None:
+        """(file size, content type) from an earlier response for this resource, if any."""
+        return self._sizes.get(source_identity(url))
+
+    async def iter_range(self, url: str, start: int, end: int):
+        """Bytes [start, end] of `url` through the read-ahead buffer; the request is sent on first iteration."""
+        stream = await self.open(url, f"bytes={start}-{end}")
+        content_range = parse_content_range(stream.headers.get("Content-Range"))
+        if not (stream.status_code == 206 and content_range and content_range[0] == start) and not (stream.status_code == 200 and start == 0):
+            stream.discard()
+            await stream.response.aclose()  # the reader may not have started, so its finally won't close it
+            raise httpx.HTTPStatusError(
+                f"unexpected upstream response {stream.status_code} {stream.headers.get('Content-Range')}",
+                request=stream.response.request, response=stream.response,
+            )
+        remaining = end - start + 1
+        chunks = stream.iter_bytes()
+        try:
+            async for chunk in chunks:
+                if len(chunk) >= remaining:
+                    yield chunk[:remaining]
+                    return
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    def stats(self) -> dict:
+        return {**self.counters, "active": self.active, "readahead_bytes": self.readahead, "known_sizes": len(self._sizes)}
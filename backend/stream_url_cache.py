@@ -0,0 +1,140 @@
+"""
+stream_url_cache.py – Bounded cache for resolved CDN stream URLs.
+
+Entries live until just before the CDN signature expires (read from the
+`auth_key=<ts>-...` or `expires=<ts>` query parameter) instead of a fixed TTL,
+and the cache is capped by entry count and approximate memory size.
+"""
+
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_TTL = 180.0           # used when the URL carries no readable expiry
+EXPIRY_MARGIN = 60.0          # expire this long before the signature does
+MAX_TTL = 6 * 3600.0          # never trust a signature further out than this
+
+
+def source_identity(url: str) -> str:
+    """Stable identity of a CDN file: host + path, ignoring the signed query string."""
+    parts = urlsplit(url)
+    return parts.netloc.lower() + parts.path
+
+
+def signature_expiry(url: str, now: float | None = None) -> float | None:
+    """Return the wall-clock expiry encoded in a signed CDN URL, or None if absent/unusable."""
+    now = time.time() if now is None else now
+    try:
+        query = parse_qs(urlsplit(url).query)
+    except ValueError:
+        return None
+
+    candidates = []
+    auth_key = (query.get("auth_key") or [""])[0]
+    if auth_key:
+        candidates.append(auth_key.split("-", 1)[0])
+    for name in ("expires", "Expires", "expire", "e"):
+        if query.get(name):
+            candidates.append(query[name][0])
+
+    for raw in candidates:
+        try:
+            ts = float(raw)
+        except ValueError:
+            continue
+        if ts > 1e12:  # milliseconds
+            ts /= 1000.0
+        if ts > now:
+            return ts
+    return None
+
+
+class StreamURLCache:
+    """LRU cache of stream URLs whose entries expire with their CDN signature."""
+
+    def __init__(self, max_entries: int = 2000, max_bytes: int = 4 * 1024 * 1024,
+                 default_ttl: float = DEFAULT_TTL, margin: float = EXPIRY_MARGIN):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.margin = margin
+        self._entries: OrderedDict[tuple, tuple[str, float, int]] = OrderedDict()  # key -> (url, expires_at, size)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _entry_size(key: tuple, url: str) -> int:
+        return sys.getsizeof(url) + sys.getsizeof(key) + sum(sys.getsizeof(k) for k in key) + 64
+
+    def _expires_at(self, url: str, now: float) -> float:
+        expiry = signature_expiry(url, now)
+        if expiry is None:
+            return now + self.default_ttl
+        return min(expiry - self.margin, now + MAX_TTL)
+
+    def _remove(self, key: tuple):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key: tuple) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        url, expires_at, _ = entry
+        if time.time() >= expires_at:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return url
+
+    def put(self, key: tuple, url: str):
+        now = time.time()
+        expires_at = self._expires_at(url, now)
+        if expires_at <= now:
+            return
+        if key in self._entries:
+            self._remove(key)
+        size = self._entry_size(key, url)
+        self._entries[key] = (url, expires_at, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def sweep(self) -> int:
+        """Drop every expired entry. Returns how many were removed."""
+        now = time.time()
+        expired = [k for k, (_, expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            self._remove(key)
+        self.expirations += len(expired)
+        return len(expired)
+
+    async def run_sweeper(self, interval: float = 60.0):
+        """Background loop that sweeps expired entries until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,208 @@
+"""
+subtitle_cache.py – Content cache for converted WebVTT subtitles.
+
+Entries are keyed by source URL and hold the converted VTT plus pre-compressed
+gzip (and brotli, if installed) variants and a strong ETag, so repeat requests
+are answered from memory (or with a 304). Memory is bounded by total bytes; an
+optional disk tier (SUBTITLE_CACHE_DIR) keeps converted files across restarts,
+bounded by its own byte budget (least recently used files are deleted).
+Compression and disk I/O run in worker threads, off the event loop.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+
+try:
+    import brotli  # optional
+except ImportError:
+    brotli = None
+
+
+@dataclass
+class SubtitleEntry:
+    vtt: bytes
+    etag: str
+    gzip: bytes
+    br: bytes | None
+
+    @property
+    def size(self) -> int:
+        return len(self.vtt) + len(self.gzip) + len(self.br or b"")
+
+    def body_for(self, accept_encoding: str | None) -> tuple[bytes, str | None]:
+        """Best variant for an Accept-Encoding header: (body, content-encoding)."""
+        accepted = _accepted_encodings(accept_encoding)
+        if self.br is not None and "br" in accepted:
+            return self.br, "br"
+        if "gzip" in accepted:
+            return self.gzip, "gzip"
+        return self.vtt, None
+
+
+def _accepted_encodings(header: str | None) -> set[str]:
+    accepted = set()
+    for part in (header or "").split(","):
+        token, _, params = part.strip().partition(";")
+        if not token:
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                pass
+        accepted.add(token.strip().lower())
+    return accepted
+
+
+def make_entry(vtt_text: str) -> SubtitleEntry:
+    vtt = vtt_text.encode("utf-8")
+    return SubtitleEntry(
+        vtt=vtt,
+        etag='"' + hashlib.sha256(vtt).hexdigest()[:32] + '"',
+        gzip=gzip.compress(vtt, compresslevel=6),
+        br=brotli.compress(vtt, quality=9) if brotli else None,
+    )
+
+
+def _scan_disk(disk_dir: str) -> list[tuple[str, int]]:
+    """(path, size) of the cached files, oldest access first."""
+    os.makedirs(disk_dir, exist_ok=True)
+    files = []
+    for name in os.listdir(disk_dir):
+        if not name.endswith(".vtt"):
+            continue
+        path = os.path.join(disk_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, path, st.st_size))
+    return [(path, size) for _, path, size in sorted(files)]
+
+
+def _read_entry(path: str) -> SubtitleEntry:
+    with open(path, "rb") as f:
+        entry = make_entry(f.read().decode("utf-8"))
+    os.utime(path)  # mtime doubles as last access for eviction after a restart
+    return entry
+
+
+def _write_file(path: str, data: bytes):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def _remove_files(paths: list[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class SubtitleCache:
+    """Byte-bounded LRU of converted subtitles with an optional, also byte-bounded, on-disk tier."""
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, disk_dir: str | None = None, disk_max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: OrderedDict[str, SubtitleEntry] = OrderedDict()
+        self._bytes = 0
+        self._disk_files: OrderedDict[str, int] | None = None  # path -> size, LRU order; loaded on first use
+        self._disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+
+    def _disk_path(self, url: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".vtt")
+
+    async def _disk_index(self) -> OrderedDict[str, int]:
+        if self._disk_files is None:
+            files = await asyncio.to_thread(_scan_disk, self.disk_dir)
+            if self._disk_files is None:
+                self._disk_files = OrderedDict(files)
+                self._disk_bytes = sum(self._disk_files.values())
+        return self._disk_files
+
+    async def get(self, url: str) -> SubtitleEntry | None:
+        entry = self._entries.get(url)
+        if entry is not None:
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry
+        if self.disk_dir:
+            path = self._disk_path(url)
+            files = await self._disk_index()
+            if path in files:
+                try:
+                    entry = await asyncio.to_thread(_read_entry, path)
+                    files.move_to_end(path)
+                    self._insert(url, entry)
+                    self.disk_hits += 1
+                    return entry
+                except FileNotFoundError:
+                    self._disk_bytes -= files.pop(path, 0)
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"DEBUG: Subtitle disk cache read failed: {e}")
+        self.misses += 1
+        return None
+
+    async def put(self, url: str, vtt_text: str) -> SubtitleEntry:
+        entry = await asyncio.to_thread(make_entry, vtt_text)
+        self._insert(url, entry)
+        if self.disk_dir and len(entry.vtt) <= self.disk_max_bytes:
+            path = self._disk_path(url)
+            files = await self._disk_index()
+            try:
+                await asyncio.to_thread(_write_file, path, entry.vtt)
+            except OSError as e:
+                print(f"DEBUG: Subtitle disk cache write failed: {e}")
+                return entry
+            self._disk_bytes += len(entry.vtt) - files.pop(path, 0)
+            files[path] = len(entry.vtt)
+            victims = []
+            while self._disk_bytes > self.disk_max_bytes and files:
+                victim, size = files.popitem(last=False)
+                self._disk_bytes -= size
+                victims.append(victim)
+            if victims:
+                self.disk_evictions += len(victims)
+                await asyncio.to_thread(_remove_files, victims)
+        return entry
+
+    def _insert(self, url: str, entry: SubtitleEntry):
+        old = self._entries.pop(url, None)
+        if old is not None:
+            self._bytes -= old.size
+        if entry.size > self.max_bytes:
+            return
+        self._entries[url] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "disk_files": len(self._disk_files or ()),
+            "disk_bytes": self._disk_bytes,
+            "disk_max_bytes": self.disk_max_bytes,
+            "disk_evictions": self.disk_evictions,
+            "brotli": brotli is not None,
+        }
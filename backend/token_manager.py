@@ -0,0 +1,146 @@
+"""
+token_manager.py – Lifecycle of the H5 bearer token.
+
+Acquisition is single-flighted (N concurrent cold-start requests cause one
+/home bootstrap), rotated tokens from `x-user` headers are absorbed, the token
+is refreshed in the background once a request finds it within
+`refresh_margin` of expiry, a token the upstream rejects (401) is dropped via
+`invalidate()` so the caller's retry fetches a new one, and it can be
+persisted to a local file so cold starts skip the bootstrap request.
+"""
+
+import asyncio
+import base64
+import json
+import os
+import time
+from typing import Awaitable, Callable
+
+
+def jwt_expiry(token: str) -> float | None:
+    """Read the `exp` claim from a JWT without verifying it. None if the token isn't a JWT."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp else None
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+
+class TokenManager:
+    """Holds the current bearer token and refreshes it before expiry."""
+
+    def __init__(
+        self,
+        fetch_token: Callable[[], Awaitable[str | None]],
+        persist_path: str | None = None,
+        refresh_margin: float = 300.0,
+        default_ttl: float = 12 * 3600.0,
+    ):
+        self._fetch_token = fetch_token
+        self.persist_path = persist_path
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.token: str | None = None
+        self.expires_at = 0.0
+        self._loaded = False
+        self._refresh_task: asyncio.Task | None = None
+        self.stats_counters = {"fetches": 0, "coalesced": 0, "rotations": 0, "background_refreshes": 0, "loaded_from_disk": 0, "invalidations": 0}
+
+    async def get(self) -> str:
+        """Current token; fetches one if missing/expired and refreshes in the background when close to expiry."""
+        self._load_persisted()
+        now = time.time()
+        if self.token and now < self.expires_at - self.refresh_margin:
+            return self.token
+        if self.token and now < self.expires_at:
+            # Still valid: keep serving it while a refresh runs
+            if self._start_refresh():
+                self.stats_counters["background_refreshes"] += 1
+            return self.token
+        return await self.refresh()
+
+    async def refresh(self) -> str:
+        """Fetch a new token, joining an already running fetch if there is one."""
+        self._start_refresh()
+        return await asyncio.shield(self._refresh_task)
+
+    def update(self, token: str | None):
+        """Adopt a token seen on a response (x-user rotation) or fetched from /home."""
+        if not token or token == self.token:
+            return
+        if self.token:
+            self.stats_counters["rotations"] += 1
+        self.token = token
+        self.expires_at = jwt_expiry(token) or (time.time() + self.default_ttl)
+        self._persist()
+
+    def invalidate(self, token: str | None = None):
+        """Forget the current token (only if it is still `token`, when given) so the next get() fetches one."""
+        if token is not None and token != self.token:
+            return  # already replaced by a rotation or another caller's refresh
+        if self.token:
+            self.stats_counters["invalidations"] += 1
+        self.token = None
+        self.expires_at = 0.0
+        if self.persist_path:
+            try:
+                os.remove(self.persist_path)
+            except OSError:
+                pass
+
+    def _start_refresh(self) -> bool:
+        """Start a refresh task unless one is already running on this loop. Returns True if started."""
+        loop = asyncio.get_running_loop()
+        task = self._refresh_task
+        if task is not None and not task.done() and task.get_loop() is loop:
+            self.stats_counters["coalesced"] += 1
+            return False
+        self._refresh_task = loop.create_task(self._do_refresh())
+        return True
+
+    async def _do_refresh(self) -> str:
+        self.stats_counters["fetches"] += 1
+        try:
+            self.update(await self._fetch_token())
+        except Exception as e:
+            print(f"DEBUG: Token acquisition error: {e}")
+        return self.token or ""
+
+    def _load_persisted(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data, dict) or not isinstance(data.get("token"), str):
+                print(f"DEBUG: Ignoring malformed persisted token file {self.persist_path}")
+                return
+            if data.get("token") and float(data.get("expires_at", 0)) > time.time() and not self.token:
+                self.token = data["token"]
+                self.expires_at = float(data["expires_at"])
+                self.stats_counters["loaded_from_disk"] += 1
+        except (OSError, ValueError, TypeError) as e:
+            print(f"DEBUG: Could not load persisted token: {e}")
+
+    def _persist(self):
+        if not self.persist_path:
+            return
+        tmp_path = f"{self.persist_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"token": self.token, "expires_at": self.expires_at}, f)
+            os.replace(tmp_path, self.persist_path)
+        except OSError as e:
+            print(f"DEBUG: Could not persist token: {e}")
+
+    def stats(self) -> dict:
+        return {
+            **self.stats_counters,
+            "has_token": bool(self.token),
+            "expires_in": max(0, int(self.expires_at - time.time())) if self.token else 0,
+        }
@@ -0,0 +1,562 @@
+"""
+transcode.py – Session manager for HEVC -> H.264 ffmpeg transcodes.
+
+Caps concurrent encoders (default: half the CPUs), queues briefly and then
+rejects excess requests with a Retry-After, kills encoders whose viewer has
+gone away, and lets a viewer who seeks forward into output the encoder has
+already produced reuse the running encoder instead of spawning a new one
+(when a fragment starts at the seek point; the player snaps transcode seeks
+to the KEYFRAME_INTERVAL grid so they line up).
+Sessions are keyed by resource and start offset rather than by viewer, so a
+Watch Together room starting at the same position shares
+one encoder; a reader that holds the others back is dropped (see fanout.py).
+
+ffmpeg writes fragmented MP4 (one fragment per forced keyframe). The session
+keeps the init segment plus recent fragments up to TRANSCODE_BUFFER_BYTES,
+never dropping one a reader hasn't consumed, so a late joiner can still start
+from the beginning while the window lasts; a reused session serves init +
+fragments from the seek point with their decode times rebased to zero, which
+is what the player expects for a `start_time` request.
+"""
+
+import asyncio
+import os
+import struct
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from fanout import FANOUT_SLOW_READER_GRACE
+from metrics import ACTIVE_TRANSCODES, STAGE_SECONDS
+from mp4_probe import child_box, iter_boxes
+from stream_url_cache import source_identity
+
+TRANSCODE_MAX_SESSIONS = int(os.environ.get("TRANSCODE_MAX_SESSIONS", "0")) or max(1, (os.cpu_count() or 2) // 2)
+TRANSCODE_MAX_QUEUE = int(os.environ.get("TRANSCODE_MAX_QUEUE", "4"))
+TRANSCODE_QUEUE_TIMEOUT = float(os.environ.get("TRANSCODE_QUEUE_TIMEOUT", "8"))
+TRANSCODE_IDLE_GRACE = float(os.environ.get("TRANSCODE_IDLE_GRACE", "15"))
+TRANSCODE_BUFFER_BYTES = int(os.environ.get("TRANSCODE_BUFFER_BYTES", str(48 * 1024 * 1024)))
+TRANSCODE_RETRY_AFTER = 10
+KEYFRAME_INTERVAL = 2  # seconds; also the fragment length and therefore seek granularity
+REUSE_TOLERANCE = 0.05  # seconds; a reused fragment must start this close to the requested time (under a frame)
+READ_CHUNK = 262144  # 256KB reads for fast startup
+
+FFMPEG_INPUT_HEADERS = (
+    "Referer: https://netfilm.world/\r\n"
+    "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/148.0.0.0 Safari/537.36\r\n"
+)
+
+
+class TranscodeBusy(Exception):
+    """All encoder slots are taken and the wait queue is full (or the wait timed out)."""
+
+    def __init__(self, retry_after: int = TRANSCODE_RETRY_AFTER):
+        super().__init__("transcoder busy")
+        self.retry_after = retry_after
+
+
+def build_ffmpeg_cmd(ffmpeg_path: str, source_url: str, start_time: float = 0.0) -> list[str]:
+    cmd = [ffmpeg_path]
+    if start_time > 0.0:
+        cmd.extend(["-ss", str(start_time)])
+    cmd.extend([
+        "-reconnect", "1",
+        "-reconnect_streamed", "1",
+        "-reconnect_delay_max", "5",
+        "-headers", FFMPEG_INPUT_HEADERS,
+        "-i", source_url,
+        "-vf", "scale=-2:min(720\\,ih)",
+        "-c:v", "libx264",
+        "-preset", "ultrafast",
+        "-tune", "zerolatency",
+        "-force_key_frames", f"expr:gte(t,n_forced*{KEYFRAME_INTERVAL})",
+        "-threads", "0",
+        "-c:a", "copy",
+        "-sn",
+        "-f", "mp4",
+        "-movflags", "frag_keyframe+empty_moov",
+        "pipe:1",
+    ])
+    return cmd
+
+
+# --- fragmented MP4 helpers -------------------------------------------------
+
+def parse_track_timescales(init_segment: bytes) -> tuple[dict[int, int], int | None]:
+    """({track_id: timescale}, video_track_id) from an init segment's moov."""
+    timescales, video_track = {}, None
+    moov = next(((p, e) for t, _, p, e in iter_boxes(init_segment) if t == "moov"), None)
+    if not moov:
+        return timescales, video_track
+    for box_type, _, payload, end in iter_boxes(init_segment, *moov):
+        if box_type != "trak":
+            continue
+        tkhd = child_box(init_segment, payload, end, "tkhd")
+        mdia = child_box(init_segment, payload, end, "mdia")
+        if not tkhd or not mdia:
+            continue
+        version = init_segment[tkhd[1]]
+        track_id = struct.unpack_from(">I", init_segment, tkhd[1] + (20 if version == 1 else 12))[0]
+        mdhd = child_box(init_segment, mdia[1], mdia[2], "mdhd")
+        hdlr = child_box(init_segment, mdia[1], mdia[2], "hdlr")
+        if mdhd:
+            version = init_segment[mdhd[1]]
+            timescales[track_id] = struct.unpack_from(">I", init_segment, mdhd[1] + (20 if version == 1 else 12))[0]
+        if hdlr and init_segment[hdlr[1] + 8:hdlr[1] + 12] == b"vide" and video_track is None:
+            video_track = track_id
+    return timescales, video_track
+
+
+def _tfdt_offsets(fragment: bytes):
+    """Yield (track_id, tfdt_version, value_offset) for each traf in a moof+mdat fragment."""
+    for box_type, _, payload, end in iter_boxes(fragment):
+        if box_type != "moof":
+            continue
+        for t, _, traf_payload, traf_end in iter_boxes(fragment, payload, end):
+            if t != "traf":
+                continue
+            tfhd = child_box(fragment, traf_payload, traf_end, "tfhd")
+            tfdt = child_box(fragment, traf_payload, traf_end, "tfdt")
+            if tfhd and tfdt:
+                track_id = struct.unpack_from(">I", fragment, tfhd[1] + 4)[0]
+                yield track_id, fragment[tfdt[1]], tfdt[1] + 4
+
+
+def fragment_decode_times(fragment: bytes) -> dict[int, int]:
+    times = {}
+    for track_id, version, offset in _tfdt_offsets(fragment):
+        fmt = ">Q" if version == 1 else ">I"
+        times[track_id] = struct.unpack_from(fmt, fragment, offset)[0]
+    return times
+
+
+def rebase_fragment(fragment: bytes, base: dict[int, int]) -> bytes:
+    """Shift every traf's baseMediaDecodeTime back by base[track_id]. Sizes are unchanged."""
+    out = bytearray(fragment)
+    for track_id, version, offset in _tfdt_offsets(fragment):
+        shift = base.get(track_id, 0)
+        if not shift:
+            continue
+        fmt = ">Q" if version == 1 else ">I"
+        value = struct.unpack_from(fmt, out, offset)[0]
+        struct.pack_into(fmt, out, offset, max(0, value - shift))
+    return bytes(out)
+
+
+async def terminate_process(process: asyncio.subprocess.Process):
+    """Stop ffmpeg: SIGTERM, then SIGKILL if it lingers."""
+    async def drain_and_wait():
+        # A paused, unread pipe keeps wait() pending, so drain it first
+        for pipe in (process.stdout, process.stderr):
+            while pipe is not None and await pipe.read(READ_CHUNK):
+                pass
+        await process.wait()
+
+    for stop in (process.terminate, process.kill):
+        try:
+            if process.returncode is None:
+                stop()
+        except ProcessLookupError:
+            pass
+        try:
+            await asyncio.wait_for(drain_and_wait(), timeout=5)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+# --- sessions ---------------------------------------------------------------
+
+@dataclass
+class _Fragment:
+    seq: int
+    data: bytes
+    times: dict[int, int]
+    seconds: float  # start of the fragment, relative to the session's start_time
+
+
+@dataclass
+class TranscodeSession:
+    sid: int
+    key: tuple  # (resource, start_time)
+    source_url: str
+    start_time: float
+    process: asyncio.subprocess.Process
+    created: float = field(default_factory=time.time)
+    init_segment: bytes | None = None
+    timescales: dict = field(default_factory=dict)
+    video_track: int | None = None
+    fragments: deque = field(default_factory=deque)
+    buffered_bytes: int = 0
+    capacity: int = TRANSCODE_BUFFER_BYTES  # history kept for late joiners
+    next_seq: int = 0
+    eof: bool = False
+    bytes_out: int = 0
+    readers: dict = field(default_factory=dict)  # reader id -> next fragment seq
+    viewers: dict = field(default_factory=dict)  # reader id -> viewer
+    reuses: int = 0
+    cond: asyncio.Condition = field(default_factory=asyncio.Condition)
+    pump_task: asyncio.Task | None = None
+    idle_task: asyncio.Task | None = None
+    slot_held: bool = True
+
+    def fragment_for(self, rel_seconds: float) -> _Fragment | None:
+        """Buffered fragment starting at rel_seconds (within REUSE_TOLERANCE), if any.
+
+        Only an exact start is reused: the player takes the requested start time as
+        the stream's zero, so a fragment starting earlier would shift its timeline.
+        """
+        for frag in self.fragments:
+            if abs(frag.seconds - rel_seconds) <= REUSE_TOLERANCE:
+                return frag
+            if frag.seconds > rel_seconds:
+                break
+        return None
+
+    def _get(self, seq: int) -> _Fragment | None:
+        if not self.fragments:
+            return None
+        idx = seq - self.fragments[0].seq
+        return self.fragments[idx] if 0 <= idx < len(self.fragments) else None
+
+    def joinable_from_start(self, start_time: float) -> bool:
+        """True if a new reader can start at this session's own start (nothing evicted yet)."""
+        if self.start_time != start_time:
+            return False
+        return self.fragments[0].seq == 0 if self.fragments else self.next_seq == 0
+
+    def _backlog(self) -> int:
+        """Bytes not yet read by the slowest reader (the whole buffer when nobody is reading)."""
+        if not self.readers:
+            return self.buffered_bytes
+        low = min(self.readers.values())
+        return sum(len(frag.data) for frag in self.fragments if frag.seq >= low)
+
+    def _trim(self):
+        # Keep recent history for late joiners, but never drop a fragment a reader hasn't consumed
+        low = min(self.readers.values(), default=self.next_seq)
+        while self.buffered_bytes > self.capacity and self.fragments and self.fragments[0].seq < low:
+            self.buffered_bytes -= len(self.fragments.popleft().data)
+
+    def _drop_readers(self, rids) -> int:
+        for rid in rids:
+            self.readers.pop(rid, None)
+            self.viewers.pop(rid, None)
+        return len(rids)
+
+    def _evict_slow(self) -> int:
+        """Drop the readers furthest behind when they hold back a reader that has caught up."""
+        if not self.readers or max(self.readers.values()) < self.next_seq:
+            return 0
+        slowest = min(self.readers.values())
+        if slowest >= self.next_seq:
+            return 0
+        return self._drop_readers([rid for rid, seq in self.readers.items() if seq == slowest])
+
+
+class TranscodeStream:
+    """One client's view of a session: init segment then fragments from a starting point."""
+
+    def __init__(self, manager: "TranscodeManager", session: TranscodeSession, reader_id: int, base: dict, actual_start: float):
+        self.manager = manager
+        self.session = session
+        self.reader_id = reader_id
+        self.base = base
+        self.actual_start = actual_start
+
+    async def iter_bytes(self):
+        s = self.session
+        rid = self.reader_id
+        try:
+            async with s.cond:
+                await s.cond.wait_for(lambda: s.init_segment is not None or s.eof or rid not in s.readers)
+                init = s.init_segment
+            if init is None:
+                return
+            yield init
+            while True:
+                async with s.cond:
+                    await s.cond.wait_for(lambda: rid not in s.readers or s._get(s.readers[rid]) is not None or s.eof)
+                    if rid not in s.readers:
+                        return  # superseded by a newer request from the same viewer, or too slow
+                    frag = s._get(s.readers[rid])
+                    if frag is None:
+                        return  # encoder finished
+                    s.readers[rid] = frag.seq + 1
+                    s.cond.notify_all()
+                data = rebase_fragment(frag.data, self.base) if self.base else frag.data
+                s.bytes_out += len(data)
+                yield data
+        finally:
+            self.manager._detach(s, rid)
+
+
+class TranscodeManager:
+    def __init__(
+        self,
+        max_sessions: int = TRANSCODE_MAX_SESSIONS,
+        max_queue: int = TRANSCODE_MAX_QUEUE,
+        queue_timeout: float = TRANSCODE_QUEUE_TIMEOUT,
+        idle_grace: float = TRANSCODE_IDLE_GRACE,
+        buffer_bytes: int = TRANSCODE_BUFFER_BYTES,
+    ):
+        self.max_sessions = max_sessions
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.idle_grace = idle_grace
+        self.buffer_bytes = buffer_bytes
+        self.sessions: dict[int, TranscodeSession] = {}
+        self._slots = asyncio.Semaphore(max_sessions)
+        self._waiting = 0
+        self._external = 0
+        self._next_reader = 0
+        self._next_session = 0
+        self.counters = {"started": 0, "reused": 0, "shared": 0, "evicted": 0, "rejected": 0, "reaped": 0, "queued": 0}
+
+    async def open(self, viewer: str, source_url: str, start_time: float, ffmpeg_path: str) -> TranscodeStream:
+        """Stream for `viewer` starting at `start_time`, joining a running encoder that covers it.
+
+        That is an encoder for the same resource started at the same offset whose
+        first fragment is still buffered (e.g. the rest of a Watch Together room),
+        or one with a buffered fragment starting at the seek point (e.g. this
+        viewer's own encoder after a seek forward to a keyframe-aligned time).
+        """
+        resource = source_identity(source_url)
+        for session in list(self.sessions.values()):
+            if session.key[0] != resource:
+                continue
+            if session.joinable_from_start(start_time):
+                frag = None
+            else:
+                frag = session.fragment_for(start_time - session.start_time)
+                if frag is None:
+                    continue
+            self.counters["reused"] += 1
+            session.reuses += 1
+            if any(v != viewer for v in session.viewers.values()):
+                self.counters["shared"] += 1
+            await self._supersede(viewer, resource, keep=session)
+            return await self._attach(session, frag, viewer)
+
+        # Seek outside every buffered window: this viewer's old encoder is no longer needed
+        await self._supersede(viewer, resource)
+        await self._acquire_slot()
+        try:
+            session = await self._spawn((resource, start_time), source_url, start_time, ffmpeg_path)
+        except BaseException:
+            self._slots.release()
+            raise
+        return await self._attach(session, None, viewer)
+
+    async def _supersede(self, viewer: str, resource: str, keep: TranscodeSession | None = None):
+        """Drop `viewer`'s readers on other encoders of this resource; stop encoders left unread."""
+        for session in list(self.sessions.values()):
+            if session is keep or session.key[0] != resource:
+                continue
+            async with session.cond:
+                dropped = session._drop_readers([rid for rid, v in session.viewers.items() if v == viewer])
+                session.cond.notify_all()
+            if dropped and not session.readers:
+                await self._stop(session)
+
+    async def acquire(self):
+        """Reserve an encoder slot for an encoder not managed as a session (e.g. HLS jobs)."""
+        await self._acquire_slot()
+        self._external += 1
+        ACTIVE_TRANSCODES.inc()
+
+    def release(self):
+        self._external -= 1
+        self._slots.release()
+        ACTIVE_TRANSCODES.dec()
+
+    async def _acquire_slot(self):
+        if self._slots.locked():
+            if self._waiting >= self.max_queue:
+                self.counters["rejected"] += 1
+                raise TranscodeBusy()
+            self.counters["queued"] += 1
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.counters["rejected"] += 1
+            raise TranscodeBusy()
+        finally:
+            self._waiting -= 1
+
+    async def _spawn(self, key: tuple, source_url: str, start_time: float, ffmpeg_path: str) -> TranscodeSession:
+        creationflags = 0x08000000 if sys.platform == "win32" else 0  # CREATE_NO_WINDOW
+        print(f"DEBUG: HEVC detected. Spawning ffmpeg transcoding proxy for: {source_url[:100]} starting at {start_time}s...")
+        process = await asyncio.create_subprocess_exec(
+            *build_ffmpeg_cmd(ffmpeg_path, source_url, start_time),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            creationflags=creationflags,
+        )
+        self._next_session += 1
+        session = TranscodeSession(
+            sid=self._next_session, key=key, source_url=source_url, start_time=start_time, process=process, capacity=self.buffer_bytes,
+        )
+        self.sessions[session.sid] = session
+        self.counters["started"] += 1
+        ACTIVE_TRANSCODES.inc()
+        session.pump_task = asyncio.create_task(self._pump(session))
+        return session
+
+    async def _attach(self, session: TranscodeSession, frag: _Fragment | None, viewer: str) -> TranscodeStream:
+        if session.idle_task is not None:
+            session.idle_task.cancel()
+            session.idle_task = None
+        self._next_reader += 1
+        rid = self._next_reader
+        async with session.cond:
+            # A new request from the same viewer supersedes their previous one
+            session._drop_readers([r for r, v in session.viewers.items() if v == viewer])
+            session.viewers[rid] = viewer
+            if frag is not None:
+                session.readers[rid] = frag.seq
+                base = dict(frag.times)
+                actual_start = session.start_time + frag.seconds
+            else:
+                session.readers[rid] = session.fragments[0].seq if session.fragments else session.next_seq
+                base = {}
+                actual_start = session.start_time
+            session.cond.notify_all()
+        return TranscodeStream(self, session, rid, base, actual_start)
+
+    def _detach(self, session: TranscodeSession, rid: int):
+        # Synchronous: runs in the stream's finally, possibly while the request is being cancelled
+        session.readers.pop(rid, None)
+        session.viewers.pop(rid, None)
+        if not session.readers and self.sessions.get(session.sid) is session and session.idle_task is None:
+            # Keep the encoder briefly so a seek-forward can reuse it, then reap the orphan
+            session.idle_task = asyncio.create_task(self._reap_later(session))
+
+    async def _reap_later(self, session: TranscodeSession):
+        try:
+            await asyncio.sleep(self.idle_grace)
+        except asyncio.CancelledError:
+            return
+        if not session.readers:
+            self.counters["reaped"] += 1
+            session.idle_task = None
+            await self._stop(session)
+
+    async def _pump(self, session: TranscodeSession):
+        """Read ffmpeg output, split it into init segment + fragments, apply backpressure."""
+        buf = bytearray()
+        pending_moof: bytes | None = None
+        spawned = time.perf_counter()
+        try:
+            while True:
+                async with session.cond:
+                    # Backpressure: stop reading (ffmpeg blocks on the pipe) while the unread backlog is full
+                    while session._backlog() >= self.buffer_bytes:
+                        try:
+                            await asyncio.wait_for(
+                                session.cond.wait_for(lambda: session._backlog() < self.buffer_bytes),
+                                timeout=FANOUT_SLOW_READER_GRACE,
+                            )
+                        except asyncio.TimeoutError:
+                            # Don't let one stalled viewer freeze the encoder for the rest of the room
+                            evicted = session._evict_slow()
+                            if evicted:
+                                self.counters["evicted"] += evicted
+                                session.cond.notify_all()
+                chunk = await session.process.stdout.read(READ_CHUNK)
+                if not chunk:
+                    break
+                buf.extend(chunk)
+                new_fragments = []
+                pos = 0
+                for box_type, start, _, end in iter_boxes(buf):
+                    box = bytes(buf[start:end])
+                    pos = end
+                    if box_type in ("ftyp", "moov"):
+                        session.init_segment = (session.init_segment or b"") + box
+                        if box_type == "moov":
+                            session.timescales, session.video_track = parse_track_timescales(session.init_segment)
+                    elif box_type == "moof":
+                        pending_moof = box
+                    elif box_type == "mdat" and pending_moof is not None:
+                        new_fragments.append(pending_moof + box)
+                        pending_moof = None
+                del buf[:pos]
+                if not new_fragments and session.init_segment is None:
+                    continue
+                async with session.cond:
+                    for data in new_fragments:
+                        if session.next_seq == 0:
+                            STAGE_SECONDS.observe(time.perf_counter() - spawned, "transcode_startup")
+                        times = fragment_decode_times(data)
+                        track = session.video_track if session.video_track in times else next(iter(times), None)
+                        scale = session.timescales.get(track) or 1
+                        seconds = times.get(track, 0) / scale if track is not None else 0.0
+                        session.fragments.append(_Fragment(session.next_seq, data, times, seconds))
+                        session.buffered_bytes += len(data)
+                        session.next_seq += 1
+                    session._trim()
+                    session.cond.notify_all()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"DEBUG: Transcoding stream exception: {e}")
+        finally:
+            async with session.cond:
+                session.eof = True
+                session.cond.notify_all()
+            self._release_slot(session)
+
+    def _release_slot(self, session: TranscodeSession):
+        if session.slot_held:
+            session.slot_held = False
+            self._slots.release()
+            ACTIVE_TRANSCODES.dec()
+
+    async def _stop(self, session: TranscodeSession):
+        if self.sessions.get(session.sid) is session:
+            del self.sessions[session.sid]
+        if session.idle_task is not None and session.idle_task is not asyncio.current_task():
+            session.idle_task.cancel()
+        if session.pump_task is not None:
+            session.pump_task.cancel()
+            await asyncio.gather(session.pump_task, return_exceptions=True)
+        await terminate_process(session.process)
+        self._release_slot(session)
+        async with session.cond:
+            session.readers.clear()
+            session.viewers.clear()
+            session.fragments.clear()
+            session.buffered_bytes = 0
+            session.eof = True
+            session.cond.notify_all()
+
+    async def close(self):
+        for session in list(self.sessions.values()):
+            await self._stop(session)
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            **self.counters,
+            "max_sessions": self.max_sessions,
+            "active": sum(1 for s in self.sessions.values() if s.slot_held),
+            "external": self._external,
+            "waiting": self._waiting,
+            "sessions": [
+                {
+                    "start_time": s.start_time,
+                    "uptime": round(now - s.created, 1),
+                    "readers": len(s.readers),
+                    "viewers": len(set(s.viewers.values())),
+                    "buffered_fragments": len(s.fragments),
+                    "buffered_bytes": s.buffered_bytes,
+                    "bytes_out": s.bytes_out,
+                    "reuses": s.reuses,
+                    "finished": s.eof,
+                }
+                for s in self.sessions.values()
+            ],
+        }
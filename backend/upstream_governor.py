@@ -0,0 +1,344 @@
+"""
+upstream_governor.py – Rate and concurrency governor for every outbound upstream request.
+
+Each upstream host gets a token bucket (UPSTREAM_RATE requests/s, UPSTREAM_BURST
+burst) and a cap on requests awaiting their response headers
+(UPSTREAM_CONCURRENCY). The slot is freed as soon as the headers arrive, so
+long-lived streamed bodies (proxied playback, downloads) never hold it.
+Requests that can't start right away queue by priority class – interactive
+playback before prefetch before downloads – taken from a context variable, so
+callers only mark their class once (e.g. the prefetcher, the download proxy).
+A queued request gives up after its pool timeout (at most
+UPSTREAM_QUEUE_TIMEOUT) with UpstreamBusy, an httpx.PoolTimeout. A 429/503
+halves the host's rate and honours Retry-After; successes recover it
+additively.
+
+Hooked in as an httpx transport (GovernedTransport / GovernedSyncTransport), so
+any client built with `governed_transport()` is covered without touching
+individual call sites.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import httpx
+
+from metrics import UPSTREAM_QUEUE_DEPTH, UPSTREAM_THROTTLED, UPSTREAM_WAIT_SECONDS
+
+INTERACTIVE, PREFETCH, DOWNLOAD = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", PREFETCH: "prefetch", DOWNLOAD: "download"}
+
+UPSTREAM_RATE = float(os.environ.get("UPSTREAM_RATE", "10"))
+UPSTREAM_BURST = float(os.environ.get("UPSTREAM_BURST", "20"))
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", "16"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", "20"))
+UPSTREAM_BUSY_RETRY_AFTER = 5
+UPSTREAM_MIN_RATE = 0.5
+MAX_COOLDOWN = 30.0
+POLL_INTERVAL = 0.25  # re-check cadence while blocked on the in-flight cap
+
+upstream_priority: contextvars.ContextVar[int] = contextvars.ContextVar("upstream_priority", default=INTERACTIVE)
+
+
+class UpstreamBusy(httpx.PoolTimeout):
+    """No governor slot for the host within the wait limit."""
+
+    retry_after = UPSTREAM_BUSY_RETRY_AFTER
+
+
+@contextlib.contextmanager
+def priority(level: int):
+    """Run the enclosed upstream calls (and tasks created inside) at `level`."""
+    token = upstream_priority.set(level)
+    try:
+        yield
+    finally:
+        upstream_priority.reset(token)
+
+
+class _Waiter:
+    __slots__ = ("priority", "wake", "granted", "cancelled")
+
+    def __init__(self, priority: int, wake):
+        self.priority = priority
+        self.wake = wake  # thread-safe callable, invoked once the slot is granted
+        self.granted = False
+        self.cancelled = False
+
+
+class _Host:
+    def __init__(self, rate: float, burst: float, concurrency: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.waiters: list = []  # heap of (priority, seq, _Waiter)
+        self.throttled = 0
+        self.granted = 0
+        self.timeouts = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def can_start(self, now: float) -> bool:
+        self._refill(now)
+        return now >= self.cooldown_until and self.in_flight < self.concurrency and self.tokens >= 1.0
+
+    def delay(self, now: float) -> float:
+        """Seconds until a request could start, ignoring the in-flight cap."""
+        self._refill(now)
+        wait = max(0.0, self.cooldown_until - now)
+        if self.tokens < 1.0:
+            wait = max(wait, (1.0 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1.0
+        self.in_flight += 1
+        self.granted += 1
+
+
+class UpstreamGovernor:
+    def __init__(self, rate: float = UPSTREAM_RATE, burst: float = UPSTREAM_BURST, concurrency: int = UPSTREAM_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self._hosts: dict[str, _Host] = {}
+        self._lock = threading.Lock()  # main_flask calls in from worker threads
+        self._seq = itertools.count()
+
+    def _host(self, host: str) -> _Host:
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _Host(self.rate, self.burst, self.concurrency)
+        return state
+
+    def _dispatch(self, state: _Host):
+        """Grant slots to the best queued waiters that can start now. Caller holds the lock."""
+        now = time.monotonic()
+        while state.waiters:
+            prio, _, waiter = state.waiters[0]
+            if waiter.cancelled:
+                heapq.heappop(state.waiters)
+                UPSTREAM_QUEUE_DEPTH.dec(PRIORITY_NAMES[prio])
+                continue
+            if not state.can_start(now):
+                return
+            heapq.heappop(state.waiters)
+            UPSTREAM_QUEUE_DEPTH.dec(PRIORITY_NAMES[prio])
+            state.take()
+            waiter.granted = True
+            waiter.wake()
+
+    def _try_immediate(self, state: _Host) -> bool:
+        if not state.waiters and state.can_start(time.monotonic()):
+            state.take()
+            return True
+        return False
+
+    def _enqueue(self, state: _Host, prio: int, wake) -> _Waiter:
+        waiter = _Waiter(prio, wake)
+        heapq.heappush(state.waiters, (prio, next(self._seq), waiter))
+        UPSTREAM_QUEUE_DEPTH.inc(PRIORITY_NAMES[prio])
+        return waiter
+
+    def _abandon(self, state: _Host, waiter: _Waiter):
+        with self._lock:
+            if waiter.granted:
+                state.in_flight -= 1
+                self._dispatch(state)
+            else:
+                waiter.cancelled = True
+
+    def _give_up(self, state: _Host, waiter: _Waiter) -> bool:
+        """Withdraw a waiter whose wait limit passed. False if it was granted meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            waiter.cancelled = True
+            state.timeouts += 1
+            return True
+
+    async def acquire(self, host: str, timeout: float | None = None) -> bool:
+        """Wait for a slot for `host`. False if `timeout` seconds pass first."""
+        prio = upstream_priority.get()
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        with self._lock:
+            state = self._host(host)
+            if self._try_immediate(state):
+                UPSTREAM_WAIT_SECONDS.observe(0.0, PRIORITY_NAMES[prio])
+                return True
+            loop = asyncio.get_running_loop()
+            granted = loop.create_future()
+
+            def wake():
+                loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+            waiter = self._enqueue(state, prio, wake)
+        try:
+            while not waiter.granted:
+                with self._lock:
+                    self._dispatch(state)
+                    if waiter.granted:
+                        break
+                    delay = state.delay(time.monotonic()) or POLL_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 and self._give_up(state, waiter):
+                        return False
+                    delay = min(delay, max(remaining, 0.0))
+                try:
+                    await asyncio.wait_for(asyncio.shield(granted), timeout=max(delay, 0.01))
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._abandon(state, waiter)
+            raise
+        UPSTREAM_WAIT_SECONDS.observe(time.monotonic() - started, PRIORITY_NAMES[prio])
+        return True
+
+    def acquire_sync(self, host: str, timeout: float | None = None) -> bool:
+        """Blocking variant for sync httpx clients (Flask)."""
+        prio = upstream_priority.get()
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        with self._lock:
+            state = self._host(host)
+            if self._try_immediate(state):
+                UPSTREAM_WAIT_SECONDS.observe(0.0, PRIORITY_NAMES[prio])
+                return True
+            event = threading.Event()
+            waiter = self._enqueue(state, prio, event.set)
+        try:
+            while not waiter.granted:
+                with self._lock:
+                    self._dispatch(state)
+                    if waiter.granted:
+                        break
+                    delay = state.delay(time.monotonic()) or POLL_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 and self._give_up(state, waiter):
+                        return False
+                    delay = min(delay, max(remaining, 0.0))
+                event.wait(max(delay, 0.01))
+        except BaseException:
+            self._abandon(state, waiter)
+            raise
+        UPSTREAM_WAIT_SECONDS.observe(time.monotonic() - started, PRIORITY_NAMES[prio])
+        return True
+
+    def release(self, host: str, status: int | None = None, retry_after: str | None = None):
+        """Free the in-flight slot and feed the response status back into the host's rate."""
+        with self._lock:
+            state = self._host(host)
+            state.in_flight -= 1
+            if status in (429, 503):
+                state.throttled += 1
+                UPSTREAM_THROTTLED.inc(host)
+                state.rate = max(UPSTREAM_MIN_RATE, state.rate / 2)
+                cooldown = 1.0 / state.rate
+                try:
+                    cooldown = max(cooldown, float(retry_after)) if retry_after else cooldown
+                except ValueError:
+                    pass
+                state.cooldown_until = max(state.cooldown_until, time.monotonic() + min(cooldown, MAX_COOLDOWN))
+                state.tokens = 0.0
+            elif status is not None and status < 400 and state.rate < state.max_rate:
+                state.rate = min(state.max_rate, state.rate + state.max_rate / 20)
+            self._dispatch(state)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                host: {
+                    "rate": round(s.rate, 2),
+                    "in_flight": s.in_flight,
+                    "queued": sum(1 for _, _, w in s.waiters if not w.cancelled),
+                    "granted": s.granted,
+                    "throttled": s.throttled,
+                    "timeouts": s.timeouts,
+                }
+                for host, s in self._hosts.items()
+            }
+
+
+governor = UpstreamGovernor()
+
+
+def _wait_limit(request: httpx.Request) -> float:
+    """How long a request may queue: its own pool timeout, capped at UPSTREAM_QUEUE_TIMEOUT."""
+    pool = (request.extensions.get("timeout") or {}).get("pool")
+    return UPSTREAM_QUEUE_TIMEOUT if pool is None else min(pool, UPSTREAM_QUEUE_TIMEOUT)
+
+
+def _busy(request: httpx.Request, limit: float) -> UpstreamBusy:
+    return UpstreamBusy(f"upstream {request.url.host} busy: no slot within {limit:.0f}s", request=request)
+
+
+class GovernedTransport(httpx.AsyncBaseTransport):
+    """Acquire a governor slot per request; release it once the response headers are in."""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, gov: UpstreamGovernor = governor):
+        self._inner = inner
+        self._gov = gov
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        limit = _wait_limit(request)
+        if not await self._gov.acquire(host, limit):
+            raise _busy(request, limit)
+        try:
+            response = await self._inner.handle_async_request(request)
+        except BaseException:
+            self._gov.release(host)
+            raise
+        # The body may stream for an hour (playback, downloads); it doesn't count against the cap
+        self._gov.release(host, response.status_code, response.headers.get("Retry-After"))
+        return response
+
+    async def aclose(self):
+        await self._inner.aclose()
+
+
+class GovernedSyncTransport(httpx.BaseTransport):
+    def __init__(self, inner: httpx.BaseTransport, gov: UpstreamGovernor = governor):
+        self._inner = inner
+        self._gov = gov
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        limit = _wait_limit(request)
+        if not self._gov.acquire_sync(host, limit):
+            raise _busy(request, limit)
+        try:
+            response = self._inner.handle_request(request)
+        except BaseException:
+            self._gov.release(host)
+            raise
+        self._gov.release(host, response.status_code, response.headers.get("Retry-After"))
+        return response
+
+    def close(self):
+        self._inner.close()
+
+
+def governed_transport(**kwargs) -> GovernedTransport:
+    """httpx.AsyncHTTPTransport(**kwargs) behind the shared governor."""
+    return GovernedTransport(httpx.AsyncHTTPTransport(**kwargs))
+
+
+def governed_sync_transport(**kwargs) -> GovernedSyncTransport:
+    return GovernedSyncTransport(httpx.HTTPTransport(**kwargs))
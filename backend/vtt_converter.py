@@ -0,0 +1,157 @@
+"""
+vtt_converter.py – Incremental SRT/VTT -> WebVTT conversion.
+
+Parses subtitles cue by cue as bytes arrive, so converted output can be sent
+to the client before the upstream download finishes and no single step has to
+process the whole file at once. Handles BOMs / encoding fallback, normalizes
+timestamps (00:00:01,000 -> 00:00:01.000) and injects `line:80%` cue settings
+to keep subtitles clear of letterbox bars.
+"""
+
+import codecs
+import re
+from typing import AsyncIterator, Iterable
+
+DEFAULT_CUE_SETTINGS = "line:80%"
+
+_TIMESTAMP = r"(?:\d{1,2}:)?\d{1,2}:\d{2}[,.]\d{1,3}"
+_TIMING_RE = re.compile(rf"^\s*({_TIMESTAMP})\s*-->\s*({_TIMESTAMP})(.*)$")
+_TS_PARTS_RE = re.compile(r"^(?:(\d{1,2}):)?(\d{1,2}):(\d{2})[,.](\d{1,3})$")
+_BLOCK_SPLIT_RE = re.compile(r"\n[ \t]*\n")
+
+
+def normalize_timestamp(ts: str) -> str:
+    """'0:01:02,5' / '01:02.500' -> '00:01:02.500'."""
+    m = _TS_PARTS_RE.match(ts.strip())
+    if not m:
+        return ts
+    hours, minutes, seconds, millis = m.groups()
+    return f"{int(hours or 0):02d}:{int(minutes):02d}:{seconds}.{millis.ljust(3, '0')}"
+
+
+class SubtitleStreamConverter:
+    """Feed raw subtitle bytes, get WebVTT text back incrementally."""
+
+    def __init__(self, cue_settings: str = DEFAULT_CUE_SETTINGS):
+        self.cue_settings = cue_settings
+        self._decoder = None
+        self._fallback = False
+        self._pending_bytes = b""
+        self._buffer = ""
+        self._carry_cr = False  # chunk ended in "\r": it may be the first half of "\r\n"
+        self._started = False
+
+    # --- decoding --------------------------------------------------------
+
+    def _pick_decoder(self, head: bytes):
+        if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE):
+            return codecs.getincrementaldecoder("utf-16")()
+        return codecs.getincrementaldecoder("utf-8-sig")()
+
+    def _decode(self, data: bytes, final: bool = False) -> str:
+        if self._decoder is None:
+            self._pending_bytes += data
+            # Need a few bytes to sniff a BOM
+            if len(self._pending_bytes) < 4 and not final:
+                return ""
+            data, self._pending_bytes = self._pending_bytes, b""
+            self._decoder = self._pick_decoder(data)
+        # Bytes the decoder holds from earlier chunks (a split multi-byte sequence)
+        buffered = self._decoder.getstate()[0]
+        try:
+            return self._decoder.decode(data, final)
+        except UnicodeDecodeError:
+            if self._fallback:
+                raise
+            # Not UTF-8: treat the rest of the stream as latin-1 (never fails)
+            self._fallback = True
+            self._decoder = codecs.getincrementaldecoder("latin-1")()
+            return self._decoder.decode(buffered + data, final)
+
+    def _append(self, text: str, final: bool = False):
+        """Add decoded text to the buffer with line endings normalized across chunk boundaries."""
+        if self._carry_cr:
+            text = "\r" + text
+            self._carry_cr = False
+        if text.endswith("\r") and not final:
+            text = text[:-1]
+            self._carry_cr = True
+        self._buffer += text.replace("\r\n", "\n").replace("\r", "\n")
+
+    # --- cue handling ----------------------------------------------------
+
+    def _convert_block(self, block: str) -> str | None:
+        block = block.replace("\\N", "\n").replace("\\n", "\n").strip("\n")
+        if not block.strip():
+            return None
+        lines = block.split("\n")
+        for i, line in enumerate(lines):
+            m = _TIMING_RE.match(line)
+            if not m:
+                continue
+            start, end, settings = m.groups()
+            settings = settings.strip()
+            if self.cue_settings and "line:" not in settings:
+                settings = f"{self.cue_settings} {settings}".strip()
+            lines[i] = f"{normalize_timestamp(start)} --> {normalize_timestamp(end)}" + (f" {settings}" if settings else "")
+            break
+        return "\n".join(lines)
+
+    def _emit_blocks(self, blocks: Iterable[str]) -> str:
+        out = []
+        for block in blocks:
+            if not self._started:
+                block = block.lstrip()
+                if not block:
+                    continue
+                self._started = True
+                if not block.startswith("WEBVTT"):
+                    out.append("WEBVTT\n\n")
+                else:
+                    # Header block passes through untouched
+                    out.append(block.strip("\n") + "\n\n")
+                    continue
+            converted = self._convert_block(block)
+            if converted is not None:
+                out.append(converted + "\n\n")
+        return "".join(out)
+
+    def feed(self, data: bytes) -> str:
+        """Consume a chunk of bytes; return WebVTT for every cue completed so far."""
+        text = self._decode(data)
+        if not text:
+            return ""
+        self._append(text)
+        parts = _BLOCK_SPLIT_RE.split(self._buffer)
+        # The last part may be an incomplete cue; keep it for the next chunk
+        self._buffer = parts.pop()
+        return self._emit_blocks(parts)
+
+    def finish(self) -> str:
+        """Flush the final cue."""
+        self._append(self._decode(b"", final=True), final=True)
+        parts = _BLOCK_SPLIT_RE.split(self._buffer)
+        self._buffer = ""
+        out = self._emit_blocks(parts)
+        if not self._started:
+            self._started = True
+            out = "WEBVTT\n\n" + out
+        return out
+
+
+def convert(content: bytes, cue_settings: str = DEFAULT_CUE_SETTINGS) -> str:
+    """Convert a whole subtitle payload in one call."""
+    converter = SubtitleStreamConverter(cue_settings)
+    return converter.feed(content) + converter.finish()
+
+
+async def convert_stream(chunks: AsyncIterator[bytes], cue_settings: str = DEFAULT_CUE_SETTINGS) -> AsyncIterator[str]:
+    """Convert an async byte stream, yielding WebVTT text as cues complete."""
+    converter = SubtitleStreamConverter(cue_settings)
+    async for chunk in chunks:
+        out = converter.feed(chunk)
+        if out:
+            yield out
+    out = converter.finish()
+    if out:
+        yield out
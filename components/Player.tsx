@@ -179,9 +179,16 @@ const Player: React.FC<PlayerProps> = ({
     : `https://v2.vidsrc.me/embed/movie/${movie.id}`;
 
   const [hevcSupported, setHevcSupported] = useState(false);
+  // Progressive transcode: restarted with start_time on every seek, timeline offset by transcodeStartTime
   const [isTranscodedStream, setIsTranscodedStream] = useState(false);
+  // HLS transcode (/api/stream redirects to a VOD playlist starting at 0): played through hls.js, seeks natively
+  const [isHlsOutput, setIsHlsOutput] = useState(false);
   const [isTranscodeChecking, setIsTranscodeChecking] = useState(false);
   const [transcodeStartTime, setTranscodeStartTime] = useState(0);
+  // Progressive transcodes restart at start_time. Keep those seeks on the encoder's keyframe grid
+  // (KEYFRAME_INTERVAL in backend/transcode.py) so buffered output of a running encoder can be reused
+  const TRANSCODE_SEEK_STEP = 2;
+  const snapTranscodeStart = (time: number) => Math.max(0, Math.floor(time / TRANSCODE_SEEK_STEP) * TRANSCODE_SEEK_STEP);
   const historyResumedRef = useRef(false);
   const pendingSeekTimeRef = useRef<number | null>(null);
 
@@ -202,7 +209,10 @@ const Player: React.FC<PlayerProps> = ({
 
   const isNative = Capacitor.isNativePlatform();
 
-  // Dynamic currentUrl builder that appends start_time and hevc supported params
+  // Per-player token so the backend can tell viewers apart (IP + User-Agent can't behind a shared NAT)
+  const playerIdRef = useRef(Math.random().toString(36).slice(2) + Date.now().toString(36));
+
+  // Dynamic currentUrl builder that appends start_time, hevc supported and player params
   const currentUrl = (() => {
     if (useEmbed) return embedUrl;
     if (!selectedStreamUrl) return '';
@@ -211,11 +221,12 @@ const Player: React.FC<PlayerProps> = ({
       let url = selectedStreamUrl;
       url = url.replace(/[?&]start_time=[^&]*/g, '');
       url = url.replace(/[?&]hevc=[^&]*/g, '');
+      url = url.replace(/[?&]player=[^&]*/g, '');
       
       const separator = url.includes('?') ? '&' : '?';
       const hevcParam = hevcSupported ? 'hevc=1' : 'hevc=0';
-      const startTimeParam = transcodeStartTime > 0 ? `&start_time=${transcodeStartTime}` : '';
-      return `${url}${separator}${hevcParam}${startTimeParam}`;
+      const startTimeParam = transcodeStartTime > 0 && !isHlsOutput ? `&start_time=${transcodeStartTime}` : '';
+      return `${url}${separator}${hevcParam}${startTimeParam}&player=${playerIdRef.current}`;
     }
     return selectedStreamUrl;
   })();
@@ -224,6 +235,7 @@ const Player: React.FC<PlayerProps> = ({
   useEffect(() => {
     if (!selectedStreamUrl || useEmbed) {
       setIsTranscodedStream(false);
+      setIsHlsOutput(false);
       setIsTranscodeChecking(false);
       return;
     }
@@ -236,16 +248,22 @@ const Player: React.FC<PlayerProps> = ({
           // Use the lightweight /api/stream/check endpoint instead of fetching the full stream
           const yearParam = year ? `&year=${year}` : '';
           const hevcParam = hevcSupported ? 'hevc=1' : 'hevc=0';
-          const checkUrl = `${backendUrl}/api/stream/check?title=${encodeURIComponent(titleToSearch)}&is_tv=${computedIsSeries}&season=${season}&episode=${episode}${yearParam}&${hevcParam}`;
+          // Same output mode as the stream URL itself (the backend default applies when it has none)
+          const outputMatch = selectedStreamUrl.match(/[?&]output=([^&]*)/);
+          const outputParam = outputMatch ? `&output=${outputMatch[1]}` : '';
+          const checkUrl = `${backendUrl}/api/stream/check?title=${encodeURIComponent(titleToSearch)}&is_tv=${computedIsSeries}&season=${season}&episode=${episode}${yearParam}&${hevcParam}${outputParam}`;
 
           const res = await fetch(checkUrl, { signal: controller.signal });
           if (res.ok) {
             const data = await res.json();
-            const isTranscoded = data.transcoded === true;
+            const isHls = data.transcoded === true && data.output === 'hls';
+            const isTranscoded = data.transcoded === true && !isHls;
             setIsTranscodedStream(isTranscoded);
-            console.log("DEBUG: Checked transcode status:", isTranscoded);
+            setIsHlsOutput(isHls);
+            console.log("DEBUG: Checked transcode status:", isTranscoded, "HLS:", isHls);
           } else {
             setIsTranscodedStream(false);
+            setIsHlsOutput(false);
             console.log("DEBUG: Checked transcode status: false (check endpoint failed)");
           }
         } catch (e) {
@@ -253,6 +271,7 @@ const Player: React.FC<PlayerProps> = ({
             console.error("DEBUG: Failed to check transcode status:", e);
           }
           setIsTranscodedStream(false);
+          setIsHlsOutput(false);
         } finally {
           setIsTranscodeChecking(false);
         }
@@ -261,6 +280,7 @@ const Player: React.FC<PlayerProps> = ({
       return () => controller.abort();
     } else {
       setIsTranscodedStream(false);
+      setIsHlsOutput(false);
       setIsTranscodeChecking(false);
     }
   }, [selectedStreamUrl, useEmbed, hevcSupported]);
@@ -285,8 +305,8 @@ const Player: React.FC<PlayerProps> = ({
         if (item && item.timestamp > 10) {
           console.log(`DEBUG: Resuming history at ${item.timestamp}s. Transcoded: ${isTranscodedStream}`);
           if (isTranscodedStream) {
-            setTranscodeStartTime(item.timestamp);
-            setCurrentTime(item.timestamp);
+            setTranscodeStartTime(snapTranscodeStart(item.timestamp));
+            setCurrentTime(snapTranscodeStart(item.timestamp));
           } else {
             pendingSeekTimeRef.current = item.timestamp;
             setCurrentTime(item.timestamp);
@@ -303,7 +323,7 @@ const Player: React.FC<PlayerProps> = ({
       const targetTime = currentTimeRef.current;
       console.log(`DEBUG: Quality switch. Preserving playhead at ${targetTime}s. Transcoded: ${isTranscodedStream}`);
       if (isTranscodedStream) {
-        setTranscodeStartTime(targetTime);
+        setTranscodeStartTime(snapTranscodeStart(targetTime));
       } else {
         pendingSeekTimeRef.current = targetTime;
         setTranscodeStartTime(0); // Reset transcode offset since it's now native seek
@@ -815,8 +835,8 @@ const Player: React.FC<PlayerProps> = ({
     if (swipeDirection === 'horizontal' && videoRef.current) {
       const seekTime = Math.max(0, Math.min(displayDuration, currentTime + swipeAmount));
       if (isTranscodedStream) {
-        setTranscodeStartTime(seekTime);
-        setCurrentTime(seekTime);
+        setTranscodeStartTime(snapTranscodeStart(seekTime));
+        setCurrentTime(snapTranscodeStart(seekTime));
         setLoading(true);
       } else {
         videoRef.current.currentTime = seekTime;
@@ -872,8 +892,8 @@ const Player: React.FC<PlayerProps> = ({
     const seekTime = Math.max(0, Math.min(displayDuration, targetTime));
     
     if (isTranscodedStream) {
-      setTranscodeStartTime(seekTime);
-      setCurrentTime(seekTime);
+      setTranscodeStartTime(snapTranscodeStart(seekTime));
+      setCurrentTime(snapTranscodeStart(seekTime));
       setLoading(true);
     } else {
       videoRef.current.currentTime = seekTime;
@@ -895,7 +915,7 @@ const Player: React.FC<PlayerProps> = ({
   const handleTimeUpdate = () => {
     if (videoRef.current && !isSeeking) {
       const videoTime = videoRef.current.currentTime;
-      setCurrentTime(videoTime + transcodeStartTime);
+      setCurrentTime(isTranscodedStream ? videoTime + transcodeStartTime : videoTime);
       
       const reportedDuration = videoRef.current.duration;
       // Only update state duration if the video reports something reasonable and it's not transcoded
@@ -994,8 +1014,8 @@ const Player: React.FC<PlayerProps> = ({
     // Ensure the video seeks to the final position on mouse/touch release
     const time = Number((e.target as HTMLInputElement).value);
     if (isTranscodedStream) {
-      setTranscodeStartTime(time);
-      setCurrentTime(time);
+      setTranscodeStartTime(snapTranscodeStart(time));
+      setCurrentTime(snapTranscodeStart(time));
       setLoading(true);
     } else {
       if (videoRef.current) {
@@ -1017,8 +1037,8 @@ const Player: React.FC<PlayerProps> = ({
     const seekTime = percentage * displayDuration;
     if (displayDuration > 0) {
       if (isTranscodedStream) {
-        setTranscodeStartTime(seekTime);
-        setCurrentTime(seekTime);
+        setTranscodeStartTime(snapTranscodeStart(seekTime));
+        setCurrentTime(snapTranscodeStart(seekTime));
         setLoading(true);
       } else {
         if (videoRef.current) {
@@ -1075,6 +1095,7 @@ const Player: React.FC<PlayerProps> = ({
     setLoading(true);
     setTranscodeStartTime(0);
     setIsTranscodedStream(false);
+    setIsHlsOutput(false);
     historyResumedRef.current = false;
   }, [movie.id, initialSeason, initialEpisode, computedIsSeries]);
 
@@ -1128,7 +1149,7 @@ const Player: React.FC<PlayerProps> = ({
             // Proxy subtitle URLs through backend
             const proxiedSubs = subsData.map((s: any) => ({
               language: s.language || 'Unknown',
-              url: `${backendUrl}/api/subtitles/proxy?url=${encodeURIComponent(s.url)}`
+              url: `${backendUrl}/api/subtitles/proxy?url=${encodeURIComponent(s.url)}&lang=${encodeURIComponent(s.language || '')}&title=${encodeURIComponent(titleToSearch)}`
             }));
             setSubtitles(proxiedSubs);
             // Check preferred subtitle language
@@ -1215,10 +1236,10 @@ const Player: React.FC<PlayerProps> = ({
       (window as any).hls = null;
     }
 
-    // Improved HLS detection: check for .m3u8 explicitly.
-    // If it's our backend proxy, we'll try HLS if it doesn't look like a direct file, 
-    // but we'll add a robust fallback in the error handler.
-    const isHls = currentUrl.includes('.m3u8');
+    // Improved HLS detection: check for .m3u8 explicitly, or the backend's HLS transcode output
+    // (/api/stream redirects to the playlist, so the URL itself doesn't show it).
+    // A robust fallback is in the error handler.
+    const isHls = currentUrl.includes('.m3u8') || isHlsOutput;
 
 
     if (isHls) {
@@ -1276,7 +1297,7 @@ const Player: React.FC<PlayerProps> = ({
     // Note: History resume is handled by the dedicated useEffect when transcode status is ready.
 
     video.play().catch(() => { });
-  }, [currentUrl, useEmbed, isTranscodeChecking]);
+  }, [currentUrl, useEmbed, isTranscodeChecking, isHlsOutput]);
 
 
   useEffect(() => {
@@ -0,0 +1,121 @@
+"""
+Unit tests for the keyframe seek index (backend/seek_index.py).
+Builds small synthetic moov boxes and checks the stts/ctts/stsc/stss/stsz/stco|co64
+and edit list walks in build_keyframe_index.
+"""
+import sys
+import os
+import struct
+
+import pytest
+
+# Ensure backend dir is on the path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "backend"))
+
+from seek_index import build_keyframe_index
+
+
+def box(kind: str, *payload: bytes) -> bytes:
+    body = b"".join(payload)
+    return struct.pack(">I4s", 8 + len(body), kind.encode("latin-1")) + body
+
+
+def full_box(kind: str, version: int, *payload: bytes) -> bytes:
+    return box(kind, struct.pack(">I", version << 24), *payload)
+
+
+def table(kind: str, fmt: str, entries, version: int = 0) -> bytes:
+    return full_box(kind, version, struct.pack(">I", len(entries)), *(struct.pack(fmt, *e) for e in entries))
+
+
+def mdhd(timescale: int, duration: int, version: int = 0) -> bytes:
+    if version == 1:
+        return full_box("mdhd", 1, struct.pack(">QQIQ", 0, 0, timescale, duration), b"\0" * 4)
+    return full_box("mdhd", 0, struct.pack(">IIII", 0, 0, timescale, duration), b"\0" * 4)
+
+
+def hdlr(handler: bytes) -> bytes:
+    return full_box("hdlr", 0, b"\0" * 4, handler, b"\0" * 12, b"\0")
+
+
+def moov(*, handler=b"vide", timescale=1000, duration=3000, mdhd_version=0, stbl=(), elst=None) -> bytes:
+    trak = []
+    if elst is not None:
+        # (segment duration, media time) with a 1.0 media rate
+        trak.append(box("edts", table("elst", ">IiHH", [(d, t, 1, 0) for d, t in elst])))
+    minf = box("minf", box("stbl", *stbl))
+    trak.append(box("mdia", mdhd(timescale, duration, mdhd_version), hdlr(handler), minf))
+    return box("moov", full_box("mvhd", 0, b"\0" * 96), box("trak", *trak))
+
+
+def stsz(sizes=None, uniform=0, count=0) -> bytes:
+    sizes = sizes or []
+    return full_box("stsz", 0, struct.pack(">II", uniform, count or len(sizes)), *(struct.pack(">I", s) for s in sizes))
+
+
+# Six samples: stts durations 500, 500, 250, 250, 250, 250 (decode 0, 500, 1000, 1250, 1500, 1750)
+STTS = table("stts", ">II", [(2, 500), (4, 250)])
+# Composition offsets 1000, 0, 500 x4 -> presentation 1000, 500, 1500, 1750, 2000, 2250
+CTTS = table("ctts", ">II", [(1, 1000), (1, 0), (4, 500)])
+# Chunks 1-2 hold two samples each, chunks 3-4 one each
+STSC = table("stsc", ">III", [(1, 2, 1), (3, 1, 1)])
+SIZES = [100, 10, 20, 200, 30, 40]
+STSS = table("stss", ">I", [(1,), (4,)])
+BASE = 5_000_000_000  # past 4 GiB: needs co64
+CO64 = table("co64", ">Q", [(BASE,), (BASE + 1000,), (BASE + 2000,), (BASE + 3000,)])
+
+
+def test_ctts_co64_stsc_and_edit_list():
+    data = moov(stbl=(STTS, CTTS, STSC, stsz(SIZES), STSS, CO64), elst=[(2000, 1000)])
+    index = build_keyframe_index(data, moov_offset=BASE + 10_000, file_size=BASE + 20_000)
+    # Presentation time minus the edit list's media start (1000)
+    assert list(index.times) == [0.0, 0.75]
+    # Sample 4 is the second sample of chunk 2, after sample 3 (20 bytes)
+    assert list(index.offsets) == [BASE, BASE + 1020]
+    assert index.duration == pytest.approx(2.0)
+    assert index.moov_size == len(data)
+    assert index.moov_at_end
+    assert index.keyframe_before(0.7) == (0.0, BASE)
+    assert index.keyframe_before(5.0) == (0.75, BASE + 1020)
+
+
+def test_signed_ctts_version_1():
+    ctts = table("ctts", ">Ii", [(1, 0), (1, -500), (4, 0)], version=1)
+    stss = table("stss", ">I", [(1,), (3,)])
+    index = build_keyframe_index(moov(stbl=(STTS, ctts, STSC, stsz(SIZES), stss, CO64)))
+    assert list(index.times) == [0.0, 1.0]
+    assert list(index.offsets) == [BASE, BASE + 1000]
+
+
+def test_without_stss_every_sample_is_sync():
+    stco = table("stco", ">I", [(1000,)])
+    stsc = table("stsc", ">III", [(1, 6, 1)])
+    stts = table("stts", ">II", [(6, 500)])
+    index = build_keyframe_index(moov(stbl=(stts, stsc, stsz(uniform=100, count=6), stco)))
+    # Index points are spaced NO_STSS_SPACING (1 s) apart
+    assert list(index.times) == [0.0, 1.0, 2.0]
+    assert list(index.offsets) == [1000, 1200, 1400]
+    assert not index.moov_at_end
+    assert index.to_dict()["keyframes"] == 3
+
+
+def test_mdhd_version_1():
+    data = moov(timescale=90000, duration=270000, mdhd_version=1, stbl=(
+        table("stts", ">II", [(3, 90000)]),
+        table("stsc", ">III", [(1, 3, 1)]),
+        stsz([10, 10, 10]),
+        table("stss", ">I", [(1,), (3,)]),
+        table("stco", ">I", [(64,)]),
+    ))
+    index = build_keyframe_index(data)
+    assert list(index.times) == [0.0, 2.0]
+    assert list(index.offsets) == [64, 84]
+    assert index.duration == pytest.approx(3.0)
+
+
+def test_no_video_track():
+    assert build_keyframe_index(moov(handler=b"soun", stbl=(STTS, STSC, stsz(SIZES), CO64))) is None
+
+
+def test_missing_sample_tables():
+    assert build_keyframe_index(moov(stbl=(STTS, stsz(SIZES), CO64))) is None
@@ -0,0 +1,76 @@
+"""
+Unit tests for the incremental SRT -> WebVTT converter (backend/vtt_converter.py).
+Checks that the output doesn't depend on where the byte stream is split.
+"""
+import sys
+import os
+
+import pytest
+
+# Ensure backend dir is on the path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "backend"))
+
+from vtt_converter import SubtitleStreamConverter, convert
+
+SRT = (
+    "1\r\n"
+    "00:00:01,000 --> 00:00:02,500\r\n"
+    "Hello\r\n"
+    "World\r\n"
+    "\r\n"
+    "2\r\n"
+    "00:00:03,000 --> 00:00:04,000\r\n"
+    "Ünïcödé line\r\n"
+    "second line\r\n"
+    "\r\n"
+    "3\r\n"
+    "0:00:05,5 --> 0:00:06,75\r\n"
+    "Last cue\r\n"
+).encode("utf-8")
+
+EXPECTED = (
+    "WEBVTT\n\n"
+    "1\n00:00:01.000 --> 00:00:02.500 line:80%\nHello\nWorld\n\n"
+    "2\n00:00:03.000 --> 00:00:04.000 line:80%\nÜnïcödé line\nsecond line\n\n"
+    "3\n00:00:05.500 --> 00:00:06.750 line:80%\nLast cue\n\n"
+)
+
+
+def convert_in_chunks(data: bytes, size: int) -> str:
+    converter = SubtitleStreamConverter()
+    out = [converter.feed(data[i:i + size]) for i in range(0, len(data), size)]
+    out.append(converter.finish())
+    return "".join(out)
+
+
+def test_convert_whole_payload():
+    assert convert(SRT) == EXPECTED
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 16, 64, len(SRT)])
+def test_crlf_chunk_sizes(size):
+    assert convert_in_chunks(SRT, size) == EXPECTED
+
+
+def test_every_split_point():
+    for split in range(1, len(SRT)):
+        converter = SubtitleStreamConverter()
+        out = converter.feed(SRT[:split]) + converter.feed(SRT[split:]) + converter.finish()
+        assert out == EXPECTED, f"split at byte {split}"
+
+
+def test_split_inside_crlf_keeps_cue_together():
+    converter = SubtitleStreamConverter()
+    head, tail = SRT.split(b"Hello\r", 1)
+    out = converter.feed(head + b"Hello\r") + converter.feed(tail) + converter.finish()
+    assert "Hello\nWorld" in out
+
+
+def test_lone_cr_line_endings():
+    data = SRT.replace(b"\r\n", b"\r")
+    assert convert_in_chunks(data, 1) == EXPECTED
+    assert convert(data) == EXPECTED
+
+
+def test_trailing_cr_at_end_of_stream():
+    assert convert_in_chunks(SRT + b"\r", 1) == EXPECTED